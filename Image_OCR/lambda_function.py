@@ -1,763 +1,4212 @@
-# import boto3
-# import json
-# import csv
-# import io
-# import zipfile
-# import os
-# import urllib.request
-# import urllib.parse
-# import email
-# import base64
-# import hashlibgit 
-# import re
-# from datetime import datetime
-# from PyPDF2 import PdfReader
-# from email.mime.multipart import MIMEMultipart
-# from email.mime.text import MIMEText
-# from email.mime.base import MIMEBase
-# from email import encoders
-# # Removed PIL import - not needed for OpenAI Vision API
+import boto3
+import json
+import csv
+import io
+import zipfile
+import os
+import urllib.parse
+import email
+import email.utils
+import base64
+import functools
+import hashlib
+import re
+import socket
+import threading
+import time
+import zlib
+import httpx
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from PyPDF2 import PdfReader, __version__ as PYPDF2_VERSION
+from PyPDF2.generic import ContentStream
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email import encoders
+
+# Partial JSON parser for streamed tool calls (optional - needs the native module for this platform)
+try:
+    import jiter
+except ImportError:
+    jiter = None
+
+# Image preprocessing before vision calls (optional - without Pillow images are sent as they are)
+try:
+    from PIL import Image, ImageOps, ImageStat
+except ImportError:
+    Image = None
 
 # Initialize AWS clients
 s3 = boto3.client('s3')
 ses = boto3.client('ses')
 
-def call_openai_api(prompt, api_key, function_definition, max_retries=3):
+# Model used for all OpenAI calls
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4o')
+
+# OpenAI HTTP transport settings
+OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', '10'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '10'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', '30'))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', '10'))
+OPENAI_READ_TIMEOUT = float(os.environ.get('OPENAI_READ_TIMEOUT', '60'))
+
+# Shared across warm invocations of the same Lambda container
+_openai_http_client = None
+_openai_http_client_lock = threading.Lock()
+
+def get_openai_http_client():
     """
-    Direct API call to OpenAI using urllib (built-in Python library)
-    Enhanced with retry logic for rate limits
+    Return the shared keep-alive HTTP client used for all OpenAI calls.
+    The connection pool lives at module level so warm invocations skip the TCP+TLS handshake.
     """
-    url = 'https://api.openai.com/v1/chat/completions'
+    global _openai_http_client
     
-    payload = {
-        "model": "gpt-4o",
-        "messages": [
-            {"role": "system", "content": "You are an invoice analysis assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        "tools": [{"type": "function", "function": function_definition}],
-        "tool_choice": {"type": "function", "function": {"name": function_definition["name"]}},
-        "max_tokens": 4096,
-        "temperature": 0
-    }
+    if _openai_http_client is None:
+        with _openai_http_client_lock:
+            if _openai_http_client is None:
+                _openai_http_client = httpx.Client(
+                    base_url=OPENAI_API_BASE,
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                    ),
+                    timeout=httpx.Timeout(
+                        OPENAI_READ_TIMEOUT,
+                        connect=OPENAI_CONNECT_TIMEOUT
+                    )
+                )
     
-    for attempt in range(max_retries):
-        try:
-            # Prepare the request
-            data = json.dumps(payload).encode('utf-8')
-            
-            req = urllib.request.Request(url, data=data)
-            req.add_header('Authorization', f'Bearer {api_key}')
-            req.add_header('Content-Type', 'application/json')
-            
-            # Make the request
-            with urllib.request.urlopen(req, timeout=60) as response:
-                result = json.loads(response.read().decode('utf-8'))
+    return _openai_http_client
+
+# Client-side OpenAI rate limits (0 disables the corresponding budget)
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '30000'))
+
+class OpenAIRateLimiter:
+    """
+    Token bucket limiter enforcing both requests-per-minute and tokens-per-minute budgets.
+    Callers block just long enough to stay under the account quota instead of
+    bursting into 429 responses and retrying in lockstep.
+    """
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self.total_wait_seconds = 0.0
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        
+        if self.requests_per_minute > 0:
+            self.available_requests = min(
+                self.requests_per_minute,
+                self.available_requests + elapsed * self.requests_per_minute / 60.0
+            )
+        if self.tokens_per_minute > 0:
+            self.available_tokens = min(
+                self.tokens_per_minute,
+                self.available_tokens + elapsed * self.tokens_per_minute / 60.0
+            )
+    
+    def acquire(self, estimated_tokens):
+        """
+        Reserve one request and estimated_tokens from the budgets, blocking until both are available.
+        Returns the number of seconds spent waiting.
+        """
+        # A single request larger than the whole budget only has to wait for a full bucket
+        if self.tokens_per_minute > 0:
+            estimated_tokens = min(estimated_tokens, self.tokens_per_minute)
+        
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
                 
-                if result.get('choices') and result['choices'][0]['message'].get('tool_calls'):
-                    function_args = json.loads(result['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
-                    return function_args
-                else:
-                    print("No tool calls in response")
-                    return {}
-                    
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode()
-            print(f"OpenAI API HTTP error: {e.code} - {error_message}")
-            
-            # Check if it's a rate limit error
-            if e.code == 429 and attempt < max_retries - 1:
-                import time
-                import random
-                wait_time = (2 ** attempt) + random.uniform(0, 1)
-                print(f"Rate limited, waiting {wait_time:.2f} seconds before retry {attempt + 1}")
-                time.sleep(wait_time)
-                continue
+                wait_time = max(0.0, self.paused_until - time.monotonic())
+                if self.requests_per_minute > 0 and self.available_requests < 1:
+                    wait_time = max(wait_time, (1 - self.available_requests) * 60.0 / self.requests_per_minute)
+                if self.tokens_per_minute > 0 and self.available_tokens < estimated_tokens:
+                    wait_time = max(wait_time, (estimated_tokens - self.available_tokens) * 60.0 / self.tokens_per_minute)
+                
+                if wait_time <= 0:
+                    if self.requests_per_minute > 0:
+                        self.available_requests -= 1
+                    if self.tokens_per_minute > 0:
+                        self.available_tokens -= estimated_tokens
+                    self.total_wait_seconds += waited
+                    return waited
             
-            return {}
-        except Exception as e:
-            print(f"Error calling OpenAI API (attempt {attempt + 1}): {str(e)}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(1)  # Brief pause before retry
-                continue
-            return {}
+            time.sleep(wait_time)
+            waited += wait_time
     
-    return {}
+    def has_capacity(self, estimated_tokens):
+        """
+        True if a request of estimated_tokens could be sent right now without waiting
+        """
+        with self.lock:
+            self._refill()
+            if self.paused_until > time.monotonic():
+                return False
+            if self.requests_per_minute > 0 and self.available_requests < 1:
+                return False
+            if self.tokens_per_minute > 0 and self.available_tokens < min(estimated_tokens, self.tokens_per_minute):
+                return False
+            return True
+    
+    def pause(self, seconds):
+        """
+        Stop handing out capacity for the given time, e.g. after the API reported a rate limit reset
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """
+        Correct the token budget once the real usage reported by the API is known.
+        actual_tokens of None means the API reported nothing and the estimate stands;
+        0 refunds the whole estimate, e.g. for a request that was cancelled unanswered.
+        """
+        if self.tokens_per_minute > 0 and actual_tokens is not None:
+            with self.lock:
+                self.available_tokens -= actual_tokens - estimated_tokens
+
+# Shared by every worker thread and across warm invocations
+openai_rate_limiter = OpenAIRateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE)
 
-def call_openai_vision_api(prompt, image_base64, api_key, max_retries=3):
+class UsageTracker:
     """
-    Call OpenAI Vision API for image processing
+    Token usage reported by the API during a run, including prompt tokens served from
+    OpenAI's automatic prompt cache (usage.prompt_tokens_details.cached_tokens)
     """
-    url = 'https://api.openai.com/v1/chat/completions'
     
-    payload = {
-        "model": "gpt-4o",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
-                        }
-                    }
-                ]
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run()
+    
+    def start_run(self):
+        with self.lock:
+            self.responses = 0
+            self.prompt_tokens = 0
+            self.cached_tokens = 0
+            self.completion_tokens = 0
+    
+    def record(self, usage):
+        if not usage:
+            return
+        with self.lock:
+            self.responses += 1
+            self.prompt_tokens += usage.get('prompt_tokens', 0)
+            self.cached_tokens += (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+            self.completion_tokens += usage.get('completion_tokens', 0)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "responses": self.responses,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0
             }
-        ],
-        "max_tokens": 4096,
-        "temperature": 0
-    }
+
+openai_usage = UsageTracker()
+
+def estimate_text_tokens(text):
+    """
+    Rough token estimate for English/invoice text (about 4 characters per token)
+    """
+    return len(text) // 4 + 1
+
+def get_image_dimensions(image_content):
+    """
+    Read (width, height) from the header of a JPEG, PNG, GIF, WebP or BMP image
+    Returns None if the format is not recognised
+    """
+    try:
+        if image_content[:8] == b'\x89PNG\r\n\x1a\n':
+            return int.from_bytes(image_content[16:20], 'big'), int.from_bytes(image_content[20:24], 'big')
+        
+        if image_content[:6] in (b'GIF87a', b'GIF89a'):
+            return int.from_bytes(image_content[6:8], 'little'), int.from_bytes(image_content[8:10], 'little')
+        
+        if image_content[:2] == b'BM':
+            return int.from_bytes(image_content[18:22], 'little', signed=True), abs(int.from_bytes(image_content[22:26], 'little', signed=True))
+        
+        if image_content[:4] == b'RIFF' and image_content[8:12] == b'WEBP':
+            chunk = image_content[12:16]
+            if chunk == b'VP8 ':
+                return int.from_bytes(image_content[26:28], 'little') & 0x3FFF, int.from_bytes(image_content[28:30], 'little') & 0x3FFF
+            if chunk == b'VP8L':
+                bits = int.from_bytes(image_content[21:25], 'little')
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b'VP8X':
+                return int.from_bytes(image_content[24:27], 'little') + 1, int.from_bytes(image_content[27:30], 'little') + 1
+        
+        if image_content[:2] == b'\xff\xd8':
+            offset = 2
+            while offset + 9 < len(image_content):
+                if image_content[offset] != 0xFF:
+                    offset += 1
+                    continue
+                marker = image_content[offset + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                    offset += 1 if marker == 0xFF else 2
+                    continue
+                segment_length = int.from_bytes(image_content[offset + 2:offset + 4], 'big')
+                # SOFn markers carry the frame size (C4, C8 and CC are not frame headers)
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height = int.from_bytes(image_content[offset + 5:offset + 7], 'big')
+                    width = int.from_bytes(image_content[offset + 7:offset + 9], 'big')
+                    return width, height
+                offset += 2 + segment_length
+    except Exception as e:
+        print(f"Could not read image dimensions: {str(e)}")
     
-    for attempt in range(max_retries):
-        try:
-            data = json.dumps(payload).encode('utf-8')
-            
-            req = urllib.request.Request(url, data=data)
-            req.add_header('Authorization', f'Bearer {api_key}')
-            req.add_header('Content-Type', 'application/json')
-            
-            with urllib.request.urlopen(req, timeout=60) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                
-                if result.get('choices') and result['choices'][0]['message'].get('content'):
-                    return result['choices'][0]['message']['content']
-                else:
-                    print("No content in vision response")
-                    return ""
-                    
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode()
-            print(f"OpenAI Vision API HTTP error: {e.code} - {error_message}")
-            
-            if e.code == 429 and attempt < max_retries - 1:
-                import time
-                import random
-                wait_time = (2 ** attempt) + random.uniform(0, 1)
-                print(f"Rate limited, waiting {wait_time:.2f} seconds before retry {attempt + 1}")
-                time.sleep(wait_time)
-                continue
-            
-            return ""
-        except Exception as e:
-            print(f"Error calling OpenAI Vision API (attempt {attempt + 1}): {str(e)}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(1)
-                continue
-            return ""
+    return None
+
+def vision_scale(width, height, detail="high"):
+    """
+    Factor GPT-4o applies before tiling: fit in 2048x2048, then bring the short side down to 768px.
+    Low detail images are fit in 512x512 instead.
+    """
+    if detail == "low":
+        return min(1.0, 512.0 / max(width, height))
+    scale = min(1.0, 2048.0 / max(width, height))
+    return scale * min(1.0, 768.0 / (min(width, height) * scale))
+
+def estimate_image_tokens(image_content, detail="high"):
+    """
+    Estimate vision input tokens the way GPT-4o bills images:
+    85 base tokens plus 170 per 512px tile after vision_scale
+    """
+    if detail == "low":
+        return 85
+    
+    dimensions = get_image_dimensions(image_content)
+    if not dimensions or min(dimensions) <= 0:
+        # Unknown size - assume a typical full page scan (2x2 tiles)
+        return 85 + 170 * 4
     
-    return ""
+    scale = vision_scale(*dimensions)
+    width, height = dimensions[0] * scale, dimensions[1] * scale
+    
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
 
-def clean_amount(amount_str):
+# Attachment extensions handled as images
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp')
+
+# Formats the vision API accepts as they are; anything else is converted first
+VISION_MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+# Multi-page TIFFs are split into at most this many pages, transcribed concurrently
+MAX_IMAGE_PAGES = int(os.environ.get('MAX_IMAGE_PAGES', '20'))
+
+def detect_image_format(image_content):
     """
-    Clean up amount strings to contain only numbers and decimal point
+    Real image format from the magic bytes ("jpeg", "png", "gif", "webp", "bmp", "tiff"), or None
     """
-    if not amount_str or amount_str in ['API_ERROR', 'ERROR', 'NO_TEXT', 'NOT_INVOICE', 'ZIP_ERROR']:
-        return amount_str
+    if image_content[:3] == b'\xff\xd8\xff':
+        return "jpeg"
+    if image_content[:8] == b'\x89PNG\r\n\x1a\n':
+        return "png"
+    if image_content[:6] in (b'GIF87a', b'GIF89a'):
+        return "gif"
+    if image_content[:4] == b'RIFF' and image_content[8:12] == b'WEBP':
+        return "webp"
+    if image_content[:2] == b'BM':
+        return "bmp"
+    if image_content[:4] in (b'II*\x00', b'MM\x00*'):
+        return "tiff"
+    return None
+
+def png_chunk(chunk_type, data):
+    return len(data).to_bytes(4, 'big') + chunk_type + data + zlib.crc32(chunk_type + data).to_bytes(4, 'big')
+
+def bmp_to_png(image_content):
+    """
+    Convert an uncompressed BMP (1, 4, 8, 24 or 32 bits per pixel) to PNG without Pillow
+    """
+    pixel_offset = int.from_bytes(image_content[10:14], 'little')
+    header_size = int.from_bytes(image_content[14:18], 'little')
+    width = int.from_bytes(image_content[18:22], 'little', signed=True)
+    height = int.from_bytes(image_content[22:26], 'little', signed=True)
+    bits = int.from_bytes(image_content[28:30], 'little')
+    compression = int.from_bytes(image_content[30:34], 'little')
+    if compression not in (0, 3) or bits not in (1, 4, 8, 24, 32) or width <= 0 or height == 0:
+        raise ValueError(f"Unsupported BMP ({bits} bits per pixel, compression {compression})")
     
-    # Remove all non-digit and non-decimal characters except for common currency symbols at the start
-    # Keep negative signs and commas for thousands
-    cleaned = re.sub(r'[^\d.,\-]', '', str(amount_str))
+    stride = (bits * width + 31) // 32 * 4
+    row_bytes = (bits * width + 7) // 8
+    # Rows are stored bottom-up unless the height is negative
+    row_order = range(abs(height)) if height < 0 else range(height - 1, -1, -1)
     
-    # Handle comma as thousands separator (e.g., 1,234.56)
-    if ',' in cleaned and '.' in cleaned:
-        # If both comma and dot, treat comma as thousands separator
-        cleaned = cleaned.replace(',', '')
-    elif ',' in cleaned and cleaned.count(',') == 1 and len(cleaned.split(',')[1]) <= 2:
-        # If comma might be decimal separator (European format)
-        cleaned = cleaned.replace(',', '.')
-    elif ',' in cleaned:
-        # Remove commas (thousands separators)
-        cleaned = cleaned.replace(',', '')
+    header = png_chunk(b'IHDR', width.to_bytes(4, 'big') + abs(height).to_bytes(4, 'big') + bytes([min(bits, 8), 3 if bits <= 8 else 2, 0, 0, 0]))
+    palette_chunk = b''
+    if bits <= 8:
+        colors = int.from_bytes(image_content[46:50], 'little') or 1 << bits
+        palette_start = 14 + header_size
+        palette = image_content[palette_start:palette_start + 4 * colors]
+        # BMP palette entries are BGRx, PNG wants RGB
+        palette_chunk = png_chunk(b'PLTE', b''.join(bytes((palette[i + 2], palette[i + 1], palette[i])) for i in range(0, len(palette), 4)))
     
-    return cleaned
+    step = bits // 8
+    rows = []
+    for row_index in row_order:
+        start = pixel_offset + row_index * stride
+        row = image_content[start:start + row_bytes]
+        if bits > 8:
+            rgb = bytearray(width * 3)
+            rgb[0::3], rgb[1::3], rgb[2::3] = row[2::step], row[1::step], row[0::step]
+            row = bytes(rgb)
+        rows.append(b'\x00' + row)
+    
+    return b'\x89PNG\r\n\x1a\n' + header + palette_chunk + png_chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) + png_chunk(b'IEND', b'')
 
-def extract_currency(amount_str):
+# TIFF field types that can hold the numeric tags a baseline image needs, with their sizes
+TIFF_FIELD_SIZES = {1: 1, 3: 2, 4: 4, 16: 8}
+# Compression schemes decoded without Pillow: none, zlib (old and new code) and PackBits
+TIFF_COMPRESSIONS = {1: "none", 8: "deflate", 32946: "deflate", 32773: "packbits"}
+
+def tiff_ifds(image_content):
     """
-    Extract currency from amount string
+    Tag dictionaries ({tag: [values]}) of the images (IFDs) in a TIFF, in page order
     """
-    if not amount_str or amount_str in ['API_ERROR', 'ERROR', 'NO_TEXT', 'NOT_INVOICE', 'ZIP_ERROR']:
-        return 'UNKNOWN'
+    byte_order = 'little' if image_content[:2] == b'II' else 'big'
+    read = lambda offset, size: int.from_bytes(image_content[offset:offset + size], byte_order)
     
-    # Common currency symbols and codes
-    currency_patterns = {
-        r'\$': 'USD',
-        r'USD': 'USD',
-        r'₹': 'INR',
-        r'INR': 'INR',
-        r'€': 'EUR',
-        r'EUR': 'EUR',
-        r'£': 'GBP',
-        r'GBP': 'GBP',
-        r'¥': 'JPY',
-        r'JPY': 'JPY',
-        r'₽': 'RUB',
-        r'RUB': 'RUB'
-    }
+    ifds = []
+    offset = read(4, 4)
+    seen = set()
+    while offset and offset not in seen and offset + 2 <= len(image_content):
+        seen.add(offset)
+        tags = {}
+        entry_count = read(offset, 2)
+        for entry in range(offset + 2, offset + 2 + 12 * entry_count, 12):
+            field_size = TIFF_FIELD_SIZES.get(read(entry + 2, 2))
+            if field_size is None:
+                continue
+            count = read(entry + 4, 4)
+            values_at = entry + 8 if field_size * count <= 4 else read(entry + 8, 4)
+            tags[read(entry, 2)] = [read(values_at + i * field_size, field_size) for i in range(count)]
+        ifds.append(tags)
+        offset = read(offset + 2 + 12 * entry_count, 4)
+    return ifds
+
+def unpack_packbits(data):
+    """
+    Decode one PackBits-compressed TIFF strip
+    """
+    output = bytearray()
+    position = 0
+    while position < len(data):
+        header = data[position]
+        if header < 128:
+            output += data[position + 1:position + 2 + header]
+            position += 2 + header
+        elif header > 128:
+            output += data[position + 1:position + 2] * (257 - header)
+            position += 2
+        else:
+            position += 1
+    return bytes(output)
+
+def tiff_page_to_png(image_content, tags):
+    """
+    Convert one baseline TIFF image (bilevel, grayscale, palette or RGB/RGBA with 8 bits per sample,
+    uncompressed, zlib or PackBits strips) to PNG without Pillow
+    """
+    if not all(tag in tags for tag in (256, 257, 273, 279)):
+        raise ValueError("TIFF image is missing its size or strip tags")
+    width, height = tags[256][0], tags[257][0]
+    bits = tags.get(258, [1])[0]
+    compression = tags.get(259, [1])[0]
+    photometric = tags.get(262, [1])[0]
+    samples = tags.get(277, [1])[0]
+    if (compression not in TIFF_COMPRESSIONS or tags.get(284, [1])[0] != 1 or tags.get(317, [1])[0] != 1
+            or (photometric, samples) not in ((0, 1), (1, 1), (2, 3), (2, 4), (3, 1))
+            or bits not in ((1, 4, 8) if photometric in (0, 1, 3) else (8,))):
+        raise ValueError(f"Unsupported TIFF ({bits} bits per sample, photometric {photometric}, compression {compression})")
     
-    amount_upper = str(amount_str).upper()
+    strips = []
+    for offset, byte_count in zip(tags[273], tags[279]):
+        strip = image_content[offset:offset + byte_count]
+        if TIFF_COMPRESSIONS[compression] == "deflate":
+            strip = zlib.decompress(strip)
+        elif TIFF_COMPRESSIONS[compression] == "packbits":
+            strip = unpack_packbits(strip)
+        strips.append(strip)
+    pixels = b''.join(strips)
     
-    for pattern, currency in currency_patterns.items():
-        if re.search(pattern, amount_upper):
-            return currency
+    row_bytes = (bits * samples * width + 7) // 8
+    if len(pixels) < row_bytes * height:
+        raise ValueError("TIFF strips are shorter than the image")
+    if photometric == 0:
+        # WhiteIsZero - PNG grayscale is always BlackIsZero
+        pixels = pixels.translate(bytes(255 - value for value in range(256)))
     
-    return 'UNKNOWN'
+    color_type = {1: 3 if photometric == 3 else 0, 3: 2, 4: 6}[samples]
+    header = png_chunk(b'IHDR', width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([bits, color_type, 0, 0, 0]))
+    palette_chunk = b''
+    if photometric == 3:
+        # ColorMap holds all reds, then all greens, then all blues, as 16-bit values
+        colormap = tags[320]
+        colors = len(colormap) // 3
+        palette_chunk = png_chunk(b'PLTE', bytes(colormap[channel * colors + index] >> 8 for index in range(colors) for channel in range(3)))
+    
+    rows = b''.join(b'\x00' + pixels[start:start + row_bytes] for start in range(0, row_bytes * height, row_bytes))
+    return b'\x89PNG\r\n\x1a\n' + header + palette_chunk + png_chunk(b'IDAT', zlib.compress(rows, 6)) + png_chunk(b'IEND', b'')
 
-def get_processed_emails(bucket):
+def convert_image_without_pillow(image_content, image_format):
     """
-    Get processed emails using Message-ID based tracking
+    (image bytes, MIME type) the vision API accepts, for when Pillow is not available
     """
-    processed_records = {}
-    tracking_key = "processed_emails_tracking.json"
+    if image_format in VISION_MIME_TYPES:
+        return image_content, VISION_MIME_TYPES[image_format]
+    if image_format == "bmp":
+        return bmp_to_png(image_content), "image/png"
+    if image_format == "tiff":
+        ifds = tiff_ifds(image_content)
+        if not ifds:
+            raise ValueError("TIFF has no images")
+        return tiff_page_to_png(image_content, ifds[0]), "image/png"
+    raise ValueError(f"{(image_format or 'unknown').upper()} images can't be sent to the vision API without Pillow")
+
+def split_image_pages(image_content):
+    """
+    Pages of a multi-page TIFF as separate lossless PNGs (up to MAX_IMAGE_PAGES);
+    any other image comes back as a single page
+    """
+    if detect_image_format(image_content) != "tiff":
+        return [image_content]
     
-    try:
-        response = s3.get_object(Bucket=bucket, Key=tracking_key)
-        tracking_data = json.loads(response['Body'].read().decode('utf-8'))
-        processed_records = tracking_data.get('processed_records', {})
-        print(f"Found {len(processed_records)} previously processed email records")
-        
-    except s3.exceptions.NoSuchKey:
-        print("No tracking file found - this is the first run")
-    except Exception as e:
-        print(f"Error reading tracking file: {str(e)}")
+    if Image is None:
+        try:
+            ifds = tiff_ifds(image_content)
+            if len(ifds) <= 1:
+                return [image_content]
+            if len(ifds) > MAX_IMAGE_PAGES:
+                print(f"TIFF has {len(ifds)} pages, only the first {MAX_IMAGE_PAGES} are processed")
+            return [tiff_page_to_png(image_content, tags) for tags in ifds[:MAX_IMAGE_PAGES]]
+        except Exception as e:
+            print(f"Could not split TIFF without Pillow: {str(e)}")
+            return [image_content]
     
-    return processed_records
+    with Image.open(io.BytesIO(image_content)) as tiff:
+        page_count = getattr(tiff, "n_frames", 1)
+        if page_count <= 1:
+            return [image_content]
+        if page_count > MAX_IMAGE_PAGES:
+            print(f"TIFF has {page_count} pages, only the first {MAX_IMAGE_PAGES} are processed")
+        
+        pages = []
+        for index in range(min(page_count, MAX_IMAGE_PAGES)):
+            tiff.seek(index)
+            buffer = io.BytesIO()
+            tiff.save(buffer, format="PNG")
+            pages.append(buffer.getvalue())
+        return pages
 
-def get_sent_emails(bucket):
+# Images are shrunk to what the vision model actually looks at and re-encoded within a byte budget
+IMAGE_PREPROCESSING_ENABLED = os.environ.get('IMAGE_PREPROCESSING_ENABLED', 'true').lower() == 'true'
+VISION_IMAGE_FORMAT = os.environ.get('VISION_IMAGE_FORMAT', 'JPEG').upper()
+VISION_IMAGE_QUALITY = int(os.environ.get('VISION_IMAGE_QUALITY', '85'))
+VISION_IMAGE_MIN_QUALITY = int(os.environ.get('VISION_IMAGE_MIN_QUALITY', '50'))
+VISION_IMAGE_BYTE_BUDGET = int(os.environ.get('VISION_IMAGE_BYTE_BUDGET', '300000'))
+# Part of the vision cache key, so changing the settings re-runs cached images
+IMAGE_PREPROCESSING_VERSION = f"{Image is not None and IMAGE_PREPROCESSING_ENABLED}:{VISION_IMAGE_FORMAT}:{VISION_IMAGE_QUALITY}:{VISION_IMAGE_MIN_QUALITY}:{VISION_IMAGE_BYTE_BUDGET}"
+
+if Image is None and IMAGE_PREPROCESSING_ENABLED:
+    print("WARNING: Pillow is not installed - image preprocessing is disabled and images are sent at their original size")
+
+def image_preprocessing_status():
     """
-    Get emails that have already had their results sent back to users
+    Whether images are resized and re-encoded before vision calls, for the handler response
     """
-    sent_records = {}
-    tracking_key = "sent_emails_tracking.json"
+    if not IMAGE_PREPROCESSING_ENABLED:
+        return {"enabled": False, "reason": "turned off by IMAGE_PREPROCESSING_ENABLED"}
+    if Image is None:
+        return {"enabled": False, "reason": "Pillow is not installed"}
+    return {"enabled": True, "format": VISION_IMAGE_FORMAT, "byte_budget": VISION_IMAGE_BYTE_BUDGET}
+
+def is_near_grayscale(image):
+    """
+    True when a thumbnail shows almost no colour, so dropping chroma loses nothing readable
+    """
+    thumbnail = image.copy()
+    thumbnail.thumbnail((64, 64))
+    stats = ImageStat.Stat(thumbnail.convert("YCbCr"))
+    return all(abs(stats.mean[band] - 128) < 6 and stats.stddev[band] < 8 for band in (1, 2))
+
+def encode_within_budget(image):
+    """
+    Re-encode at the highest quality that fits VISION_IMAGE_BYTE_BUDGET, shrinking the image
+    further when even the lowest quality is too big
+    """
+    for _ in range(4):
+        for quality in range(VISION_IMAGE_QUALITY, VISION_IMAGE_MIN_QUALITY - 1, -10):
+            buffer = io.BytesIO()
+            image.save(buffer, format=VISION_IMAGE_FORMAT, quality=quality, optimize=VISION_IMAGE_FORMAT == "JPEG")
+            if buffer.tell() <= VISION_IMAGE_BYTE_BUDGET:
+                return buffer.getvalue()
+        image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+    return buffer.getvalue()
+
+def preprocess_image(image_content, detail="high"):
+    """
+    Apply EXIF orientation, downscale to the vision model's working resolution for detail, drop colour when
+    the page is grey anyway and re-encode. Returns (image bytes, MIME type detected from the magic
+    bytes); the original is kept when Pillow is missing or re-encoding would not help.
+    Formats the API rejects (BMP, TIFF) are always converted, and raise ValueError when they can't be.
+    """
+    image_format = detect_image_format(image_content)
+    if Image is None or (not IMAGE_PREPROCESSING_ENABLED and image_format in VISION_MIME_TYPES):
+        return convert_image_without_pillow(image_content, image_format)
     
     try:
-        response = s3.get_object(Bucket=bucket, Key=tracking_key)
-        tracking_data = json.loads(response['Body'].read().decode('utf-8'))
-        sent_records = tracking_data.get('sent_records', {})
-        print(f"Found {len(sent_records)} emails that already had results sent")
-        
-    except s3.exceptions.NoSuchKey:
-        print("No sent emails tracking file found - this is the first run")
+        with Image.open(io.BytesIO(image_content)) as original:
+            rotated = original.getexif().get(0x0112, 1) not in (0, 1)
+            scale = vision_scale(*original.size, detail)
+            if scale < 1.0 and original.format == "JPEG":
+                # Let the JPEG decoder skip straight to a 1/2, 1/4 or 1/8 scale that is still large enough
+                original.draft(original.mode, (round(original.width * scale), round(original.height * scale)))
+            image = ImageOps.exif_transpose(original)
+            if image.mode in ("RGBA", "LA", "P"):
+                # Transparent areas become white paper instead of black
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            
+            scale = vision_scale(*image.size, detail)
+            if scale < 1.0:
+                image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+            if image.mode == "RGB" and is_near_grayscale(image):
+                image = image.convert("L")
+            
+            encoded = encode_within_budget(image)
     except Exception as e:
-        print(f"Error reading sent emails tracking file: {str(e)}")
+        print(f"Image preprocessing failed, sending the original: {str(e)}")
+        return convert_image_without_pillow(image_content, image_format)
     
-    return sent_records
+    if len(encoded) >= len(image_content) and image_format in VISION_MIME_TYPES and not rotated:
+        return image_content, VISION_MIME_TYPES[image_format]
+    return encoded, f"image/{VISION_IMAGE_FORMAT.lower()}"
 
-def create_email_signature(email_result):
+STREAM_OPTIONS_SUFFIX = b', "stream": true, "stream_options": {"include_usage": true}}'
+
+def encode_request_body(payload, stream=False):
     """
-    Create a unique signature for each email based on Message-ID and sender
-    This ensures each unique email is processed exactly once
+    Serialize a request body to bytes; bodies rendered from a RequestTemplate are already bytes
     """
-    sender = email_result.get('sender_email', 'unknown')
-    message_id = email_result.get('message_id', '')
-    subject = email_result.get('subject', 'no_subject')
-    date = email_result.get('date', '')
+    if not isinstance(payload, bytes):
+        payload = json.dumps(payload).encode('utf-8')
+    if stream:
+        # Every body is a JSON object, so the stream options go in just before its closing brace
+        payload = payload[:-1] + STREAM_OPTIONS_SUFFIX
+    return payload
+
+def post_openai_request(path, payload, api_key, estimated_tokens=0):
+    """
+    POST a JSON payload (dict or pre-encoded bytes) to the OpenAI API over the shared connection pool.
+    Waits on the shared rate limiter first; estimated_tokens is the expected input size.
+    Raises httpx.HTTPStatusError for non-2xx responses.
+    """
+    client = get_openai_http_client()
+    data = encode_request_body(payload)
     
-    # Use Message-ID as primary identifier (globally unique)
-    if message_id and message_id.strip():
-        signature = f"{sender}|{message_id}"
-    else:
-        # Fallback: create hash from sender + subject + date
-        content_to_hash = f"{sender}|{subject}|{date}"
-        content_hash = hashlib.md5(content_to_hash.encode()).hexdigest()[:10]
-        signature = f"{sender}|HASH_{content_hash}"
+    waited = openai_rate_limiter.acquire(estimated_tokens)
+    if waited > 0:
+        print(f"Rate limiter delayed OpenAI request by {waited:.2f} seconds")
     
-    return signature
+    started = time.monotonic()
+    response = client.post(
+        path,
+        content=data,
+        headers={
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+    )
+    print(f"OpenAI {path} responded {response.status_code} in {(time.monotonic() - started) * 1000:.0f} ms")
+    
+    response.raise_for_status()
+    result = response.json()
+    
+    usage = result.get('usage') or {}
+    openai_rate_limiter.record_usage(estimated_tokens, usage.get('total_tokens'))
+    openai_usage.record(usage)
+    
+    return result
 
-def mark_email_as_processed(bucket, email_key, email_result, processing_results):
+# Stream tool call arguments over SSE so callers can act on fields before the response finishes
+OPENAI_STREAMING = os.environ.get('OPENAI_STREAMING', 'false').lower() == 'true'
+
+def parse_partial_json(text):
     """
-    Mark email as processed with detailed tracking
+    Decode the complete key/value pairs of a partially streamed JSON object.
+    Uses the jiter partial parser when available, otherwise cuts the object at the
+    last top-level comma and closes it.
     """
-    try:
-        tracking_key = "processed_emails_tracking.json"
-        
-        # Get existing records
-        processed_records = get_processed_emails(bucket)
-        
-        # Create unique signature for this email
-        email_signature = create_email_signature(email_result)
-        
-        # Store detailed processing info
-        processed_records[email_signature] = {
-            "email_key": email_key,
-            "sender_email": email_result.get('sender_email'),
-            "subject": email_result.get('subject'),
-            "message_id": email_result.get('message_id'),
-            "processed_date": datetime.utcnow().isoformat(),
-            "attachment_count": len(email_result.get('attachments', [])),
-            "processing_results_count": len(processing_results),
-            "status": "processed"
-        }
+    if jiter is not None:
+        try:
+            value = jiter.from_json(text.encode('utf-8'), partial_mode=True)
+            return value if isinstance(value, dict) else {}
+        except ValueError:
+            return {}
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    last_comma = -1
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+        elif char == ',' and depth == 1:
+            last_comma = i
+    
+    candidates = [text, text + '}']
+    if last_comma > 0:
+        candidates.append(text[:last_comma] + '}')
+    
+    for candidate in candidates:
+        try:
+            value = json.loads(candidate)
+            return value if isinstance(value, dict) else {}
+        except ValueError:
+            continue
+    
+    return {}
+
+class StreamCancel(threading.Event):
+    """
+    Cancellation flag for a streaming request. Setting it also shuts down the socket of the
+    response attached to it, so a reader blocked waiting for the next SSE line returns at once
+    and the API stops generating for the request.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.response = None
+    
+    def attach(self, response):
+        """
+        Register the live response; returns False if the request was cancelled already
+        """
+        with self.lock:
+            self.response = response
+            return not self.is_set()
+    
+    def set(self):
+        with self.lock:
+            super().set()
+            response = self.response
+        if response is None:
+            return
         
-        # Update tracking file
-        tracking_data = {
-            "processed_records": processed_records,
-            "last_updated": datetime.utcnow().isoformat(),
-            "total_processed": len(processed_records)
+        network_stream = response.extensions.get("network_stream")
+        sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+        try:
+            if sock is not None:
+                # The reading thread closes the response itself once its read fails
+                sock.shutdown(socket.SHUT_RDWR)
+            else:
+                response.close()
+        except Exception as e:
+            print(f"Could not close cancelled OpenAI stream: {str(e)}")
+
+def stream_openai_request(path, payload, api_key, estimated_tokens=0, on_field=None, stop_when=None, cancel_event=None):
+    """
+    POST a streaming chat completion and assemble the message content or the forced tool call's
+    arguments from the SSE chunks. Each tool call field is handed to on_field(name, value) as soon
+    as it is complete, and reading stops as soon as stop_when(fields) is true or cancel_event is set.
+    A StreamCancel cancel_event also closes the stream while a read is blocked; a cancelled request
+    that never reported usage has its estimated tokens refunded to the rate limiter.
+    Returns a response shaped like a non-streaming completion.
+    """
+    client = get_openai_http_client()
+    data = encode_request_body(payload, stream=True)
+    
+    waited = openai_rate_limiter.acquire(estimated_tokens)
+    if waited > 0:
+        print(f"Rate limiter delayed OpenAI request by {waited:.2f} seconds")
+    
+    started = time.monotonic()
+    content = ""
+    arguments = ""
+    fields = {}
+    usage = {}
+    stopped_early = False
+    cancelled = cancel_event is not None and cancel_event.is_set()
+    
+    try:
+        if not cancelled:
+            content, arguments, fields, usage, stopped_early = read_openai_stream(
+                client, path, data, api_key, started, on_field, stop_when, cancel_event
+            )
+    except Exception:
+        # A cancelled loser fails its read when the winner closes its stream
+        if cancel_event is None or not cancel_event.is_set():
+            raise
+    
+    if cancel_event is not None and cancel_event.is_set():
+        cancelled = stopped_early = True
+    
+    print(f"OpenAI {path} stream {'cancelled' if cancelled else 'stopped early' if stopped_early else 'finished'} in {(time.monotonic() - started) * 1000:.0f} ms")
+    if cancelled and not usage:
+        openai_rate_limiter.record_usage(estimated_tokens, 0)
+    else:
+        openai_rate_limiter.record_usage(estimated_tokens, usage.get('total_tokens'))
+    openai_usage.record(usage)
+    
+    message = {"role": "assistant"}
+    if content:
+        message["content"] = content
+    if arguments:
+        message["tool_calls"] = [{
+            "type": "function",
+            "function": {"arguments": json.dumps(fields) if stopped_early else arguments}
+        }]
+    
+    return {"choices": [{"message": message}], "usage": usage}
+
+def read_openai_stream(client, path, data, api_key, started, on_field, stop_when, cancel_event):
+    """
+    Send the streaming request and read its SSE chunks for stream_openai_request.
+    Returns (content, arguments, fields, usage, stopped_early).
+    """
+    content = ""
+    arguments = ""
+    fields = {}
+    usage = {}
+    stopped_early = False
+    
+    with client.stream(
+        'POST',
+        path,
+        content=data,
+        headers={
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
         }
+    ) as response:
+        if response.status_code >= 400:
+            response.read()
+            response.raise_for_status()
         
-        s3.put_object(
-            Bucket=bucket,
-            Key=tracking_key,
-            Body=json.dumps(tracking_data, indent=2).encode('utf-8'),
-            ContentType='application/json'
-        )
+        if isinstance(cancel_event, StreamCancel) and not cancel_event.attach(response):
+            # Cancelled while waiting for the response headers
+            return content, arguments, fields, usage, True
         
-        print(f"Marked email as processed: {email_signature}")
-        return email_signature
+        for line in response.iter_lines():
+            if cancel_event is not None and cancel_event.is_set():
+                # Closing the stream makes the API stop generating for this request
+                stopped_early = True
+                break
+            if not line.startswith('data:'):
+                continue
+            chunk_data = line[5:].strip()
+            if chunk_data == '[DONE]':
+                break
+            
+            chunk = json.loads(chunk_data)
+            if chunk.get('usage'):
+                usage = chunk['usage']
+            
+            fragment = ""
+            for choice in chunk.get('choices') or []:
+                delta = choice.get('delta') or {}
+                content += delta.get('content') or ""
+                for tool_call in delta.get('tool_calls') or []:
+                    fragment += (tool_call.get('function') or {}).get('arguments') or ""
+            
+            # A field can only have completed if the fragment closed a string or the object
+            if not fragment:
+                continue
+            arguments += fragment
+            if '"' not in fragment and '}' not in fragment:
+                continue
+            
+            for name, value in parse_partial_json(arguments).items():
+                if name not in fields:
+                    fields[name] = value
+                    print(f"Streamed field {name} after {(time.monotonic() - started) * 1000:.0f} ms")
+                    if on_field:
+                        on_field(name, value)
+            
+            if stop_when and stop_when(fields):
+                stopped_early = True
+                break
+    
+    return content, arguments, fields, usage, stopped_early
+
+# Opt-in request hedging for slow OpenAI calls
+OPENAI_HEDGING = os.environ.get('OPENAI_HEDGING', 'false').lower() == 'true'
+OPENAI_HEDGE_PERCENTILE = float(os.environ.get('OPENAI_HEDGE_PERCENTILE', '0.95'))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.environ.get('OPENAI_HEDGE_MIN_SAMPLES', '20'))
+OPENAI_HEDGE_MIN_DELAY = float(os.environ.get('OPENAI_HEDGE_MIN_DELAY', '2'))
+OPENAI_HEDGE_MAX_RATIO = float(os.environ.get('OPENAI_HEDGE_MAX_RATIO', '0.1'))
+
+class RequestHedger:
+    """
+    Sends a duplicate request when a call has not answered within a latency percentile
+    learned from recent calls. The first response wins and the other attempt is cancelled:
+    its stream is closed at once and its unused token estimate goes back to the rate limiter.
+    Hedges are capped at a fraction of all requests and are skipped when the rate limiter
+    has no spare capacity, so they cannot double spend or queue behind real work under load.
+    """
+    
+    def __init__(self, percentile, min_samples, min_delay, max_ratio):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        # Latency history is kept across warm invocations
+        self.latencies = deque(maxlen=200)
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.executor = None
+        self.lock = threading.Lock()
+    
+    def start_run(self):
+        with self.lock:
+            self.requests = 0
+            self.hedges_fired = 0
+            self.hedges_won = 0
+    
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+    
+    def hedge_delay(self):
+        """
+        Seconds to wait before hedging, or None until enough latencies have been observed
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
         
-    except Exception as e:
-        print(f"Error marking email as processed {email_key}: {str(e)}")
+        return max(self.min_delay, ordered[int(self.percentile * (len(ordered) - 1))])
+    
+    def reserve_hedge(self, estimated_tokens):
+        if not openai_rate_limiter.has_capacity(estimated_tokens):
+            return False
+        with self.lock:
+            if self.hedges_fired + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedges_fired += 1
+            return True
+    
+    def _submit(self, send, path, payload, api_key, estimated_tokens, cancel_event):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=OPENAI_MAX_CONNECTIONS * 2)
+        return self.executor.submit(send, path, payload, api_key, estimated_tokens, cancel_event=cancel_event)
+    
+    def send(self, send, path, payload, api_key, estimated_tokens=0):
+        """
+        Call send(path, payload, api_key, estimated_tokens, cancel_event=...) with hedging.
+        Raises the last error if every attempt failed.
+        """
+        with self.lock:
+            self.requests += 1
+        
+        started = time.monotonic()
+        delay = self.hedge_delay()
+        
+        attempts = {}
+        primary_cancel = StreamCancel()
+        attempts[self._submit(send, path, payload, api_key, estimated_tokens, primary_cancel)] = (primary_cancel, False)
+        
+        if delay is not None:
+            done, _ = wait(attempts, timeout=delay)
+            if not done and self.reserve_hedge(estimated_tokens):
+                print(f"No response from OpenAI after {delay:.1f} seconds - sending hedged request")
+                hedge_cancel = StreamCancel()
+                attempts[self._submit(send, path, payload, api_key, estimated_tokens, hedge_cancel)] = (hedge_cancel, True)
+        
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                
+                for loser in pending:
+                    attempts[loser][0].set()
+                
+                with self.lock:
+                    if attempts[future][1]:
+                        self.hedges_won += 1
+                self.record_latency(time.monotonic() - started)
+                return result
+        
+        raise error
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+                "latency_samples": len(self.latencies)
+            }
+
+openai_hedger = RequestHedger(OPENAI_HEDGE_PERCENTILE, OPENAI_HEDGE_MIN_SAMPLES, OPENAI_HEDGE_MIN_DELAY, OPENAI_HEDGE_MAX_RATIO)
+
+# Circuit breaker so an OpenAI outage fails fast instead of burning every retry
+OPENAI_BREAKER_THRESHOLD = int(os.environ.get('OPENAI_BREAKER_THRESHOLD', '5'))
+OPENAI_BREAKER_COOLDOWN = float(os.environ.get('OPENAI_BREAKER_COOLDOWN', '60'))
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling OpenAI while the circuit breaker is open
+    """
+
+class OpenAIOutageError(CircuitOpenError):
+    """
+    Raised when every attempt at a request failed like an outage (timeouts, network errors,
+    408/409, 5xx) before the breaker opened. Handled like an open breaker: the email is deferred
+    instead of being answered with API_ERROR rows.
+    """
+
+class CircuitBreaker:
+    """
+    Opens after a run of consecutive outage failures (timeouts, network errors, 5xx) and
+    rejects requests until the cool-down has passed. Then a single probe request is let
+    through while other callers wait for its outcome: success closes the breaker,
+    failure opens it for another cool-down.
+    """
+    
+    def __init__(self, failure_threshold, cooldown_seconds, probe_timeout):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.probe_timeout = probe_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected_requests = 0
+        self.lock = threading.Condition()
+    
+    def _reject_if_cooling_down(self):
+        if self.state == "open" and time.monotonic() - self.opened_at < self.cooldown_seconds:
+            self.rejected_requests += 1
+            raise CircuitOpenError(f"OpenAI circuit breaker is open after {self.consecutive_failures} consecutive failures")
+    
+    def raise_if_open(self):
+        with self.lock:
+            self._reject_if_cooling_down()
+    
+    def before_request(self):
+        """
+        Raise CircuitOpenError unless a request may be sent now
+        """
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.state != "half_open", timeout=self.probe_timeout):
+                self.rejected_requests += 1
+                raise CircuitOpenError("OpenAI circuit breaker probe request did not finish")
+            
+            self._reject_if_cooling_down()
+            if self.state == "open":
+                print("OpenAI circuit breaker cool-down over - sending a probe request")
+                self.state = "half_open"
+    
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                print("OpenAI circuit breaker closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.lock.notify_all()
+    
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.failure_threshold <= 0:
+                return
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+                print(f"OpenAI circuit breaker opened after {self.consecutive_failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                self.lock.notify_all()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "rejected_requests": self.rejected_requests
+            }
+
+# Shared across warm invocations so an outage seen by one run is respected by the next
+openai_breaker = CircuitBreaker(OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN, OPENAI_CONNECT_TIMEOUT + OPENAI_READ_TIMEOUT)
+
+# Retry policy for OpenAI requests
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '4'))
+OPENAI_INITIAL_RETRY_DELAY = float(os.environ.get('OPENAI_INITIAL_RETRY_DELAY', '0.5'))
+OPENAI_MAX_RETRY_DELAY = float(os.environ.get('OPENAI_MAX_RETRY_DELAY', '8'))
+OPENAI_MAX_RETRY_AFTER = float(os.environ.get('OPENAI_MAX_RETRY_AFTER', '60'))
+
+def parse_reset_duration(value):
+    """
+    Parse x-ratelimit-reset-* durations such as "20ms", "1s", "6m0s" or "1h2m3.5s" into seconds
+    """
+    if not value:
+        return None
+    
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value.strip())
+    if not parts:
         return None
+    
+    multipliers = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    return sum(float(number) * multipliers[unit] for number, unit in parts)
 
-def mark_email_as_sent(bucket, email_signature, sender_email, subject, results_count):
+def parse_retry_after_headers(headers):
     """
-    Mark email as having had its results sent back to the user
+    Work out how long the API asked us to wait, in seconds, or None if it did not say.
+    Checks retry-after-ms, retry-after (seconds or HTTP date), then the reset time of
+    whichever x-ratelimit bucket is exhausted.
     """
+    if headers is None:
+        return None
+    
     try:
-        tracking_key = "sent_emails_tracking.json"
+        return float(headers.get('retry-after-ms')) / 1000
+    except (TypeError, ValueError):
+        pass
+    
+    retry_after = headers.get('retry-after')
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        pass
+    
+    if retry_after:
+        retry_date = email.utils.parsedate_tz(retry_after)
+        if retry_date is not None:
+            return float(email.utils.mktime_tz(retry_date) - time.time())
+    
+    resets = []
+    for bucket in ('requests', 'tokens'):
+        if headers.get(f'x-ratelimit-remaining-{bucket}') == '0':
+            reset = parse_reset_duration(headers.get(f'x-ratelimit-reset-{bucket}'))
+            if reset is not None:
+                resets.append(reset)
+    
+    return max(resets) if resets else None
+
+def is_retryable_response(response):
+    """
+    Decide whether a failed HTTP response can succeed on a later attempt.
+    Rate limits, timeouts, lock conflicts and server errors are retried;
+    bad requests, auth failures and exhausted quota are permanent.
+    """
+    should_retry = response.headers.get('x-should-retry')
+    if should_retry == 'true':
+        return True
+    if should_retry == 'false':
+        return False
+    
+    if response.status_code == 429:
+        try:
+            error_code = response.json().get('error', {}).get('code')
+        except Exception:
+            error_code = None
+        # Billing quota errors share the 429 status but never clear by waiting
+        return error_code != 'insufficient_quota'
+    
+    return response.status_code in (408, 409) or response.status_code >= 500
+
+def calculate_retry_wait(attempt, headers=None):
+    """
+    Seconds to wait before the next attempt: exactly what the API asked for when it said,
+    otherwise capped exponential backoff with jitter
+    """
+    retry_after = parse_retry_after_headers(headers)
+    if retry_after is not None and 0 <= retry_after <= OPENAI_MAX_RETRY_AFTER:
+        return retry_after
+    
+    import random
+    backoff = min(OPENAI_INITIAL_RETRY_DELAY * (2 ** attempt), OPENAI_MAX_RETRY_DELAY)
+    return backoff * (1 - 0.25 * random.random())
+
+def request_chat_completion(payload, api_key, estimated_tokens, max_retries=OPENAI_MAX_RETRIES, api_name="OpenAI API", send=post_openai_request):
+    """
+    Send a chat completion request, retrying only errors that can succeed on a later attempt.
+    Returns the parsed response, or None once the request failed permanently or retries ran out.
+    Raises CircuitOpenError while the circuit breaker is open, and OpenAIOutageError when the
+    last attempt also failed like an outage.
+    """
+    outage = None
+    for attempt in range(max_retries):
+        response_headers = None
+        outage = None
+        openai_breaker.before_request()
         
-        # Get existing records
-        sent_records = get_sent_emails(bucket)
+        try:
+            result = send('/chat/completions', payload, api_key, estimated_tokens)
+            openai_breaker.record_success()
+            return result
         
-        # Store detailed sending info
-        sent_records[email_signature] = {
-            "sender_email": sender_email,
-            "subject": subject,
-            "sent_date": datetime.utcnow().isoformat(),
-            "results_count": results_count,
-            "status": "sent"
-        }
+        except httpx.HTTPStatusError as e:
+            print(f"{api_name} HTTP error: {e.response.status_code} - {e.response.text}")
+            if e.response.status_code in (408, 409) or e.response.status_code >= 500:
+                openai_breaker.record_failure()
+                outage = f"HTTP {e.response.status_code}"
+            else:
+                # The API is up; this request was only rejected or throttled
+                openai_breaker.record_success()
+            if not is_retryable_response(e.response):
+                return None
+            response_headers = e.response.headers
         
-        # Update tracking file
-        tracking_data = {
-            "sent_records": sent_records,
-            "last_updated": datetime.utcnow().isoformat(),
-            "total_sent": len(sent_records)
-        }
+        except httpx.TransportError as e:
+            # Timeouts, connection resets and other network failures are worth another attempt
+            print(f"Error calling {api_name} (attempt {attempt + 1}): {type(e).__name__} {str(e)}")
+            openai_breaker.record_failure()
+            outage = type(e).__name__
         
-        s3.put_object(
-            Bucket=bucket,
-            Key=tracking_key,
-            Body=json.dumps(tracking_data, indent=2).encode('utf-8'),
-            ContentType='application/json'
-        )
+        except Exception as e:
+            print(f"Error calling {api_name} (attempt {attempt + 1}): {str(e)}")
+            # A problem with this request or its response, not an outage
+            openai_breaker.record_success()
+            return None
         
-        print(f"Marked email results as sent: {email_signature}")
-        return True
+        if attempt < max_retries - 1:
+            # No point waiting for a retry the breaker will reject
+            openai_breaker.raise_if_open()
+            wait_time = calculate_retry_wait(attempt, response_headers)
+            if parse_retry_after_headers(response_headers) is not None:
+                # Hold back the other workers too instead of letting them hit the same limit
+                openai_rate_limiter.pause(wait_time)
+            print(f"Waiting {wait_time:.2f} seconds before {api_name} retry {attempt + 1}")
+            time.sleep(wait_time)
+    
+    if outage:
+        raise OpenAIOutageError(f"{api_name} failed {max_retries} attempts, the last with {outage}")
+    return None
+
+def build_tool_payload(prompt, function_definition, max_tokens=4096):
+    """
+    Build the chat completion request body that forces a single tool call
+    """
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {"role": "system", "content": "You are an invoice analysis assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        "tools": [{"type": "function", "function": function_definition}],
+        "tool_choice": {"type": "function", "function": {"name": function_definition["name"]}},
+        "max_tokens": max_tokens,
+        "temperature": 0
+    }
+
+def image_data_url(image_content, mime_type):
+    return f"data:{mime_type};base64,{base64.b64encode(image_content).decode('utf-8')}"
+
+def build_vision_tool_payload(prompt, image_urls, function_definition, detail="auto"):
+    """
+    Build a chat completion request body that sends images (data URLs, in page order)
+    at the given detail level and forces a single tool call
+    """
+    payload = build_tool_payload(prompt, function_definition)
+    payload["messages"][1]["content"] = [
+        {
+            "type": "text",
+            "text": prompt
+        }
+    ] + [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": image_url,
+                "detail": detail
+            }
+        }
+        for image_url in image_urls
+    ]
+    return payload
+
+# Placeholder for the per-call value in a RequestTemplate
+TEMPLATE_SLOT = "\u0000TEMPLATE_SLOT\u0000"
+
+class RequestTemplate:
+    """
+    A request body serialized to bytes once, with a single slot for the per-call value.
+    Keep the slot after all static instructions so every request shares the same prefix
+    and OpenAI's automatic prompt caching can reuse it.
+    """
+    
+    def __init__(self, payload):
+        encoded = json.dumps(payload).encode('utf-8')
+        self.prefix, self.suffix = encoded.split(json.dumps(TEMPLATE_SLOT)[1:-1].encode('utf-8'))
+        self.static_tokens = estimate_text_tokens((self.prefix + self.suffix).decode('utf-8'))
         
+        # model opens the body and max_tokens comes after the slot, so both can be
+        # swapped per call without re-serializing
+        match = re.match(rb'\{"model": "[^"]*"', self.prefix)
+        self.model_rest = self.prefix[match.end():] if match else None
+        match = re.search(rb'"max_tokens": \d+', self.suffix)
+        self.max_tokens_split = (self.suffix[:match.start()], self.suffix[match.end():]) if match else None
+    
+    def render(self, value, escape=True, max_tokens=None, model=None):
+        """
+        Splice value into the template; escape=False is only safe for JSON-safe values like base64
+        """
+        encoded = json.dumps(value)[1:-1] if escape else value
+        prefix = self.prefix
+        if model is not None and self.model_rest is not None:
+            prefix = b'{"model": ' + json.dumps(model).encode('utf-8') + self.model_rest
+        suffix = self.suffix
+        if max_tokens is not None and self.max_tokens_split:
+            suffix = self.max_tokens_split[0] + b'"max_tokens": %d' % max_tokens + self.max_tokens_split[1]
+        return prefix + encoded.encode('utf-8') + suffix
+
+def parse_tool_call_arguments(result):
+    """
+    Return the decoded arguments of the first tool call in a chat completion, or {} if there are none
+    """
+    try:
+        if result.get('choices') and result['choices'][0]['message'].get('tool_calls'):
+            function_args = json.loads(result['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
+            return function_args
+        else:
+            print("No tool calls in response")
+            return {}
     except Exception as e:
-        print(f"Error marking email as sent {email_signature}: {str(e)}")
-        return False
+        print(f"Error parsing OpenAI API response: {str(e)}")
+        return {}
+
+def call_openai_template(template, text, api_key, max_retries=OPENAI_MAX_RETRIES, on_field=None, stop_when=None, max_tokens=None, model=None, usage=None):
+    """
+    Tool call whose body is a prebuilt RequestTemplate with text spliced into its slot
+    """
+    body = template.render(text, max_tokens=max_tokens, model=model)
+    estimated_tokens = template.static_tokens + estimate_text_tokens(text)
+    
+    return call_openai_tool(body, estimated_tokens, api_key, max_retries, on_field, stop_when, usage)
+
+def call_openai_tool(payload, estimated_tokens, api_key, max_retries=OPENAI_MAX_RETRIES, on_field=None, stop_when=None, usage=None):
+    """
+    Send a forced tool call request body and return the decoded arguments, or {} on failure.
+    The response's token usage is copied into the usage dict when one is given.
+    """
+    send = post_openai_request
+    if OPENAI_HEDGING:
+        # Hedged attempts stream so the losing attempt can be cancelled; fields are reported once
+        reported = set()
+        def report_field_once(name, value):
+            if on_field and name not in reported:
+                reported.add(name)
+                on_field(name, value)
+        send = functools.partial(openai_hedger.send, functools.partial(stream_openai_request, on_field=report_field_once, stop_when=stop_when))
+    elif OPENAI_STREAMING:
+        send = functools.partial(stream_openai_request, on_field=on_field, stop_when=stop_when)
+    
+    result = request_chat_completion(payload, api_key, estimated_tokens, max_retries, "OpenAI API", send)
+    if not result:
+        return {}
+    
+    if usage is not None:
+        usage.update(result.get('usage') or {})
+    return parse_tool_call_arguments(result)
+
+def build_vision_payload(prompt, detail="auto"):
+    """
+    Build a chat completion request body for free-text answers about an image at the given detail level.
+    The image data URL goes in the template slot.
+    """
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": TEMPLATE_SLOT,
+                            "detail": detail
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 4096,
+        "temperature": 0
+    }
+
+def call_openai_vision_api(template, image_content, api_key, max_retries=OPENAI_MAX_RETRIES, model=None, usage=None, mime_type="image/jpeg", detail="high"):
+    """
+    Call OpenAI Vision API for image processing using a template built by build_vision_payload
+    """
+    # Base64 never needs JSON escaping, so the encoded image is spliced in as-is
+    payload = template.render(image_data_url(image_content, mime_type), escape=False, model=model)
+    
+    estimated_tokens = template.static_tokens + estimate_image_tokens(image_content, detail)
+    
+    send = post_openai_request
+    if OPENAI_HEDGING:
+        send = functools.partial(openai_hedger.send, stream_openai_request)
+    
+    result = request_chat_completion(payload, api_key, estimated_tokens, max_retries, "OpenAI Vision API", send)
+    if not result:
+        return ""
+    
+    if usage is not None:
+        usage.update(result.get('usage') or {})
+    if result.get('choices') and result['choices'][0]['message'].get('content'):
+        return result['choices'][0]['message']['content']
+    else:
+        print("No content in vision response")
+        return ""
+
+# Model tiers per stage, cheapest first. A request only moves to the next model when the
+# cheaper one's answer fails the stage's checks; a single model disables tiering for that stage.
+OPENAI_SMALL_MODEL = os.environ.get('OPENAI_SMALL_MODEL', 'gpt-4o-mini')
+
+def parse_model_tiers(value):
+    return [model.strip() for model in value.split(',') if model.strip()] or [OPENAI_MODEL]
+
+CLASSIFICATION_MODELS = parse_model_tiers(os.environ.get('CLASSIFICATION_MODELS', f'{OPENAI_SMALL_MODEL},{OPENAI_MODEL}'))
+EXTRACTION_MODELS = parse_model_tiers(os.environ.get('EXTRACTION_MODELS', f'{OPENAI_SMALL_MODEL},{OPENAI_MODEL}'))
+VISION_MODELS = parse_model_tiers(os.environ.get('VISION_MODELS', OPENAI_MODEL))
+# Longer documents skip the cheaper tiers and go straight to the last model
+SMALL_MODEL_MAX_INPUT_TOKENS = int(os.environ.get('SMALL_MODEL_MAX_INPUT_TOKENS', '3000'))
+# USD per million input and output tokens, used for the per-tier cost estimate
+MODEL_PRICES = json.loads(os.environ.get('MODEL_PRICES', '{"gpt-4o": [2.5, 10.0], "gpt-4o-mini": [0.15, 0.6]}'))
+
+class ModelTierStats:
+    """
+    Calls, escalations, latency and estimated cost per stage and model for the current run
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run()
+    
+    def start_run(self):
+        with self.lock:
+            self.tiers = {}
+    
+    def record(self, stage, model, seconds, usage, escalated):
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (usage.get('prompt_tokens', 0) * input_price + usage.get('completion_tokens', 0) * output_price) / 1000000
+        
+        with self.lock:
+            tier = self.tiers.setdefault(f"{stage}:{model}", {
+                "calls": 0,
+                "escalations": 0,
+                "total_seconds": 0.0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cost_usd": 0.0
+            })
+            tier["calls"] += 1
+            tier["escalations"] += 1 if escalated else 0
+            tier["total_seconds"] += seconds
+            tier["prompt_tokens"] += usage.get('prompt_tokens', 0)
+            tier["completion_tokens"] += usage.get('completion_tokens', 0)
+            tier["cost_usd"] += cost
+    
+    def stats(self):
+        with self.lock:
+            return {
+                name: {
+                    "calls": tier["calls"],
+                    "escalation_rate": round(tier["escalations"] / tier["calls"], 3),
+                    "avg_latency_ms": round(tier["total_seconds"] * 1000 / tier["calls"]),
+                    "prompt_tokens": tier["prompt_tokens"],
+                    "completion_tokens": tier["completion_tokens"],
+                    "cost_usd": round(tier["cost_usd"], 6)
+                }
+                for name, tier in self.tiers.items()
+            }
+
+model_tier_stats = ModelTierStats()
+
+def select_model_tiers(models, text):
+    """
+    Models to try for this input: all tiers for short input, only the last one for long input
+    """
+    if len(models) > 1 and estimate_text_tokens(text) > SMALL_MODEL_MAX_INPUT_TOKENS:
+        return models[-1:]
+    return models
+
+def run_model_tiers(stage, models, call, escalation_reason):
+    """
+    Try models in order. call(model, usage) returns the answer and fills usage;
+    escalation_reason(answer) returns why the next model should be tried, or None to accept.
+    Returns the first accepted answer, or the last model's answer.
+    """
+    answer = None
+    for i, model in enumerate(models):
+        usage = {}
+        started = time.monotonic()
+        answer = call(model, usage)
+        reason = escalation_reason(answer) if i < len(models) - 1 else None
+        model_tier_stats.record(stage, model, time.monotonic() - started, usage, reason is not None)
+        
+        if reason is None:
+            return answer
+        print(f"Escalating {stage} from {model} to {models[i + 1]}: {reason}")
+    
+    return answer
+
+# Vision detail levels to try per image, cheapest first. "low" costs a flat 85 tokens per image
+# on a 512px copy; an answer that is incomplete or hard to read is retried at the next level.
+VISION_DETAIL_LADDER = [detail for detail in (level.strip().lower() for level in os.environ.get('VISION_DETAIL_LADDER', 'low,high').split(',')) if detail in ("low", "high", "auto")] or ["high"]
+
+class VisionDetailStats:
+    """
+    Detail level escalations and estimated prompt tokens saved against sending everything at high detail
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run()
+    
+    def start_run(self):
+        with self.lock:
+            self.requests = 0
+            self.escalations = 0
+            self.answered = {detail: 0 for detail in VISION_DETAIL_LADDER}
+            self.spent_tokens = 0
+            self.high_detail_tokens = 0
+    
+    def record(self, detail, escalations, spent_tokens, high_detail_tokens):
+        with self.lock:
+            self.requests += 1
+            self.escalations += escalations
+            self.answered[detail] += 1
+            self.spent_tokens += spent_tokens
+            self.high_detail_tokens += high_detail_tokens
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "ladder": VISION_DETAIL_LADDER,
+                "requests": self.requests,
+                "escalations": self.escalations,
+                "escalation_rate": round(self.escalations / self.requests, 3) if self.requests else 0.0,
+                "answered_at": dict(self.answered),
+                "estimated_prompt_tokens": self.spent_tokens,
+                "estimated_prompt_tokens_saved": self.high_detail_tokens - self.spent_tokens
+            }
+
+vision_detail_stats = VisionDetailStats()
+
+def run_detail_ladder(stage, pages, static_tokens, call, escalation_reason):
+    """
+    Try VISION_DETAIL_LADDER in order for the given image pages. call(detail) returns the answer;
+    escalation_reason(answer) returns why the next level should be tried, or None to accept.
+    """
+    answer = None
+    spent_tokens = 0
+    for i, detail in enumerate(VISION_DETAIL_LADDER):
+        answer = call(detail)
+        spent_tokens += static_tokens + sum(estimate_image_tokens(page, detail) for page in pages)
+        reason = escalation_reason(answer) if i < len(VISION_DETAIL_LADDER) - 1 else None
+        if reason is None:
+            break
+        print(f"Escalating {stage} from {detail} to {VISION_DETAIL_LADDER[i + 1]} detail: {reason}")
+    
+    vision_detail_stats.record(detail, i, spent_tokens, static_tokens + sum(estimate_image_tokens(page) for page in pages))
+    return answer
+
+def clean_amount(amount_str):
+    """
+    Clean up amount strings to contain only numbers and decimal point
+    """
+    if not amount_str or amount_str in ['API_ERROR', 'ERROR', 'NO_TEXT', 'NOT_INVOICE', 'ZIP_ERROR']:
+        return amount_str
+    
+    # Remove all non-digit and non-decimal characters except for common currency symbols at the start
+    # Keep negative signs and commas for thousands
+    cleaned = re.sub(r'[^\d.,\-]', '', str(amount_str))
+    
+    # Handle comma as thousands separator (e.g., 1,234.56)
+    if ',' in cleaned and '.' in cleaned:
+        # If both comma and dot, treat comma as thousands separator
+        cleaned = cleaned.replace(',', '')
+    elif ',' in cleaned and cleaned.count(',') == 1 and len(cleaned.split(',')[1]) <= 2:
+        # If comma might be decimal separator (European format)
+        cleaned = cleaned.replace(',', '.')
+    elif ',' in cleaned:
+        # Remove commas (thousands separators)
+        cleaned = cleaned.replace(',', '')
+    
+    return cleaned
+
+def extract_currency(amount_str):
+    """
+    Extract currency from amount string
+    """
+    if not amount_str or amount_str in ['API_ERROR', 'ERROR', 'NO_TEXT', 'NOT_INVOICE', 'ZIP_ERROR']:
+        return 'UNKNOWN'
+    
+    # Common currency symbols and codes
+    currency_patterns = {
+        r'\$': 'USD',
+        r'USD': 'USD',
+        r'₹': 'INR',
+        r'INR': 'INR',
+        r'€': 'EUR',
+        r'EUR': 'EUR',
+        r'£': 'GBP',
+        r'GBP': 'GBP',
+        r'¥': 'JPY',
+        r'JPY': 'JPY',
+        r'₽': 'RUB',
+        r'RUB': 'RUB'
+    }
+    
+    amount_upper = str(amount_str).upper()
+    
+    for pattern, currency in currency_patterns.items():
+        if re.search(pattern, amount_upper):
+            return currency
+    
+    return 'UNKNOWN'
+
+def get_processed_emails(bucket):
+    """
+    Get processed emails using Message-ID based tracking
+    """
+    processed_records = {}
+    tracking_key = "processed_emails_tracking.json"
+    
+    try:
+        response = s3.get_object(Bucket=bucket, Key=tracking_key)
+        tracking_data = json.loads(response['Body'].read().decode('utf-8'))
+        processed_records = tracking_data.get('processed_records', {})
+        print(f"Found {len(processed_records)} previously processed email records")
+        
+    except s3.exceptions.NoSuchKey:
+        print("No tracking file found - this is the first run")
+    except Exception as e:
+        print(f"Error reading tracking file: {str(e)}")
+    
+    return processed_records
+
+def get_sent_emails(bucket):
+    """
+    Get emails that have already had their results sent back to users
+    """
+    sent_records = {}
+    tracking_key = "sent_emails_tracking.json"
+    
+    try:
+        response = s3.get_object(Bucket=bucket, Key=tracking_key)
+        tracking_data = json.loads(response['Body'].read().decode('utf-8'))
+        sent_records = tracking_data.get('sent_records', {})
+        print(f"Found {len(sent_records)} emails that already had results sent")
+        
+    except s3.exceptions.NoSuchKey:
+        print("No sent emails tracking file found - this is the first run")
+    except Exception as e:
+        print(f"Error reading sent emails tracking file: {str(e)}")
+    
+    return sent_records
+
+def create_email_signature(email_result):
+    """
+    Create a unique signature for each email based on Message-ID and sender
+    This ensures each unique email is processed exactly once
+    """
+    sender = email_result.get('sender_email', 'unknown')
+    message_id = email_result.get('message_id', '')
+    subject = email_result.get('subject', 'no_subject')
+    date = email_result.get('date', '')
+    
+    # Use Message-ID as primary identifier (globally unique)
+    if message_id and message_id.strip():
+        signature = f"{sender}|{message_id}"
+    else:
+        # Fallback: create hash from sender + subject + date
+        content_to_hash = f"{sender}|{subject}|{date}"
+        content_hash = hashlib.md5(content_to_hash.encode()).hexdigest()[:10]
+        signature = f"{sender}|HASH_{content_hash}"
+    
+    return signature
+
+def mark_email_as_processed(bucket, email_key, email_result, processing_results):
+    """
+    Mark email as processed with detailed tracking
+    """
+    try:
+        tracking_key = "processed_emails_tracking.json"
+        
+        # Get existing records
+        processed_records = get_processed_emails(bucket)
+        
+        # Create unique signature for this email
+        email_signature = create_email_signature(email_result)
+        
+        # Store detailed processing info
+        processed_records[email_signature] = {
+            "email_key": email_key,
+            "sender_email": email_result.get('sender_email'),
+            "subject": email_result.get('subject'),
+            "message_id": email_result.get('message_id'),
+            "processed_date": datetime.utcnow().isoformat(),
+            "attachment_count": len(email_result.get('attachments', [])),
+            "processing_results_count": len(processing_results),
+            "status": "processed"
+        }
+        
+        # Update tracking file
+        tracking_data = {
+            "processed_records": processed_records,
+            "last_updated": datetime.utcnow().isoformat(),
+            "total_processed": len(processed_records)
+        }
+        
+        s3.put_object(
+            Bucket=bucket,
+            Key=tracking_key,
+            Body=json.dumps(tracking_data, indent=2).encode('utf-8'),
+            ContentType='application/json'
+        )
+        
+        print(f"Marked email as processed: {email_signature}")
+        return email_signature
+        
+    except Exception as e:
+        print(f"Error marking email as processed {email_key}: {str(e)}")
+        return None
+
+def mark_email_as_sent(bucket, email_signature, sender_email, subject, results_count):
+    """
+    Mark email as having had its results sent back to the user
+    """
+    try:
+        tracking_key = "sent_emails_tracking.json"
+        
+        # Get existing records
+        sent_records = get_sent_emails(bucket)
+        
+        # Store detailed sending info
+        sent_records[email_signature] = {
+            "sender_email": sender_email,
+            "subject": subject,
+            "sent_date": datetime.utcnow().isoformat(),
+            "results_count": results_count,
+            "status": "sent"
+        }
+        
+        # Update tracking file
+        tracking_data = {
+            "sent_records": sent_records,
+            "last_updated": datetime.utcnow().isoformat(),
+            "total_sent": len(sent_records)
+        }
+        
+        s3.put_object(
+            Bucket=bucket,
+            Key=tracking_key,
+            Body=json.dumps(tracking_data, indent=2).encode('utf-8'),
+            ContentType='application/json'
+        )
+        
+        print(f"Marked email results as sent: {email_signature}")
+        return True
+        
+    except Exception as e:
+        print(f"Error marking email as sent {email_signature}: {str(e)}")
+        return False
+
+def is_email_already_processed(email_result, processed_records):
+    """
+    Check if this specific email was already processed based on Message-ID
+    """
+    email_signature = create_email_signature(email_result)
+    
+    if email_signature in processed_records:
+        record = processed_records[email_signature]
+        print(f"Email already processed on {record.get('processed_date')}")
+        print(f"Original sender: {record.get('sender_email')}")
+        print(f"Original subject: {record.get('subject')}")
+        return True
+    
+    return False
+
+def is_email_already_sent(email_result, sent_records):
+    """
+    Check if this email's results have already been sent back to the user
+    """
+    email_signature = create_email_signature(email_result)
+    
+    if email_signature in sent_records:
+        record = sent_records[email_signature]
+        print(f"Email results already sent on {record.get('sent_date')}")
+        print(f"Sender: {record.get('sender_email')}")
+        print(f"Results count: {record.get('results_count')}")
+        return True
+    
+    return False
+
+def get_deferred_emails(bucket):
+    """
+    Get emails deferred by an OpenAI outage, keyed by email signature
+    """
+    deferred_emails = {}
+    tracking_key = "deferred_emails_tracking.json"
+    
+    try:
+        response = s3.get_object(Bucket=bucket, Key=tracking_key)
+        tracking_data = json.loads(response['Body'].read().decode('utf-8'))
+        deferred_emails = tracking_data.get('deferred_emails', {})
+        print(f"Found {len(deferred_emails)} deferred emails")
+        
+    except s3.exceptions.NoSuchKey:
+        print("No deferred emails tracking file found")
+    except Exception as e:
+        print(f"Error reading deferred emails tracking file: {str(e)}")
+    
+    return deferred_emails
+
+def save_deferred_emails(bucket, deferred_emails):
+    """
+    Persist the deferred emails so a later invocation retries them first
+    """
+    try:
+        tracking_data = {
+            "deferred_emails": deferred_emails,
+            "last_updated": datetime.utcnow().isoformat(),
+            "total_deferred": len(deferred_emails)
+        }
+        
+        s3.put_object(
+            Bucket=bucket,
+            Key="deferred_emails_tracking.json",
+            Body=json.dumps(tracking_data, indent=2).encode('utf-8'),
+            ContentType='application/json'
+        )
+        return True
+        
+    except Exception as e:
+        print(f"Error saving deferred emails tracking file: {str(e)}")
+        return False
+
+def defer_email(deferred_emails, email_key, email_result, email_signature, reason):
+    """
+    Add or update an email in the deferred queue
+    """
+    previous = deferred_emails.get(email_signature, {})
+    deferred_emails[email_signature] = {
+        "email_key": email_key,
+        "sender_email": email_result["sender_email"],
+        "subject": email_result["subject"],
+        "first_deferred": previous.get("first_deferred", datetime.utcnow().isoformat()),
+        "last_deferred": datetime.utcnow().isoformat(),
+        "attempts": previous.get("attempts", 0) + 1,
+        "reason": reason
+    }
+
+# Local pre-screen for images in emails: logos, signatures, social icons, tracking pixels and
+# blank spacers are dropped before they reach the vision API
+IMAGE_SCREEN_ENABLED = os.environ.get('IMAGE_SCREEN_ENABLED', 'true').lower() == 'true'
+MIN_IMAGE_BYTES = int(os.environ.get('MIN_IMAGE_BYTES', '1024'))
+MIN_IMAGE_SIDE = int(os.environ.get('MIN_IMAGE_SIDE', '100'))
+# Images shown by the HTML body are signatures and logos unless both sides are at least this
+# big, which keeps pasted screenshots and photos that some mail clients send the same way
+MIN_EMBEDDED_IMAGE_SIDE = int(os.environ.get('MIN_EMBEDDED_IMAGE_SIDE', '500'))
+# Grey levels between the darkest and lightest pixel of a thumbnail below which an image is blank
+BLANK_IMAGE_MAX_RANGE = int(os.environ.get('BLANK_IMAGE_MAX_RANGE', '24'))
+
+CONTENT_ID_REFERENCE_PATTERN = re.compile(r'cid:([^"\'\s>)]+)', re.IGNORECASE)
+
+class ImageScreenStats:
+    """
+    Email images checked by the pre-screen and why the skipped ones were dropped, for the current run
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run()
+    
+    def start_run(self):
+        with self.lock:
+            self.screened = 0
+            self.reasons = {}
+            self.unchecked = 0
+    
+    def record(self, reason):
+        with self.lock:
+            self.screened += 1
+            if reason:
+                self.reasons[reason] = self.reasons.get(reason, 0) + 1
+    
+    def record_unchecked(self):
+        with self.lock:
+            self.unchecked += 1
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "screened": self.screened,
+                "skipped": sum(self.reasons.values()),
+                "reasons": dict(self.reasons),
+                "blank_check": "all formats" if Image is not None else "PNG and BMP only (Pillow is not installed)",
+                "blank_check_skipped": self.unchecked
+            }
+
+image_screen_stats = ImageScreenStats()
+
+def referenced_content_ids(msg):
+    """
+    Content-IDs the HTML bodies of an email display inline (cid: URLs), lowercased
+    """
+    content_ids = set()
+    for part in msg.walk():
+        if part.get_content_type() != 'text/html':
+            continue
+        payload = part.get_payload(decode=True) or b''
+        html = payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+        content_ids.update(urllib.parse.unquote(content_id).lower() for content_id in CONTENT_ID_REFERENCE_PATTERN.findall(html))
+    return content_ids
+
+# Channels per pixel of each PNG colour type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def unfilter_png_row(filter_type, row, previous, bpp):
+    """
+    Undo the PNG filter of one scanline given the previous, already unfiltered one
+    """
+    if filter_type == 0:
+        return row
+    if filter_type == 2:
+        # Bytewise addition without carries between bytes, done on the whole row at once
+        low = int.from_bytes(b'\x7f' * len(row), 'big')
+        a, b = int.from_bytes(row, 'big'), int.from_bytes(previous, 'big')
+        return (((a & low) + (b & low)) ^ ((a ^ b) & ~low)).to_bytes(len(row), 'big')
+    
+    output = bytearray(row)
+    for i in range(len(output)):
+        left = output[i - bpp] if i >= bpp else 0
+        if filter_type == 1:
+            output[i] = (output[i] + left) & 0xFF
+        elif filter_type == 3:
+            output[i] = (output[i] + (left + previous[i]) // 2) & 0xFF
+        else:
+            up_left = previous[i - bpp] if i >= bpp else 0
+            estimate = left + previous[i] - up_left
+            distances = (abs(estimate - left), abs(estimate - previous[i]), abs(estimate - up_left))
+            output[i] = (output[i] + (left, previous[i], up_left)[distances.index(min(distances))]) & 0xFF
+    return bytes(output)
+
+def png_is_blank(image_content):
+    """
+    True when no colour channel of a non-interlaced PNG varies by more than BLANK_IMAGE_MAX_RANGE,
+    which also bounds the grey range; None for PNGs this can't read (16-bit, interlaced)
+    """
+    chunks = {}
+    position = 8
+    while position + 8 <= len(image_content):
+        length = int.from_bytes(image_content[position:position + 4], 'big')
+        chunk_type = image_content[position + 4:position + 8]
+        chunks[chunk_type] = chunks.get(chunk_type, b'') + image_content[position + 8:position + 8 + length]
+        position += 12 + length
+    
+    header = chunks[b'IHDR']
+    width, height = int.from_bytes(header[0:4], 'big'), int.from_bytes(header[4:8], 'big')
+    depth, color_type, interlaced = header[8], header[9], header[12]
+    if interlaced or color_type not in PNG_CHANNELS or depth != 8 and color_type != 3 or depth > 8:
+        return None
+    
+    channels = PNG_CHANNELS[color_type]
+    bpp = max(1, channels * depth // 8)
+    stride = (channels * depth * width + 7) // 8
+    pixels = zlib.decompress(chunks[b'IDAT'])
+    # Alpha is ignored, as it is when Pillow converts to greyscale
+    color_channels = range(1 if channels <= 2 else 3)
+    
+    low, high = [255] * 3, [0] * 3
+    used_indices = set()
+    previous = bytes(stride)
+    for start in range(0, min(len(pixels), (stride + 1) * height), stride + 1):
+        row = unfilter_png_row(pixels[start], pixels[start + 1:start + 1 + stride], previous, bpp)
+        previous = row
+        if color_type == 3:
+            used_indices.update(row)
+            continue
+        for channel in color_channels:
+            values = row[channel::channels]
+            low[channel], high[channel] = min(low[channel], min(values)), max(high[channel], max(values))
+            if high[channel] - low[channel] > BLANK_IMAGE_MAX_RANGE:
+                return False
+    
+    if color_type == 3:
+        # Packed indices are unpacked from the distinct bytes seen, not per pixel
+        if depth < 8:
+            used_indices = {(value >> shift) & ((1 << depth) - 1) for value in used_indices for shift in range(0, 8, depth)}
+        palette = chunks.get(b'PLTE', b'')
+        colors = [palette[3 * index:3 * index + 3] for index in used_indices if 3 * index + 3 <= len(palette)]
+        return all(max(color[channel] for color in colors) - min(color[channel] for color in colors) <= BLANK_IMAGE_MAX_RANGE for channel in range(3))
+    return True
+
+def is_blank_image(image_content):
+    """
+    True when a greyscale thumbnail is a near-uniform colour; False when the image can't be decoded.
+    Without Pillow only PNG and BMP are checked, from their pixel data.
+    """
+    if Image is None:
+        image_format = detect_image_format(image_content)
+        try:
+            if image_format in ("png", "bmp"):
+                blank = png_is_blank(image_content if image_format == "png" else bmp_to_png(image_content))
+                if blank is not None:
+                    return blank
+        except Exception as e:
+            print(f"Blank check failed: {str(e)}")
+        image_screen_stats.record_unchecked()
+        return False
+    try:
+        with Image.open(io.BytesIO(image_content)) as image:
+            image.draft("L", (256, 256))
+            thumbnail = image.convert("L")
+            thumbnail.thumbnail((256, 256))
+            darkest, lightest = thumbnail.getextrema()
+            return lightest - darkest <= BLANK_IMAGE_MAX_RANGE
+    except Exception:
+        return False
+
+def image_screen_reason(part, image_content, content_ids):
+    """
+    Why an email image part is not an invoice candidate, or None to process it.
+    Cheap header checks run first; only images that pass them are decoded.
+    """
+    if not IMAGE_SCREEN_ENABLED:
+        return None
+    
+    if len(image_content) < MIN_IMAGE_BYTES:
+        return "too small"
+    
+    dimensions = get_image_dimensions(image_content)
+    if dimensions and min(dimensions) < MIN_IMAGE_SIDE:
+        return "tiny dimensions"
+    
+    content_id = str(part.get('Content-ID', '')).strip().strip('<>').lower()
+    if content_id and content_id in content_ids and not (dimensions and min(dimensions) >= MIN_EMBEDDED_IMAGE_SIDE):
+        return "shown in the email body"
+    
+    if is_blank_image(image_content):
+        return "blank"
+    return None
+
+def screen_email_image(part, image_content, filename, content_ids):
+    """
+    True when an email image should be processed; skipped images are logged and counted
+    """
+    reason = image_screen_reason(part, image_content, content_ids)
+    image_screen_stats.record(reason)
+    if reason:
+        print(f"Skipping image {filename} ({len(image_content)} bytes): {reason}")
+    return reason is None
+
+def extract_attachments_from_email(bucket, email_key):
+    """
+    Extract attachments from a raw email message stored by SES in S3
+    Now supports images in addition to PDFs and ZIPs
+    """
+    try:
+        # Download raw email from S3
+        response = s3.get_object(Bucket=bucket, Key=email_key)
+        raw_email_content = response['Body'].read()
+        
+        # Parse the raw email message
+        msg = email.message_from_bytes(raw_email_content)
+        
+        # Extract sender information - handle different email formats
+        sender_email = msg.get('From', '')
+        # Clean up sender email - extract just the email address if in format "Name <email@domain.com>"
+        if '<' in sender_email and '>' in sender_email:
+            sender_email = sender_email.split('<')[1].split('>')[0].strip()
+        
+        subject = msg.get('Subject', '')
+        message_id = msg.get('Message-ID', '')
+        date = msg.get('Date', '')
+        
+        print(f"Processing raw email from: {sender_email}")
+        print(f"Subject: {subject}")
+        print(f"Date: {date}")
+        print(f"Message-ID: {message_id}")
+        
+        attachments = []
+        content_ids = referenced_content_ids(msg)
+        
+        # Walk through all parts of the multipart email
+        for part in msg.walk():
+            # Get content disposition
+            content_disposition = str(part.get("Content-Disposition", ""))
+            content_type = part.get_content_type()
+            
+            print(f"Processing part: Content-Type: {content_type}, Content-Disposition: {content_disposition}")
+            
+            # Check if this part is an attachment
+            if "attachment" in content_disposition.lower():
+                filename = part.get_filename()
+                if filename:
+                    # Decode the attachment content
+                    content = part.get_payload(decode=True)
+                    
+                    if content:
+                        # Process PDF, ZIP, and image files
+                        if filename.lower().endswith(IMAGE_EXTENSIONS) and not screen_email_image(part, content, filename, content_ids):
+                            continue
+                        if filename.lower().endswith(('.pdf', '.zip') + IMAGE_EXTENSIONS):
+                            attachments.append((content, filename, content_type))
+                            print(f"Found attachment: {filename} ({len(content)} bytes, type: {content_type})")
+                        else:
+                            print(f"Skipping attachment: {filename} (unsupported file type)")
+                    else:
+                        print(f"Warning: Could not decode attachment {filename}")
+                else:
+                    print(f"Warning: Attachment found but no filename available")
+            
+            # Also check for inline files that might be attachments without explicit Content-Disposition
+            elif content_type in ['application/pdf', 'application/zip'] or content_type.startswith('image/'):
+                filename = part.get_filename()
+                if not filename:
+                    # Try to get filename from Content-Type parameters
+                    if hasattr(part, 'get_param'):
+                        filename = part.get_param('name')
+                    
+                    # Generate filename if still not found
+                    if not filename:
+                        if content_type == 'application/pdf':
+                            extension = '.pdf'
+                        elif content_type == 'application/zip':
+                            extension = '.zip'
+                        elif content_type.startswith('image/'):
+                            extension = '.jpg'  # Default image extension
+                        else:
+                            extension = '.unknown'
+                        filename = f"attachment_{len(attachments)+1}{extension}"
+                
+                content = part.get_payload(decode=True)
+                if content and filename and content_type.startswith('image/') and not screen_email_image(part, content, filename, content_ids):
+                    continue
+                if content and filename:
+                    attachments.append((content, filename, content_type))
+                    print(f"Found inline attachment: {filename} ({len(content)} bytes, type: {content_type})")
+        
+        if not attachments:
+            print("No PDF, ZIP, or image attachments found in email")
+            # Debug: Print all parts found
+            print("All email parts found:")
+            for i, part in enumerate(msg.walk()):
+                print(f"  Part {i}: {part.get_content_type()}, disposition: {part.get('Content-Disposition', 'None')}")
+        
+        return {
+            "success": True,
+            "sender_email": sender_email,
+            "subject": subject,
+            "message_id": message_id,
+            "date": date,
+            "attachments": attachments
+        }
+        
+    except Exception as e:
+        print(f"Error extracting attachments from {email_key}: {str(e)}")
+        import traceback
+        print(f"Full traceback: {traceback.format_exc()}")
+        return {
+            "success": False,
+            "error": str(e),
+            "sender_email": "",
+            "subject": "",
+            "message_id": "",
+            "date": "",
+            "attachments": []
+        }
+
+# Content-addressed cache of pipeline stage outputs
+STAGE_CACHE_ENABLED = os.environ.get('STAGE_CACHE_ENABLED', 'true').lower() == 'true'
+STAGE_CACHE_PREFIX = os.environ.get('STAGE_CACHE_PREFIX', 'stage_cache/')
+STAGE_CACHE_LOCAL_DIR = os.environ.get('STAGE_CACHE_LOCAL_DIR', '/tmp/stage_cache')
+
+# Bump when prompt wording or tool schemas change so cached LLM outputs are not reused
+PROMPT_VERSION = "3"
+SCHEMA_VERSION = "1"
+
+class StageCache:
+    """
+    Persistent cache of stage outputs keyed by SHA-256 of the stage input plus the
+    model, prompt and schema versions that produced them.
+    Entries live in S3 with an optional read-through copy under /tmp for warm containers.
+    """
+    
+    def __init__(self, prefix, local_dir, enabled):
+        self.prefix = prefix
+        self.local_dir = local_dir
+        self.enabled = enabled
+        self.bucket = None
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+    
+    def start_run(self, bucket):
+        """
+        Point the cache at this invocation's bucket and reset the per-run counters
+        """
+        with self.lock:
+            self.bucket = bucket
+            self.hits = {}
+            self.misses = {}
+    
+    def make_key(self, content, *versions):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        content_hash = hashlib.sha256(content).hexdigest()
+        version_hash = hashlib.sha256('|'.join(versions).encode('utf-8')).hexdigest()[:16]
+        return f"{content_hash}-{version_hash}"
+    
+    def _count(self, counters, stage):
+        with self.lock:
+            counters[stage] = counters.get(stage, 0) + 1
+    
+    def _local_path(self, stage, key):
+        return os.path.join(self.local_dir, stage, f"{key}.json")
+    
+    def _write_local(self, stage, key, data):
+        if not self.local_dir:
+            return
+        try:
+            path = self._local_path(stage, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        except Exception as e:
+            print(f"Error writing local cache entry {stage}/{key}: {str(e)}")
+    
+    def get(self, stage, key):
+        """
+        Return the cached value for this stage and key, or None on a miss
+        """
+        if not self.enabled:
+            return None
+        
+        if self.local_dir:
+            try:
+                with open(self._local_path(stage, key), 'rb') as f:
+                    value = json.loads(f.read().decode('utf-8'))
+                self._count(self.hits, stage)
+                return value
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error reading local cache entry {stage}/{key}: {str(e)}")
+        
+        if self.bucket:
+            try:
+                response = s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{stage}/{key}.json")
+                data = response['Body'].read()
+                value = json.loads(data.decode('utf-8'))
+                self._write_local(stage, key, data)
+                self._count(self.hits, stage)
+                return value
+            except s3.exceptions.NoSuchKey:
+                pass
+            except Exception as e:
+                print(f"Error reading cache entry {stage}/{key}: {str(e)}")
+        
+        self._count(self.misses, stage)
+        return None
+    
+    def put(self, stage, key, value):
+        """
+        Store a stage output in S3 and the local layer
+        """
+        if not self.enabled:
+            return
+        
+        data = json.dumps(value).encode('utf-8')
+        self._write_local(stage, key, data)
+        
+        if self.bucket:
+            try:
+                s3.put_object(
+                    Bucket=self.bucket,
+                    Key=f"{self.prefix}{stage}/{key}.json",
+                    Body=data,
+                    ContentType='application/json'
+                )
+            except Exception as e:
+                print(f"Error writing cache entry {stage}/{key}: {str(e)}")
+    
+    def stats(self):
+        with self.lock:
+            stages = sorted(set(self.hits) | set(self.misses))
+            return {stage: {"hits": self.hits.get(stage, 0), "misses": self.misses.get(stage, 0)} for stage in stages}
+
+stage_cache = StageCache(STAGE_CACHE_PREFIX, STAGE_CACHE_LOCAL_DIR, STAGE_CACHE_ENABLED)
+
+def extract_page_lines(page):
+    """
+    Extract a page's text together with its lines and their vertical position
+    (0 = top of the page, 1 = bottom), collected from PyPDF2's text visitor callbacks
+    """
+    fragments = []
+    
+    def visit_text(text, cm, tm, font_dict, font_size):
+        if text:
+            fragments.append((tm[4] * cm[1] + tm[5] * cm[3] + cm[5], text))
+    
+    page_text = page.extract_text(visitor_text=visit_text)
+    
+    # Fragments on the same baseline form one line, e.g. a label and its value in another column
+    lines = []
+    for y, text in fragments:
+        for i, part in enumerate(text.split("\n")):
+            if lines and i == 0 and abs(lines[-1][0] - y) <= 1.0:
+                lines[-1][1] += part
+            else:
+                lines.append([y, part])
+    
+    height = float(page.mediabox.height) or 1.0
+    return page_text, [
+        [round(min(1.0, max(0.0, 1 - y / height)), 3), line.strip()]
+        for y, line in lines if line.strip()
+    ]
+
+def extract_text_from_pdf(pdf_content):
+    """Extract raw text from PDF content, plus positioned lines per page for the token budget planner"""
+    cache_key = stage_cache.make_key(pdf_content, PYPDF2_VERSION)
+    cached = stage_cache.get("pdf_text", cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        reader = PdfReader(io.BytesIO(pdf_content))
+        page_texts = []
+        pages = []
+        # One extraction pass per page: the text and its positioned lines come from the same call
+        for page in reader.pages:
+            page_text, lines = extract_page_lines(page)
+            if page_text:
+                page_texts.append(page_text)
+            pages.append(lines)
+        full_text = "\n".join(page_texts)
+        
+        try:
+            producer = str(reader.metadata.producer or "") if reader.metadata else ""
+        except Exception:
+            producer = ""
+        
+        result = {
+            "success": True,
+            "text": full_text,
+            "page_count": len(reader.pages),
+            "pages": pages,
+            "producer": producer
+        }
+        stage_cache.put("pdf_text", cache_key, result)
+        return result
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "text": "",
+            "page_count": 0
+        }
+
+# Vision prompt for invoice/receipt analysis
+VISION_TEXT_PROMPT = """
+    Analyze this image and extract any text content, especially if it appears to be an invoice, receipt, or bill.
+    
+    Please extract all readable text from the image, maintaining the structure and layout as much as possible.
+    Include:
+    - All text content (handwritten or printed)
+    - Numbers, amounts, dates
+    - Company names, addresses
+    - Item descriptions
+    - Any other readable information
+    
+    If this appears to be a financial document (invoice, receipt, bill), note that specifically.
+    If any part of the text is too small or blurry to read reliably, write [ILLEGIBLE] in its place.
+    
+    Return the extracted text content:
+"""
+
+VISION_TEXT_TEMPLATES = {detail: RequestTemplate(build_vision_payload(VISION_TEXT_PROMPT, detail)) for detail in VISION_DETAIL_LADDER}
+
+def transcript_escalation_reason(text):
+    """
+    Why a transcript should be retried at a higher detail level or on a larger model, or None to accept it
+    """
+    if len(text.strip()) < 20:
+        return "empty transcript"
+    if "[ILLEGIBLE]" in text:
+        return "illegible text"
+    if TOTAL_LINE_PATTERN.search(text) and not AMOUNT_LINE_PATTERN.search(text):
+        return "total without a readable amount"
+    return None
+
+def transcribe_image(image_content, filename, api_key):
+    """
+    Vision transcript of a single image or page, converted and shrunk by preprocess_image first
+    and escalated through VISION_DETAIL_LADDER
+    """
+    def transcribe_at(detail):
+        vision_image, mime_type = preprocess_image(image_content, detail)
+        if vision_image is not image_content:
+            print(f"Preprocessed image {filename} for {detail} detail: {len(image_content)} -> {len(vision_image)} bytes ({mime_type})")
+        
+        return run_model_tiers(
+            "vision_text",
+            VISION_MODELS,
+            lambda model, usage: call_openai_vision_api(VISION_TEXT_TEMPLATES[detail], vision_image, api_key, model=model, usage=usage, mime_type=mime_type, detail=detail),
+            transcript_escalation_reason
+        )
+    
+    template = VISION_TEXT_TEMPLATES[VISION_DETAIL_LADDER[0]]
+    return run_detail_ladder("vision_text", [image_content], template.static_tokens, transcribe_at, transcript_escalation_reason)
+
+def process_image_with_vision(image_content, filename, api_key):
+    """
+    Process image using OpenAI Vision API to extract text
+    """
+    cache_key = stage_cache.make_key(image_content, ",".join(VISION_MODELS), PROMPT_VERSION, IMAGE_PREPROCESSING_VERSION, ",".join(VISION_DETAIL_LADDER))
+    cached = stage_cache.get("vision_text", cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        pages = split_image_pages(image_content)
+        if len(pages) > 1:
+            print(f"Split {filename} into {len(pages)} pages")
+        
+        # Pages are transcribed concurrently and their text joined in page order
+        page_texts = run_in_parallel(lambda page: transcribe_image(page, filename, api_key), pages)
+        extracted_text = "\n\n".join(text for text in page_texts if text)
+        
+        if extracted_text:
+            result = {
+                "success": True,
+                "text": extracted_text,
+                "source": "vision_api"
+            }
+            stage_cache.put("vision_text", cache_key, result)
+            return result
+        else:
+            return {
+                "success": False,
+                "error": "No text extracted from image",
+                "text": "",
+                "source": "vision_api"
+            }
+    
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Error processing image {filename} with Vision API: {str(e)}")
+        return {
+            "success": False,
+            "error": str(e),
+            "text": "",
+            "source": "vision_api"
+        }
+
+# Scanned PDFs without a text layer are read from their embedded page images with the vision API
+SCANNED_PDF_FALLBACK_ENABLED = os.environ.get('SCANNED_PDF_FALLBACK_ENABLED', 'true').lower() == 'true'
+SCANNED_PDF_MAX_PAGES = int(os.environ.get('SCANNED_PDF_MAX_PAGES', '10'))
+# Share of a page its images must cover for the page to count as a full-page scan
+SCANNED_PAGE_MIN_COVERAGE = float(os.environ.get('SCANNED_PAGE_MIN_COVERAGE', '0.8'))
+
+INVERTED_BYTES = bytes(range(255, -1, -1))
+PDF_COLOR_COMPONENTS = {"/DeviceGray": 1, "/CalGray": 1, "/DeviceRGB": 3, "/CalRGB": 3}
+
+def pdf_image_filters(xobject):
+    filters = xobject.get("/Filter", [])
+    filters = filters.get_object() if hasattr(filters, "get_object") else filters
+    return [filters] if isinstance(filters, str) else list(filters)
+
+def is_image_mask(xobject):
+    # PyPDF2's BooleanObject is always truthy, so compare its value
+    return getattr(xobject.get("/ImageMask"), "value", False) is True
+
+def pdf_raw_image_layout(xobject):
+    """
+    (PNG colour type, bit depth, PLTE chunk data) for an image XObject stored as raw pixels,
+    or None when its colour space has no direct PNG equivalent
+    """
+    if is_image_mask(xobject):
+        return 0, 1, None
+    bits = int(xobject.get("/BitsPerComponent", 8))
+    if bits not in (1, 2, 4, 8):
+        return None
+    
+    color_space = xobject.get("/ColorSpace", "/DeviceGray")
+    color_space = color_space.get_object() if hasattr(color_space, "get_object") else color_space
+    if isinstance(color_space, str):
+        components = PDF_COLOR_COMPONENTS.get(color_space)
+        return (0 if components == 1 else 2, bits, None) if components else None
+    
+    family = color_space[0]
+    if family == "/ICCBased":
+        components = int(color_space[1].get_object().get("/N", 0))
+        return (0 if components == 1 else 2, bits, None) if components in (1, 3) else None
+    if family == "/Indexed":
+        base = color_space[1].get_object() if hasattr(color_space[1], "get_object") else color_space[1]
+        lookup = color_space[3].get_object()
+        lookup = lookup.get_data() if hasattr(lookup, "get_data") else bytes(lookup)
+        if PDF_COLOR_COMPONENTS.get(base) == 1:
+            lookup = b"".join(lookup[i:i + 1] * 3 for i in range(len(lookup)))
+        elif PDF_COLOR_COMPONENTS.get(base) != 3:
+            return None
+        return 3, bits, lookup[:3 * (int(color_space[2]) + 1)]
+    return None
+
+def read_pdf_page_image(xobject):
+    """
+    One image XObject as ("pixels", layout, width, height, pixel data) for raw pixel data, or
+    ("encoded", image bytes) for JPEG, CCITT fax (as TIFF) and JPEG 2000 data. None when it can't be read.
+    """
+    filters = pdf_image_filters(xobject)
+    if "/JBIG2Decode" in filters:
+        # Neither PyPDF2 nor Pillow can decode JBIG2
+        return None
+    try:
+        data = xobject.get_data()
+    except Exception as e:
+        print(f"Could not decode PDF image ({', '.join(filters)}): {str(e)}")
+        return None
+    
+    if filters and filters[-1] in ("/DCTDecode", "/CCITTFaxDecode", "/JPXDecode"):
+        return "encoded", data
+    
+    layout = pdf_raw_image_layout(xobject)
+    if layout is None:
+        return None
+    width, height = int(xobject["/Width"]), int(xobject["/Height"])
+    if list(xobject.get("/Decode", [])) == [1, 0]:
+        # Inverted samples; image masks paint where the sample is 0, which already reads as black in a PNG
+        data = data.translate(INVERTED_BYTES)
+    return "pixels", layout, width, height, data
+
+def pixels_to_png(layout, width, rows):
+    """
+    Encode raw pixel rows (already in PNG sample order) as a PNG without Pillow
+    """
+    color_type, bits, palette = layout
+    height = len(rows)
+    header = png_chunk(b'IHDR', width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([bits, color_type, 0, 0, 0]))
+    palette_chunk = png_chunk(b'PLTE', palette) if palette else b''
+    return b'\x89PNG\r\n\x1a\n' + header + palette_chunk + png_chunk(b'IDAT', zlib.compress(b''.join(b'\x00' + row for row in rows), 6)) + png_chunk(b'IEND', b'')
+
+def stack_images_vertically(images):
+    """
+    Paste equally wide encoded images below each other into one PNG with Pillow, or None
+    """
+    if Image is None or len(images) < 2:
+        return None
+    try:
+        decoded = [Image.open(io.BytesIO(image)) for image in images]
+        if len({image.width for image in decoded}) != 1:
+            return None
+        mode = "RGB" if any(image.mode not in ("1", "L") for image in decoded) else "L"
+        page = Image.new(mode, (decoded[0].width, sum(image.height for image in decoded)), "white")
+        top = 0
+        for image in decoded:
+            page.paste(image.convert(mode), (0, top))
+            top += image.height
+        buffer = io.BytesIO()
+        # Fast lossless encoding; preprocess_image re-encodes the page for the vision API anyway
+        page.save(buffer, format="PNG", compress_level=1)
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"Could not reassemble scan strips: {str(e)}")
+        return None
+
+def page_image_resources(page):
+    """
+    Image XObjects in a page's resources, by resource name
+    """
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    if not xobjects:
+        return {}
+    xobjects = xobjects.get_object()
+    return {name: xobject.get_object() for name, xobject in xobjects.items() if xobject.get_object().get("/Subtype") == "/Image"}
+
+def page_image_xobjects(page):
+    """
+    Image XObjects drawn by a page, top of the page first. Scanners often split a page into
+    horizontal strips; their order comes from the y offset of the cm before each Do.
+    """
+    images = page_image_resources(page)
+    if not images:
+        return []
+    
+    try:
+        placed = []
+        offset = 0.0
+        for operands, operator in ContentStream(page.get_contents(), page.pdf).operations:
+            if operator == b"cm" and len(operands) == 6:
+                offset = float(operands[5])
+            elif operator == b"Do" and operands and operands[0] in images:
+                placed.append((-offset, len(placed), operands[0]))
+        order = [name for _, _, name in sorted(placed)]
+    except Exception as e:
+        print(f"Could not read the page content stream, using resource order: {str(e)}")
+        order = list(images)
+    
+    return [images[name] for name in order]
+
+def page_image_coverage(page):
+    """
+    Share of the page area covered by the images it draws, from the cm placing each image
+    (0 when the content stream cannot be read)
+    """
+    try:
+        box = page.mediabox
+        page_area = abs(float(box.width) * float(box.height))
+        if not page_area:
+            return 0.0
+        
+        images = page_image_resources(page)
+        if not images:
+            return 0.0
+        
+        covered = 0.0
+        matrix = None
+        for operands, operator in ContentStream(page.get_contents(), page.pdf).operations:
+            if operator == b"cm" and len(operands) == 6:
+                matrix = [float(operand) for operand in operands[:4]]
+            elif operator == b"Do" and operands and operands[0] in images and matrix:
+                # Images are drawn into the unit square, so the cm determinant is their area
+                covered += abs(matrix[0] * matrix[3] - matrix[1] * matrix[2])
+        
+        return min(1.0, covered / page_area)
+    except Exception as e:
+        print(f"Could not measure the page images: {str(e)}")
+        return 0.0
+
+def extract_scanned_page_images(page):
+    """
+    Encoded images that make up a scanned page, top first. Raw pixel strips are stacked into one
+    PNG directly; JPEG and fax strips are stacked with Pillow when it is available. Without it JPEG
+    strips are passed on as they are and fax and JPEG 2000 strips, which it would have to decode, are skipped.
+    """
+    parts = []
+    for xobject in page_image_xobjects(page):
+        if max(int(xobject.get("/Width", 0)), int(xobject.get("/Height", 0))) < MIN_IMAGE_SIDE:
+            continue
+        image = read_pdf_page_image(xobject)
+        if image is None:
+            print(f"Skipping unsupported scan image ({', '.join(pdf_image_filters(xobject)) or 'raw'})")
+            continue
+        
+        if image[0] == "pixels":
+            _, layout, width, height, data = image
+            row_bytes = (width * (3 if layout[0] == 2 else 1) * layout[1] + 7) // 8
+            rows = [data[i * row_bytes:(i + 1) * row_bytes] for i in range(height)]
+            if parts and parts[-1][0] == "pixels" and tuple(parts[-1][1:3]) == (layout, width):
+                parts[-1][3].extend(rows)
+            else:
+                parts.append(["pixels", layout, width, rows])
+        elif Image is None and detect_image_format(image[1]) not in VISION_MIME_TYPES:
+            print(f"Skipping scan image that needs Pillow ({', '.join(pdf_image_filters(xobject))})")
+        else:
+            parts.append(["encoded", image[1]])
+    
+    images = [pixels_to_png(part[1], part[2], part[3]) if part[0] == "pixels" else part[1] for part in parts]
+    if Image is None:
+        return images
+    stacked = stack_images_vertically(images)
+    return [stacked] if stacked else images
+
+def has_total_line(text):
+    """
+    True when some line names a total and carries an amount
+    """
+    return any(TOTAL_LINE_PATTERN.search(line) and AMOUNT_LINE_PATTERN.search(line) for line in text.splitlines())
+
+def transcribe_scanned_page(page_images, filename, api_key):
+    """
+    Vision transcript of one scanned page; strips that could not be stacked are read concurrently
+    and joined top to bottom
+    """
+    try:
+        return "\n".join(text for text in run_in_parallel(lambda image: transcribe_image(image, filename, api_key), page_images) if text)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Error reading scanned page of {filename}: {str(e)}")
+        return ""
+
+def read_scanned_pdf_pages(pdf_content):
+    """
+    Page images of the first SCANNED_PDF_MAX_PAGES pages, for a batch request that reads them in one
+    vision call, and whether every one of those pages is a full-page scan
+    """
+    reader = PdfReader(io.BytesIO(pdf_content))
+    pages = reader.pages[:SCANNED_PDF_MAX_PAGES]
+    images = [image for page in pages for image in extract_scanned_page_images(page)]
+    full_page_images = bool(pages) and min(page_image_coverage(page) for page in pages) >= SCANNED_PAGE_MIN_COVERAGE
+    return images, full_page_images
+
+def extract_text_from_scanned_pdf(pdf_content, filename, api_key):
+    """
+    Text of a PDF without a text layer, read from its page images with the vision API.
+    Pages go in waves of PIPELINE_CONCURRENCY and the rest are skipped once a total has been read.
+    full_page_images tells whether every page read was a full-page scan rather than e.g. a logo.
+    """
+    cache_key = stage_cache.make_key(pdf_content, ",".join(VISION_MODELS), PROMPT_VERSION, IMAGE_PREPROCESSING_VERSION, ",".join(VISION_DETAIL_LADDER), str(SCANNED_PDF_MAX_PAGES))
+    cached = stage_cache.get("pdf_vision_text", cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        reader = PdfReader(io.BytesIO(pdf_content))
+        pages = reader.pages[:SCANNED_PDF_MAX_PAGES]
+        if len(reader.pages) > SCANNED_PDF_MAX_PAGES:
+            print(f"Scanned PDF {filename} has {len(reader.pages)} pages, only the first {SCANNED_PDF_MAX_PAGES} are read")
+        
+        page_texts = []
+        coverage = []
+        for start in range(0, len(pages), PIPELINE_CONCURRENCY):
+            # The reader is not thread-safe, so images are pulled out here and only the vision calls run in parallel
+            wave = [extract_scanned_page_images(page) for page in pages[start:start + PIPELINE_CONCURRENCY]]
+            coverage += [page_image_coverage(page) for page in pages[start:start + PIPELINE_CONCURRENCY]]
+            page_texts += run_in_parallel(lambda page_images: transcribe_scanned_page(page_images, filename, api_key), wave)
+            
+            remaining = len(pages) - len(page_texts)
+            if remaining and has_total_line("\n".join(page_texts)):
+                print(f"Found the totals in {filename} after {len(page_texts)} pages, skipping the other {remaining}")
+                break
+        
+        result = {
+            "success": True,
+            "text": "\n\n".join(text for text in page_texts if text),
+            "pages_read": len(page_texts),
+            "full_page_images": bool(coverage) and min(coverage) >= SCANNED_PAGE_MIN_COVERAGE,
+            "source": "pdf_page_images"
+        }
+        if result["text"]:
+            stage_cache.put("pdf_vision_text", cache_key, result)
+        return result
+    
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Error reading scanned PDF {filename} with Vision API: {str(e)}")
+        return {
+            "success": False,
+            "error": str(e),
+            "text": "",
+            "source": "pdf_page_images"
+        }
+
+# Text layers scoring below this are treated as broken (missing ToUnicode maps, Type3 fonts,
+# bad OCR layers) and the PDF is read from its page images instead
+TEXT_QUALITY_MIN_SCORE = float(os.environ.get('TEXT_QUALITY_MIN_SCORE', '0.55'))
+# Only the start of the text is scored; broken fonts show up on the first pages already
+TEXT_QUALITY_SAMPLE_CHARS = 8000
+
+# Replacement characters, private use area glyphs and control characters
+BROKEN_GLYPH_PATTERN = re.compile('[\ufffd\ue000-\uf8ff\x00-\x08\x0b\x0e-\x1f\x7f]')
+WORD_TOKEN_PATTERN = re.compile(r"[^\W\d_]{2,}")
+WORD_SHAPE_PATTERN = re.compile(r"[A-Z]?[a-zß-ÿ]+|[A-ZÀ-Þ]+")
+VOWEL_PATTERN = re.compile(r'[aeiouyAEIOUYÀ-ÆÈ-ÏÒ-ÖÙ-Üà-æè-ïò-öù-ü]')
+CONSONANT_RUN_PATTERN = re.compile(r'[b-df-hj-np-tv-xzB-DF-HJ-NP-TV-XZ]{5,}')
+NUMBER_TOKEN_PATTERN = re.compile(r'(?=[^\s]*\d)[\d.,:/$€£₹%()+-]+(?!\S)')
+WELL_FORMED_NUMBER_PATTERN = re.compile(
+    r'\(?[$€£₹]?[+-]?(?:\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:[.,]\d+)?)%?\)?[.,:]?'
+    r'|\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}|\d{1,2}:\d{2}(?::\d{2})?|\d+(?:[/-]\d+)+'
+)
+# Short words that make up a good share of any real invoice, in the languages we receive
+COMMON_WORDS = frozenset("""
+a an and are as at be by for from in is it of on or the to with this that your you we our not no all
+invoice bill statement receipt total amount due balance date number account customer payment paid pay
+tax vat gst subtotal sub price qty quantity description item items service services unit rate charges charge
+fee fees period billing order purchase po ref reference terms net days address phone email name page
+credit debit cash card bank transfer currency usd eur gbp inr discount shipping delivery ship sold remit
+der die das und mit von für rechnung datum betrag summe gesamt mwst steuer
+le la les de des et du pour facture montant tva prix
+el los las del y por para factura fecha importe iva precio
+""".split())
+
+def score_text_quality(text):
+    """
+    0-1 score of how readable an extracted text layer is, from the printable glyph ratio, how many
+    tokens look like (known) words and how many numbers are well formed. Real invoices score
+    above 0.9; text from broken font encodings scores below 0.5.
+    """
+    text = text[:TEXT_QUALITY_SAMPLE_CHARS]
+    visible = len(text) - sum(map(text.count, " \n\t\r"))
+    if visible <= 0:
+        return 0.0
+    printable = 1 - len(BROKEN_GLYPH_PATTERN.findall(text)) / visible
+    
+    words = WORD_TOKEN_PATTERN.findall(text)
+    lexical = 0.0
+    if words:
+        shaped = sum(1 for word in words if WORD_SHAPE_PATTERN.fullmatch(word) and VOWEL_PATTERN.search(word) and not CONSONANT_RUN_PATTERN.search(word))
+        known = sum(1 for word in words if word.lower() in COMMON_WORDS)
+        lexical = 0.4 * shaped / len(words) + 0.6 * min(1.0, known / len(words) / 0.08)
+    
+    numbers = NUMBER_TOKEN_PATTERN.findall(text)
+    digits = sum(1 for number in numbers if WELL_FORMED_NUMBER_PATTERN.fullmatch(number)) / len(numbers) if numbers else 0.5
+    
+    return round(max(0.0, printable) ** 2 * (0.8 * lexical + 0.2 * digits), 2)
+
+# Token budget for the document text sent to the LLM (0 sends everything). Longer documents
+# are cut down to the lines most likely to hold the billing fields.
+DOCUMENT_TOKEN_BUDGET = int(os.environ.get('DOCUMENT_TOKEN_BUDGET', '6000'))
+# Part of the first page, from the top, that is always kept (vendor, bill to, invoice number, date)
+FIRST_PAGE_TOP_FRACTION = float(os.environ.get('FIRST_PAGE_TOP_FRACTION', '0.35'))
+
+TOTAL_LINE_PATTERN = re.compile(r'\b(total|amount\s+due|balance\s+due|amount\s+payable|net\s+payable|pay\s+this\s+amount)\b', re.IGNORECASE)
+IDENTIFIER_LINE_PATTERN = re.compile(r'\b(invoice|bill|statement|receipt|account|order|p\.?\s?o\.?|purchase\s+order)\b[^\n\d]{0,20}[A-Z]{0,4}[-/#]?\d[\w/-]{2,}', re.IGNORECASE)
+DATE_LINE_PATTERN = re.compile(r'\b(\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}|(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+\d{1,2}\b|\d{1,2}\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*)', re.IGNORECASE)
+AMOUNT_LINE_PATTERN = re.compile(r'([$€£₹]|\b(USD|INR|EUR|GBP|CAD|AUD|JPY|Rs\.?)\b)\s?-?\d|\b\d{1,3}(,\d{3})*\.\d{2}\b')
+PARTY_LINE_PATTERN = re.compile(r'\b(bill(ed)?\s+to|sold\s+to|ship\s+to|remit\s+to|from|vendor|supplier|seller|customer|gstin|vat|tax\s+id)\b', re.IGNORECASE)
+
+def score_invoice_line(line):
+    """
+    How likely a line is to carry one of the billing fields
+    """
+    score = 0
+    if TOTAL_LINE_PATTERN.search(line):
+        score += 10
+    if IDENTIFIER_LINE_PATTERN.search(line):
+        score += 6
+    if DATE_LINE_PATTERN.search(line):
+        score += 3
+    if AMOUNT_LINE_PATTERN.search(line):
+        score += 2
+    if PARTY_LINE_PATTERN.search(line):
+        score += 2
+    return score
+
+def plan_document_text(text, pages=None, budget=DOCUMENT_TOKEN_BUDGET):
+    """
+    Fit document text into the token budget. Text that already fits is returned unchanged.
+    Otherwise keeps, in priority order: the top of the first page, every total line with its
+    neighbours, the last page, whole pages containing totals, then the best scoring other lines.
+    pages holds [position, line] lists per page from extract_text_from_pdf; without it the
+    text is treated as a single page with lines in reading order.
+    """
+    original_tokens = estimate_text_tokens(text)
+    if budget <= 0 or original_tokens <= budget:
+        return text
+    
+    if not pages:
+        text_lines = [line.strip() for line in text.splitlines() if line.strip()]
+        pages = [[[i / max(1, len(text_lines)), line] for i, line in enumerate(text_lines)]]
+    
+    lines = [(page_index, position, line) for page_index, page in enumerate(pages) for position, line in page]
+    costs = [estimate_text_tokens(line) + 1 for _, _, line in lines]
+    scores = [score_invoice_line(line) for _, _, line in lines]
+    last_page = len(pages) - 1
+    
+    selected = set()
+    used = 0
+    
+    def keep(indexes):
+        # Keep the whole group if it fits, otherwise as many of its best lines as possible
+        nonlocal used
+        remaining = [i for i in indexes if i not in selected]
+        group_cost = sum(costs[i] for i in remaining)
+        if used + group_cost <= budget:
+            selected.update(remaining)
+            used += group_cost
+            return
+        for i in sorted(remaining, key=lambda i: (-scores[i], i)):
+            if used + costs[i] <= budget:
+                selected.add(i)
+                used += costs[i]
+    
+    total_lines = [i for i, (_, _, line) in enumerate(lines) if TOTAL_LINE_PATTERN.search(line)]
+    total_pages = sorted({lines[i][0] for i in total_lines})
+    
+    keep([i for i, (page_index, position, _) in enumerate(lines) if page_index == 0 and position <= FIRST_PAGE_TOP_FRACTION])
+    # Amounts are often on the line next to their label
+    keep([j for i in total_lines for j in (i - 1, i, i + 1) if 0 <= j < len(lines) and lines[j][0] == lines[i][0]])
+    keep([i for i, (page_index, _, _) in enumerate(lines) if page_index == last_page])
+    for total_page in total_pages:
+        keep([i for i, (page_index, _, _) in enumerate(lines) if page_index == total_page])
+    keep(range(len(lines)))
+    
+    planned_lines = []
+    skipped = 0
+    for i, (_, _, line) in enumerate(lines):
+        if i in selected:
+            if skipped:
+                planned_lines.append(f"[... {skipped} lines omitted ...]")
+                skipped = 0
+            planned_lines.append(line)
+        else:
+            skipped += 1
+    if skipped:
+        planned_lines.append(f"[... {skipped} lines omitted ...]")
+    
+    print(f"Token budget planner kept {len(selected)}/{len(lines)} lines: ~{original_tokens} -> ~{used} tokens")
+    return "\n".join(planned_lines)
+
+# Text compaction before the LLM calls: collapses whitespace and dot leaders and drops page
+# headers/footers, legal boilerplate and duplicate lines
+TEXT_COMPACTION_ENABLED = os.environ.get('TEXT_COMPACTION_ENABLED', 'true').lower() == 'true'
+# Top and bottom share of a page where repeated headers and footers are looked for
+PAGE_MARGIN_FRACTION = float(os.environ.get('PAGE_MARGIN_FRACTION', '0.12'))
+
+WHITESPACE_PATTERN = re.compile(r'[ \t\u00a0]+')
+DOT_LEADER_PATTERN = re.compile(r'(?:[ \t]*[.·…_][ \t]*){4,}|-{4,}|={4,}')
+PAGE_NUMBER_PATTERN = re.compile(r'\bpage\s*\d+(\s*(of|/)\s*\d+)?\b|^\d{1,4}$', re.IGNORECASE)
+BOILERPLATE_START_PATTERN = re.compile(
+    r'\b(terms\s*(and|&)\s*conditions|terms\s+of\s+(service|use|sale)|please\s+detach|detach\s+(here|and\s+return)'
+    r'|return\s+this\s+(portion|stub|slip)|remittance\s+(slip|advice|stub)|privacy\s+(policy|notice)|all\s+rights\s+reserved'
+    r'|disclaimer|this\s+is\s+a\s+(computer|system)[\s-]generated|governing\s+law|limitation\s+of\s+liability)\b',
+    re.IGNORECASE
+)
+
+def is_protected_line(line):
+    """
+    Lines compaction must keep: totals, identifiers and dates
+    """
+    return bool(TOTAL_LINE_PATTERN.search(line) or IDENTIFIER_LINE_PATTERN.search(line) or DATE_LINE_PATTERN.search(line))
+
+def compact_document_text(text, pages=None):
+    """
+    Remove text that costs tokens without helping extraction. Returns (text, pages) in the
+    format of extract_text_from_pdf; pages is None when none were given.
+    - whitespace runs and dot leaders collapse to a single space
+    - lines repeated in the header/footer margin of at least half the pages keep only their first copy
+    - legal boilerplate blocks (terms and conditions, remittance slips, ...) are dropped
+    - identical lines keep only their first copy
+    A total, identifier or date line is only ever dropped as a repeat of a line that is kept,
+    so every such value still reaches the LLM.
+    """
+    if not TEXT_COMPACTION_ENABLED:
+        return text, pages
+    
+    has_pages = bool(pages)
+    if not has_pages:
+        text_lines = [line for line in text.splitlines() if line.strip()]
+        pages = [[[i / max(1, len(text_lines)), line] for i, line in enumerate(text_lines)]]
+    
+    cleaned_pages = []
+    for page in pages:
+        cleaned = []
+        for position, line in page:
+            line = WHITESPACE_PATTERN.sub(' ', DOT_LEADER_PATTERN.sub(' ', line)).strip()
+            if line:
+                cleaned.append([position, line])
+        cleaned_pages.append(cleaned)
+    
+    # Headers and footers: same text (ignoring page numbers) in the margins of most pages
+    repeated_keys = set()
+    if len(cleaned_pages) >= 2:
+        key_pages = {}
+        for page_index, page in enumerate(cleaned_pages):
+            for position, line in page:
+                if position <= PAGE_MARGIN_FRACTION or position >= 1 - PAGE_MARGIN_FRACTION:
+                    key_pages.setdefault(PAGE_NUMBER_PATTERN.sub('#', line.lower()), set()).add(page_index)
+        min_pages = max(2, (len(cleaned_pages) + 1) // 2)
+        repeated_keys = {key for key, page_set in key_pages.items() if len(page_set) >= min_pages}
+    
+    seen_lines = set()
+    seen_repeated = set()
+    compacted_pages = []
+    for page in cleaned_pages:
+        compacted = []
+        in_boilerplate = False
+        for position, line in page:
+            protected = is_protected_line(line)
+            
+            if BOILERPLATE_START_PATTERN.search(line) and not protected:
+                in_boilerplate = True
+                continue
+            # A boilerplate block runs through the prose that follows its heading
+            if in_boilerplate:
+                if not protected and not AMOUNT_LINE_PATTERN.search(line) and len(line) >= 30:
+                    continue
+                in_boilerplate = False
+            
+            key = PAGE_NUMBER_PATTERN.sub('#', line.lower())
+            if key in repeated_keys:
+                if key in seen_repeated:
+                    continue
+                seen_repeated.add(key)
+            
+            if line in seen_lines:
+                continue
+            seen_lines.add(line)
+            
+            compacted.append([position, line])
+        compacted_pages.append(compacted)
+    
+    compacted_text = "\n".join(line for page in compacted_pages for _, line in page)
+    original_tokens = estimate_text_tokens(text)
+    if original_tokens:
+        print(f"Text compaction: ~{original_tokens} -> ~{estimate_text_tokens(compacted_text)} tokens")
+    
+    return compacted_text, compacted_pages if has_pages else None
+
+def prepare_document_text(text, pages=None):
+    """
+    Compact the extracted text, then fit it into the token budget
+    """
+    text, pages = compact_document_text(text, pages)
+    return plan_document_text(text, pages)
+
+def estimate_output_tokens(text):
+    """
+    max_tokens for a billing extraction: room for the fixed fields plus the items/services
+    list, which grows with the number of line items (lines with amounts) in the text
+    """
+    item_lines = sum(1 for line in text.splitlines() if AMOUNT_LINE_PATTERN.search(line))
+    return max(512, min(4096, 300 + 15 * item_lines))
+
+# How documents are analysed: "combined" classifies and extracts in a single tool call,
+# "separate" keeps the original classify-then-extract two-call path
+EXTRACTION_MODE = os.environ.get('EXTRACTION_MODE', 'combined').lower()
+
+BILLING_FIELDS = ["po_number", "bill_to", "bill_from", "total_amount", "amount_due", "currency", "bill_id", "bill_date", "items_services"]
+
+DOCUMENT_CLASSIFICATION_RULES = """
+    BILL/INVOICE includes (be very inclusive):
+    - Traditional invoices with invoice numbers and line items
+    - Bills (utility, phone, internet, etc.)
+    - Statements with charges or amounts due (even if called "statement")
+    - AWS bills, cloud service bills, subscription bills
+    - Tax bills, government fees, penalty notices
+    - Service charges, professional service bills
+    - Receipts with amounts paid or due
+    - ANY financial document showing money owed or charges
+    - Handwritten receipts or bills from local markets/vendors
+    
+    IMPORTANT CLASSIFICATION RULES:
+    - If you see ANY dollar amounts, fees, charges, or costs → BILL_INVOICE
+    - If you see terms like "amount due", "total", "charges", "bill", "invoice" → BILL_INVOICE
+    - If you see vendor/company names with amounts → BILL_INVOICE
+    - If you see dates with financial amounts → BILL_INVOICE
+    - Only classify as OTHER if it's clearly non-financial (contracts, manuals, reports with no charges)
+    - When in doubt, classify as BILL_INVOICE (better to process than skip)
+"""
+
+# One line per billing field for the numbered list at the top of the extraction rules
+BILLING_FIELD_SUMMARIES = {
+    "po_number": 'PO number - Look for ANY number that appears after "PO", "P.O.", "Purchase Order", "PO#", "PO:", "PO-", etc. Can be any length (3-10 digits). If no PO number is found, return "NOT_FOUND"',
+    "bill_to": "Bill To (company/person the invoice is billed to)",
+    "bill_from": "Bill From (company/vendor issuing the invoice)",
+    "total_amount": "Total Amount (final total amount on the invoice - return ONLY the numeric value without currency symbols)",
+    "amount_due": "Amount Due (amount that needs to be paid - return ONLY the numeric value without currency symbols)",
+    "currency": "Currency (currency code like USD, INR, EUR, etc.)",
+    "bill_id": "Bill ID/Invoice number",
+    "bill_date": "Bill Date (invoice date in format YYYY-MM-DD)",
+    "items_services": "Items/Services (list of products, services, or items purchased - comma separated)"
+}
+
+# Detailed rule sections: (heading, rules per field, rules added whenever any of those fields is asked for)
+BILLING_RULE_SECTIONS = [
+    ("FLEXIBLE PO NUMBER RULES", {"po_number": [
+        'Look for patterns like: "PO: 124555", "P.O. 124555", "Purchase Order 124555", "PO-124555", "PO# 124555"',
+        "Can be 3-10 digits long",
+        "Can start with any digit (not just 2 or 3)",
+        'Examples of VALID patterns: "PO-124555", "PO: 20001", "Purchase Order 987654", "P.O.# 12345"',
+        "If multiple PO numbers found, pick the most prominent/first one",
+        'If no PO reference found at all, set to "NOT_FOUND"'
+    ]}, []),
+    ("AMOUNT RULES", {
+        "total_amount": ['Total Amount: Look for "Total", "Grand Total", "Amount", "Invoice Total" - return only numbers (e.g., "1234.56")'],
+        "amount_due": ['Amount Due: Look for "Amount Due", "Balance Due", "Due", "Pay This Amount" - return only numbers (e.g., "1234.56")']
+    }, ["Remove all currency symbols, commas, and special characters from amounts"]),
+    ("CURRENCY RULES", {"currency": [
+        "Extract currency separately (USD, INR, EUR, GBP, etc.)",
+        "Look for currency symbols ($, ₹, €, £) or currency codes"
+    ]}, []),
+    ("ITEMS/SERVICES RULES", {"items_services": [
+        "List all products, services, subscriptions, or items mentioned in the invoice",
+        "Include descriptions, product names, service types",
+        "Separate multiple items with commas",
+        'Examples: "Web Hosting Service, Domain Registration" or "Electricity Bill, Service Charges"'
+    ]}, [])
+]
+
+def build_billing_rules(fields):
+    """
+    Extraction rules for just the given billing fields: the numbered field list, then the
+    detailed rule sections that apply to them
+    """
+    lines = [f"    {number}. {BILLING_FIELD_SUMMARIES[field]}" for number, field in enumerate(fields, 1)]
+    for heading, field_rules, shared_rules in BILLING_RULE_SECTIONS:
+        rules = [rule for field in fields for rule in field_rules.get(field, [])]
+        if rules:
+            lines += ["    ", f"    {heading}:"] + [f"    - {rule}" for rule in rules + shared_rules]
+    return "\n" + "\n".join(lines) + "\n"
+
+BILLING_EXTRACTION_RULES = build_billing_rules(BILLING_FIELDS)
+
+CLASSIFICATION_PROPERTIES = {
+    "document_type": {
+        "type": "string",
+        "enum": ["BILL_INVOICE", "OTHER"],
+        "description": "Type of document"
+    },
+    "confidence": {
+        "type": "string",
+        "enum": ["HIGH", "MEDIUM", "LOW"],
+        "description": "Confidence level"
+    },
+    "reason": {
+        "type": "string",
+        "description": "Brief explanation"
+    }
+}
+
+BILLING_FIELD_PROPERTIES = {
+    "po_number": {
+        "type": "string",
+        "description": "Purchase Order number - any number found after PO/Purchase Order references"
+    },
+    "bill_to": {
+        "type": "string",
+        "description": "Company or person the invoice is billed to"
+    },
+    "bill_from": {
+        "type": "string",
+        "description": "Company or vendor issuing the invoice"
+    },
+    "total_amount": {
+        "type": "string",
+        "description": "Total amount on the invoice - numbers only, no currency symbols"
+    },
+    "amount_due": {
+        "type": "string",
+        "description": "Amount due to be paid - numbers only, no currency symbols"
+    },
+    "currency": {
+        "type": "string",
+        "description": "Currency code (USD, INR, EUR, etc.)"
+    },
+    "bill_id": {
+        "type": "string",
+        "description": "Invoice number or ID"
+    },
+    "bill_date": {
+        "type": "string",
+        "description": "Date of the invoice in format YYYY-MM-DD"
+    },
+    "items_services": {
+        "type": "string",
+        "description": "Comma-separated list of items, products, or services purchased"
+    }
+}
+
+def api_error_billing_info():
+    """
+    Billing fields to report when the extraction call failed
+    """
+    return {field: "API_ERROR" for field in BILLING_FIELDS}
+
+def clean_billing_amounts(result):
+    """
+    Clean up amounts and ensure proper formatting
+    """
+    if 'total_amount' in result:
+        result['total_amount'] = clean_amount(result['total_amount'])
+    if 'amount_due' in result:
+        result['amount_due'] = clean_amount(result['amount_due'])
+    
+    return result
+
+CLASSIFY_FUNCTION = {
+    "name": "ClassifyDocument",
+    "description": "Classify document type",
+    "parameters": {
+        "type": "object",
+        "properties": CLASSIFICATION_PROPERTIES,
+        "required": ["document_type", "confidence", "reason"]
+    }
+}
+
+EXTRACT_FUNCTION = {
+    "name": "ExtractInvoiceData",
+    "description": "Extract structured data from invoice text",
+    "parameters": {
+        "type": "object",
+        "properties": BILLING_FIELD_PROPERTIES,
+        "required": BILLING_FIELDS
+    }
+}
+
+def build_classification_prompt(text):
+    """
+    Prompt for the classification call on the first 2000 characters of document text
+    """
+    return f"""
+    You are a document classifier. Analyze the following document text and determine if it is:
+    1. A BILL/INVOICE - ANY document that shows amounts to be paid, charges, fees, costs, or financial obligations
+    2. OTHER - clearly non-financial documents like contracts, reports, manuals, etc.
+    {DOCUMENT_CLASSIFICATION_RULES}
+    Return ONLY a JSON object with these keys:
+    - document_type: "BILL_INVOICE" or "OTHER" 
+    - confidence: "HIGH", "MEDIUM", or "LOW"
+    - reason: Brief explanation for the classification
+    
+    Document text (first 2000 characters):
+    {text}
+    """
+
+def build_extraction_prompt(text):
+    """
+    Prompt for the billing extraction call on invoice text
+    """
+    return f"""
+    You are a professional invoice analyzer. Extract the following information from this invoice text:
+    {BILLING_EXTRACTION_RULES}
+    Return ONLY a JSON object with these keys: po_number, bill_to, bill_from, total_amount, amount_due, currency, bill_id, bill_date, items_services
+    
+    Here's the invoice text:
+    {text}
+    """
+
+# Classification answers are three short fields
+CLASSIFY_TEMPLATE = RequestTemplate(build_tool_payload(build_classification_prompt(TEMPLATE_SLOT), CLASSIFY_FUNCTION, max_tokens=256))
+EXTRACT_TEMPLATE = RequestTemplate(build_tool_payload(build_extraction_prompt(TEMPLATE_SLOT), EXTRACT_FUNCTION))
+
+# Fields a cheaper model must fill in for its invoice answer to be accepted
+REQUIRED_BILLING_FIELDS = ["bill_from", "total_amount"]
+
+def classification_escalation_reason(classification):
+    """
+    Why a classification should be retried on a larger model, or None to accept it
+    """
+    if not classification:
+        return "no answer"
+    if classification.get("confidence") not in ("HIGH", "MEDIUM"):
+        return "LOW confidence"
+    return None
+
+def billing_escalation_reason(billing_info):
+    """
+    Why extracted billing fields should be retried on a larger model, or None to accept them.
+    Checks required fields and that amounts and the date parse.
+    """
+    for field in REQUIRED_BILLING_FIELDS:
+        if billing_info.get(field, "") in ("", "NOT_FOUND"):
+            return f"{field} empty"
+    
+    for field in ("total_amount", "amount_due"):
+        value = billing_info.get(field, "")
+        if value not in ("", "NOT_FOUND"):
+            try:
+                float(value)
+            except ValueError:
+                return f"{field} {value!r} is not a number"
+    
+    bill_date = billing_info.get("bill_date", "")
+    if bill_date not in ("", "NOT_FOUND"):
+        try:
+            datetime.strptime(bill_date, "%Y-%m-%d")
+        except ValueError:
+            return f"bill_date {bill_date!r} is not YYYY-MM-DD"
+    
+    return None
+
+def check_document_type(text, api_key):
+    """
+    Check if the document is a bill/invoice or something else.
+    More lenient classification to catch all types of invoices.
+    """
+    cache_key = stage_cache.make_key(text[:2000], ",".join(CLASSIFICATION_MODELS), PROMPT_VERSION, SCHEMA_VERSION)
+    cached = stage_cache.get("classification", cache_key)
+    if cached is not None:
+        return cached
+    
+    result = run_model_tiers(
+        "classification",
+        select_model_tiers(CLASSIFICATION_MODELS, text[:2000]),
+        lambda model, usage: call_openai_template(CLASSIFY_TEMPLATE, text[:2000], api_key, model=model, usage=usage),
+        classification_escalation_reason
+    )
+    
+    if not result:
+        # Default to BILL_INVOICE if API fails - better to process than skip
+        return {"document_type": "BILL_INVOICE", "confidence": "LOW", "reason": "API call failed - defaulting to process"}
+    
+    stage_cache.put("classification", cache_key, result)
+    return result
+
+# Rule-based fast path: labelled fields in machine-generated PDFs are read locally and only
+# the fields the rules can't fill with confidence are asked from the model
+RULE_EXTRACTION_ENABLED = os.environ.get('RULE_EXTRACTION_ENABLED', 'true').lower() == 'true'
+
+_AMOUNT_NUMBER = r'-?\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|-?\d+(?:\.\d{1,2})?'
+_DATE_VALUE = (
+    r'\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{4}|'
+    r'\d{1,2}[\s-][A-Za-z]{3,9}\.?[\s-],?\s*\d{4}|[A-Za-z]{3,9}\.?\s+\d{1,2},?\s+\d{4}'
+)
+_AMOUNT_VALUE = (
+    r'(?P<symbol>[$€£₹¥₽]|\b(?:USD|INR|EUR|GBP|JPY|RUB)\b)?\s?'
+    r'(?P<amount>' + _AMOUNT_NUMBER + r')'
+    r'(?:\s?(?P<code>USD|INR|EUR|GBP|JPY|RUB)\b)?'
+)
+# Amount lines only count when the line is just the label and a single amount
+TOTAL_FIELD_PATTERN = re.compile(
+    r'^\s*(?P<label>grand\s+total|invoice\s+total|total\s+amount|total)(?!\s+(?:due|payable))[\s:.\-]*' + _AMOUNT_VALUE + r'\s*$',
+    re.IGNORECASE | re.MULTILINE
+)
+AMOUNT_DUE_FIELD_PATTERN = re.compile(
+    r'^\s*(?:total\s+amount\s+due|amount\s+due|balance\s+due|total\s+due|amount\s+payable|pay\s+this\s+amount)[\s:.\-]*' + _AMOUNT_VALUE + r'\s*$',
+    re.IGNORECASE | re.MULTILINE
+)
+# Labels use (?<![A-Za-z]) rather than \b because PyPDF2 often glues a label to the number before it
+BILL_ID_FIELD_PATTERN = re.compile(
+    r'(?<![A-Za-z])(?:invoice|bill|statement|receipt)\s*(?:no\.?|number|num\.?|#|id)\s*[:#.]?\s*(?P<value>[A-Z0-9][A-Z0-9/-]*\d[A-Z0-9/-]*)\b',
+    re.IGNORECASE
+)
+PO_NUMBER_FIELD_PATTERN = re.compile(
+    r'(?<![A-Za-z])(?:p\.?\s?o\.?|purchase\s+order)(?!\s*box)\s*(?:no\.?|number|#)?\s*[:#-]?\s*(?P<value>\d{3,10})\b',
+    re.IGNORECASE
+)
+PO_MENTION_PATTERN = re.compile(r'(?<![A-Za-z])(?:p\.?\s?o\b|purchase\s+order)', re.IGNORECASE)
+BILL_DATE_FIELD_PATTERN = re.compile(
+    r'(?:(?<![A-Za-z])(?:invoice|bill|billing|statement|issue|document)\s+date|^\s*date)\s*[:\-]?\s*'
+    r'(?P<value>' + _DATE_VALUE + r')',
+    re.IGNORECASE | re.MULTILINE
+)
+BILL_TO_FIELD_PATTERN = re.compile(r'^\s*bill(?:ed)?\s+to\b\s*[:\-]?[ \t]*(?P<value>[^\n]*)$', re.IGNORECASE | re.MULTILINE)
+CURRENCY_MARKER_PATTERN = re.compile(r'[$€£₹¥₽]|\b(?:USD|INR|EUR|GBP|JPY|RUB|CAD|AUD|SGD|CHF|AED)\b')
+
+def parse_invoice_date(value):
+    """
+    Convert a printed date to YYYY-MM-DD, or None when it is ambiguous (like 03/04/2025) or invalid
+    """
+    if re.search(r'[A-Za-z]', value):
+        # "Mar. 3, 2025" and "3-Mar-2025" both become "Mar 3 2025" style tokens
+        value = re.sub(r'[.,-]', ' ', value)
+    value = WHITESPACE_PATTERN.sub(" ", value).strip()
+    numeric = re.fullmatch(r'(\d{1,4})[-/.](\d{1,2})[-/.](\d{1,4})', value)
+    if numeric:
+        first, second, third = numeric.groups()
+        if len(first) == 4:
+            candidates = [(first, second, third)]
+        else:
+            # Day and month order is only certain when one of them can't be a month
+            orders = {(third, second, first), (third, first, second)}
+            candidates = [order for order in orders if int(order[1]) <= 12]
+            if len(candidates) != 1:
+                return None
+        year, month, day = candidates[0]
+        value = f"{year}-{int(month):02d}-{int(day):02d}"
+    
+    for date_format in ("%Y-%m-%d", "%d %b %Y", "%d %B %Y", "%b %d %Y", "%B %d %Y"):
+        try:
+            return datetime.strptime(value, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def single_labelled_amount(matches):
+    """
+    The amount when every labelled line agrees on one value, otherwise None
+    """
+    # A bare integer after "Total" is as likely a count of items as an amount
+    if not matches or not all(match.group("symbol") or match.group("code") or "." in match.group("amount") for match in matches):
+        return None
+    
+    values = {clean_amount(match.group("amount")) for match in matches}
+    return values.pop() if len(values) == 1 else None
+
+def extract_billing_fields_with_rules(text):
+    """
+    Read labelled billing fields with the precompiled patterns. Only fields found without
+    ambiguity are returned, already in the format the model is asked for.
+    """
+    fields = {}
+    
+    totals = list(TOTAL_FIELD_PATTERN.finditer(text))
+    # A grand total outranks plain "Total" lines, which may be section totals
+    grand_totals = [match for match in totals if match.group("label").lower().split()[0] in ("grand", "invoice")]
+    total = single_labelled_amount(grand_totals or totals)
+    due = single_labelled_amount(list(AMOUNT_DUE_FIELD_PATTERN.finditer(text)))
+    if due and not totals:
+        # "Total amount due" is both the total and the amount due
+        total = due if re.search(r'^\s*total\s+amount\s+due', text, re.IGNORECASE | re.MULTILINE) else None
+    if total:
+        fields["total_amount"] = total
+    if due:
+        fields["amount_due"] = due
+    
+    currencies = {extract_currency(marker) for marker in CURRENCY_MARKER_PATTERN.findall(text)}
+    if len(currencies) == 1 and "UNKNOWN" not in currencies:
+        fields["currency"] = currencies.pop()
+    
+    bill_ids = {match.group("value").upper() for match in BILL_ID_FIELD_PATTERN.finditer(text)}
+    if len(bill_ids) == 1:
+        fields["bill_id"] = bill_ids.pop()
+    
+    po_match = PO_NUMBER_FIELD_PATTERN.search(text)
+    if po_match:
+        fields["po_number"] = po_match.group("value")
+    elif not PO_MENTION_PATTERN.search(text):
+        fields["po_number"] = "NOT_FOUND"
+    
+    dates = {parse_invoice_date(match.group("value")) for match in BILL_DATE_FIELD_PATTERN.finditer(text)}
+    if len(dates) == 1 and None not in dates:
+        fields["bill_date"] = dates.pop()
+    
+    bill_to_match = BILL_TO_FIELD_PATTERN.search(text)
+    if bill_to_match:
+        bill_to = bill_to_match.group("value").strip()
+        if not bill_to:
+            following = text[bill_to_match.end():].lstrip("\n").split("\n", 1)[0]
+            bill_to = following.strip()
+        if re.search(r'[A-Za-z]{2}', bill_to) and ":" not in bill_to and len(bill_to) <= 100:
+            fields["bill_to"] = bill_to
+    
+    return fields
+
+class RuleExtractionStats:
+    """
+    How many billing fields the rule-based fast path filled locally in the current run
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run()
+    
+    def start_run(self):
+        with self.lock:
+            self.documents = 0
+            self.fully_local = 0
+            self.field_counts = {field: 0 for field in BILLING_FIELDS}
+    
+    def record(self, fields):
+        with self.lock:
+            self.documents += 1
+            self.fully_local += 1 if len(fields) == len(BILLING_FIELDS) else 0
+            for field in fields:
+                self.field_counts[field] += 1
+    
+    def stats(self):
+        with self.lock:
+            filled = sum(self.field_counts.values())
+            return {
+                "documents": self.documents,
+                "fully_local": self.fully_local,
+                "fields_filled": filled,
+                "field_fill_ratio": round(filled / (self.documents * len(BILLING_FIELDS)), 3) if self.documents else 0.0,
+                "fields": dict(self.field_counts)
+            }
+
+rule_extraction_stats = RuleExtractionStats()
+
+def build_partial_extraction_prompt(text, fields):
+    """
+    Prompt for the extraction call when only some billing fields are still missing
+    """
+    return f"""
+    You are a professional invoice analyzer. Extract the following information from this invoice text:
+    {build_billing_rules(fields)}
+    Return ONLY a JSON object with these keys: {", ".join(fields)}
+    
+    Here's the invoice text:
+    {text}
+    """
+
+@functools.lru_cache(maxsize=64)
+def partial_extract_template(fields):
+    """
+    Prebuilt request for a tuple of missing billing fields, with a schema reduced to just those fields
+    """
+    function_definition = {
+        "name": "ExtractInvoiceData",
+        "description": "Extract structured data from invoice text",
+        "parameters": {
+            "type": "object",
+            "properties": {field: BILLING_FIELD_PROPERTIES[field] for field in fields},
+            "required": list(fields)
+        }
+    }
+    return RequestTemplate(build_tool_payload(build_partial_extraction_prompt(TEMPLATE_SLOT, fields), function_definition))
+
+def extract_billing_info_with_gpt(text, api_key, known_fields=None):
+    """
+    Extracts billing information from PDF text using GPT.
+    Updated with more flexible PO number detection, better field names, and items list.
+    Fields the local rules read with confidence, plus any known_fields (from a vendor template),
+    are kept and only the rest are asked from the model.
+    """
+    versions = [json.dumps(known_fields, sort_keys=True)] if known_fields else []
+    cache_key = stage_cache.make_key(text, ",".join(EXTRACTION_MODELS), PROMPT_VERSION, SCHEMA_VERSION, *versions)
+    cached = stage_cache.get("extraction", cache_key)
+    if cached is not None:
+        return cached
+    
+    rule_fields = extract_billing_fields_with_rules(text) if RULE_EXTRACTION_ENABLED else {}
+    rule_extraction_stats.record(rule_fields)
+    rule_fields.update(known_fields or {})
+    missing = tuple(field for field in BILLING_FIELDS if field not in rule_fields)
+    
+    result = {}
+    if missing:
+        template = partial_extract_template(missing) if rule_fields else EXTRACT_TEMPLATE
+        # Output shrinks with the schema, so scale the token estimate to the fields asked for
+        max_tokens = max(256, estimate_output_tokens(text) * len(missing) // len(BILLING_FIELDS))
+        result = run_model_tiers(
+            "extraction",
+            select_model_tiers(EXTRACTION_MODELS, text),
+            lambda model, usage: clean_billing_amounts(call_openai_template(template, text, api_key, max_tokens=max_tokens, model=model, usage=usage)),
+            lambda result: billing_escalation_reason({**result, **rule_fields}) if result else "no answer"
+        )
+        if not result and not rule_fields:
+            return api_error_billing_info()
+    
+    result = {field: rule_fields.get(field, result.get(field, "API_ERROR" if not result else "")) for field in BILLING_FIELDS}
+    if "API_ERROR" not in result.values():
+        stage_cache.put("extraction", cache_key, result)
+    return result
+
+CLASSIFY_EXTRACT_INSTRUCTIONS = f"""
+    You are a professional invoice analyzer. First determine if the following document is:
+    1. A BILL/INVOICE - ANY document that shows amounts to be paid, charges, fees, costs, or financial obligations
+    2. OTHER - clearly non-financial documents like contracts, reports, manuals, etc.
+    {DOCUMENT_CLASSIFICATION_RULES}
+    If it is a BILL_INVOICE, extract the following information:
+    {BILLING_EXTRACTION_RULES}
+    If it is OTHER, return empty strings for all the billing fields.
+    
+    Return ONLY a JSON object with these keys: document_type, confidence, reason, po_number, bill_to, bill_from, total_amount, amount_due, currency, bill_id, bill_date, items_services
+"""
+
+CLASSIFY_EXTRACT_FUNCTION = {
+    "name": "ClassifyAndExtractInvoiceData",
+    "description": "Classify the document and extract structured data if it is an invoice",
+    "parameters": {
+        "type": "object",
+        "properties": {**CLASSIFICATION_PROPERTIES, **BILLING_FIELD_PROPERTIES},
+        "required": ["document_type", "confidence", "reason"] + BILLING_FIELDS
+    }
+}
+
+def build_classify_extract_prompt(text):
+    """
+    Prompt for the combined classification and extraction call on document text
+    """
+    return f"""{CLASSIFY_EXTRACT_INSTRUCTIONS}
+    Here's the document text:
+    {text}
+    """
+
+def build_image_classify_extract_prompt():
+    """
+    Prompt for the combined classification and extraction call on an attached image
+    """
+    return f"""{CLASSIFY_EXTRACT_INSTRUCTIONS}
+    The document is the attached image. Read all printed and handwritten text in it.
+    """
+
+CLASSIFY_EXTRACT_TEMPLATE = RequestTemplate(build_tool_payload(build_classify_extract_prompt(TEMPLATE_SLOT), CLASSIFY_EXTRACT_FUNCTION))
+
+# Images are classified and extracted straight from the pixels in one call ("direct"),
+# or transcribed first and then analysed like PDF text ("transcribe")
+IMAGE_EXTRACTION_MODE = os.environ.get('IMAGE_EXTRACTION_MODE', 'direct').lower()
+# Also ask the direct call for a transcript of the image, for debugging and audits
+VISION_AUDIT_TRANSCRIPT = os.environ.get('VISION_AUDIT_TRANSCRIPT', 'false').lower() == 'true'
+
+# The model also rates how readable the image is, so a low detail answer can be retried at high detail
+IMAGE_CLASSIFY_EXTRACT_PROPERTIES = {
+    **CLASSIFY_EXTRACT_FUNCTION["parameters"]["properties"],
+    "legibility": {
+        "type": "string",
+        "enum": ["HIGH", "MEDIUM", "LOW"],
+        "description": "How clearly the text in the image can be read; LOW when amounts, dates or names are too small or blurry to read reliably"
+    }
+}
+if VISION_AUDIT_TRANSCRIPT:
+    IMAGE_CLASSIFY_EXTRACT_PROPERTIES["transcript"] = {"type": "string", "description": "All text in the image, in reading order"}
+
+IMAGE_CLASSIFY_EXTRACT_FUNCTION = {
+    **CLASSIFY_EXTRACT_FUNCTION,
+    "parameters": {
+        "type": "object",
+        "properties": IMAGE_CLASSIFY_EXTRACT_PROPERTIES,
+        "required": CLASSIFY_EXTRACT_FUNCTION["parameters"]["required"] + [name for name in IMAGE_CLASSIFY_EXTRACT_PROPERTIES if name in ("legibility", "transcript")]
+    }
+}
+
+IMAGE_CLASSIFY_EXTRACT_TEMPLATES = {
+    detail: RequestTemplate(build_vision_tool_payload(build_image_classify_extract_prompt(), [TEMPLATE_SLOT], IMAGE_CLASSIFY_EXTRACT_FUNCTION, detail))
+    for detail in VISION_DETAIL_LADDER
+}
+
+def parse_classify_extract_result(result):
+    """
+    Split the combined tool call arguments into (classification, billing_info)
+    """
+    classification = {
+        "document_type": result.get("document_type", "BILL_INVOICE"),
+        "confidence": result.get("confidence", "LOW"),
+        "reason": result.get("reason", "")
+    }
+    billing_info = clean_billing_amounts({field: result.get(field, "") for field in BILLING_FIELDS})
+    
+    return classification, billing_info
+
+def classify_extract_cache_key(text):
+    """
+    Stage cache key for combined classification and extraction, shared with the batch mode
+    """
+    return stage_cache.make_key(text, ",".join(EXTRACTION_MODELS), PROMPT_VERSION, SCHEMA_VERSION)
+
+def classify_extract_escalation_reason(result):
+    """
+    Why a combined answer should be retried on a larger model, or None to accept it
+    """
+    if not result:
+        return "no answer"
+    
+    classification, billing_info = parse_classify_extract_result(result)
+    reason = classification_escalation_reason(result)
+    if reason is None and classification["document_type"] == "BILL_INVOICE":
+        reason = billing_escalation_reason(billing_info)
+    return reason
+
+def image_escalation_reason(result):
+    """
+    Why a direct image answer should be retried at a higher detail level or on a larger model, or None to accept it
+    """
+    if result and result.get("legibility") == "LOW":
+        return "LOW legibility"
+    return classify_extract_escalation_reason(result)
+
+def classify_and_extract_image(image_content, filename, api_key):
+    """
+    Classify an image and extract billing information in a single vision call, without a
+    transcript step. Multi-page TIFFs go in one request with every page attached.
+    Returns (classification, billing_info) like classify_and_extract_with_gpt.
+    """
+    cache_key = stage_cache.make_key(image_content, ",".join(VISION_MODELS), PROMPT_VERSION, SCHEMA_VERSION, IMAGE_PREPROCESSING_VERSION, str(VISION_AUDIT_TRANSCRIPT), ",".join(VISION_DETAIL_LADDER))
+    result = stage_cache.get("image_classify_extract", cache_key)
+    
+    if result is None:
+        pages = split_image_pages(image_content)
+        
+        def classify_extract_at(detail):
+            images = [preprocess_image(page, detail) for page in pages]
+            image_urls = [image_data_url(image, mime_type) for image, mime_type in images]
+            template = IMAGE_CLASSIFY_EXTRACT_TEMPLATES[detail]
+            estimated_tokens = template.static_tokens + sum(estimate_image_tokens(image, detail) for image, _ in images)
+            print(f"Sending {filename} to the vision API directly at {detail} detail ({len(images)} page(s), {sum(len(image) for image, _ in images)} bytes)")
+            
+            def request_body(model):
+                if len(image_urls) == 1:
+                    return template.render(image_urls[0], escape=False, model=model)
+                payload = build_vision_tool_payload(build_image_classify_extract_prompt(), image_urls, IMAGE_CLASSIFY_EXTRACT_FUNCTION, detail)
+                payload["model"] = model
+                return payload
+            
+            return run_model_tiers(
+                "image_classify_extract",
+                VISION_MODELS,
+                lambda model, usage: call_openai_tool(request_body(model), estimated_tokens, api_key, usage=usage),
+                image_escalation_reason
+            )
+        
+        static_tokens = IMAGE_CLASSIFY_EXTRACT_TEMPLATES[VISION_DETAIL_LADDER[0]].static_tokens
+        result = run_detail_ladder("image_classify_extract", pages, static_tokens, classify_extract_at, image_escalation_reason)
+        if result:
+            stage_cache.put("image_classify_extract", cache_key, result)
+    
+    if not result:
+        classification = {"document_type": "BILL_INVOICE", "confidence": "LOW", "reason": "API call failed - defaulting to process"}
+        return classification, api_error_billing_info()
+    
+    if VISION_AUDIT_TRANSCRIPT:
+        print(f"Transcript of {filename}: {result.get('transcript', '')[:2000]}")
+    return parse_classify_extract_result(result)
+
+def classify_and_extract_with_gpt(text, api_key, on_field=None):
+    """
+    Classify the document and extract billing information in a single tool call.
+    Returns (classification, billing_info); billing fields are empty for OTHER documents.
+    When streaming, fields go to on_field as they finish and non-invoices stop the stream early.
+    """
+    cache_key = classify_extract_cache_key(text)
+    result = stage_cache.get("classify_extract", cache_key)
+    
+    if result is None:
+        result = run_model_tiers(
+            "classify_extract",
+            select_model_tiers(EXTRACTION_MODELS, text),
+            lambda model, usage: call_openai_template(
+                CLASSIFY_EXTRACT_TEMPLATE,
+                text,
+                api_key,
+                on_field=on_field,
+                # Wait for the confidence too, so a LOW confidence answer can still escalate
+                stop_when=lambda fields: fields.get("document_type") == "OTHER" and "confidence" in fields,
+                max_tokens=estimate_output_tokens(text),
+                model=model,
+                usage=usage
+            ),
+            classify_extract_escalation_reason
+        )
+        if result:
+            stage_cache.put("classify_extract", cache_key, result)
+    
+    if not result:
+        # Same fallback as the two-call path: process rather than skip, and report the API error
+        classification = {"document_type": "BILL_INVOICE", "confidence": "LOW", "reason": "API call failed - defaulting to process"}
+        return classification, api_error_billing_info()
+    
+    return parse_classify_extract_result(result)
+
+# Local pre-classifier: unambiguous documents skip the classification call entirely
+PRECLASSIFIER_ENABLED = os.environ.get('PRECLASSIFIER_ENABLED', 'true').lower() == 'true'
+# PDF /Producer substrings of billing systems whose documents are always invoices or bills
+BILLING_PDF_PRODUCERS = [name.strip().lower() for name in os.environ.get(
+    'BILLING_PDF_PRODUCERS',
+    'QuickBooks,Xero,FreshBooks,Zoho Invoice,Zoho Books,Stripe,Bill.com,Sage,NetSuite,Chargebee,Invoice Ninja,Wave'
+).split(',') if name.strip()]
+# Below this length the text says too little to call it OTHER without asking the model
+PRECLASSIFIER_MIN_OTHER_CHARS = int(os.environ.get('PRECLASSIFIER_MIN_OTHER_CHARS', '300'))
+
+# Both patterns run on lowercased text, which is about twice as fast as IGNORECASE
+INVOICE_KEYWORD_PATTERN = re.compile(
+    r'\b(invoice|bill(?:ed)?\s+to|amount\s+due|balance\s+due|total\s+due|amount\s+payable|sub-?total|'
+    r'due\s+date|remit(?:tance)?|receipt|statement\s+of\s+account|pay\s+this\s+amount)\b'
+)
+FINANCIAL_TERM_PATTERN = re.compile(
+    r'\b(?:invoice|bill(?:ing|ed)?|total|amount|due|charges?|fees?|costs?|price|payments?|paid|balance|receipt|tax|vat|gst)\b'
+)
+
+class PreclassifierStats:
+    """
+    How many documents the local pre-classifier decided on its own versus sent to the model
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run()
+    
+    def start_run(self):
+        with self.lock:
+            self.counts = {"BILL_INVOICE": 0, "OTHER": 0, "ambiguous": 0}
+    
+    def record(self, document_type):
+        with self.lock:
+            self.counts[document_type or "ambiguous"] += 1
+    
+    def stats(self):
+        with self.lock:
+            documents = sum(self.counts.values())
+            skipped = self.counts["BILL_INVOICE"] + self.counts["OTHER"]
+            return {
+                "documents": documents,
+                "skipped_as_bill_invoice": self.counts["BILL_INVOICE"],
+                "skipped_as_other": self.counts["OTHER"],
+                "sent_to_model": self.counts["ambiguous"],
+                "skipped_ratio": round(skipped / documents, 3) if documents else 0.0
+            }
+
+preclassifier_stats = PreclassifierStats()
+
+def preclassify_document(text, producer=""):
+    """
+    Apply the classification rules locally. Returns a HIGH confidence classification when
+    the signals are unambiguous, or None when the model has to decide.
+    """
+    if not PRECLASSIFIER_ENABLED:
+        return None
+    
+    lowered = text.lower()
+    has_amount = AMOUNT_LINE_PATTERN.search(text) is not None
+    billing_producer = next((name for name in BILLING_PDF_PRODUCERS if name in producer.lower()), None)
+    
+    # Two different invoice phrases are enough, so stop scanning once they are found
+    keywords = set()
+    if has_amount:
+        for match in INVOICE_KEYWORD_PATTERN.finditer(lowered):
+            keywords.add(WHITESPACE_PATTERN.sub(" ", match.group(1)))
+            if len(keywords) >= 2:
+                break
+    
+    classification = None
+    if has_amount and (len(keywords) >= 2 or billing_producer):
+        signals = f"amounts with {' and '.join(sorted(keywords))}" if len(keywords) >= 2 else f"amounts in a {producer} PDF"
+        classification = {"document_type": "BILL_INVOICE", "confidence": "HIGH", "reason": f"Local rules: {signals}"}
+    elif not has_amount and len(text) >= PRECLASSIFIER_MIN_OTHER_CHARS and not FINANCIAL_TERM_PATTERN.search(lowered):
+        classification = {"document_type": "OTHER", "confidence": "HIGH", "reason": "Local rules: no amounts or financial terms"}
+    
+    preclassifier_stats.record(classification and classification["document_type"])
+    return classification
+
+# Vendor templates: recurring bills from the same sender and layout are extracted locally
+# once enough model extractions agree on where each field sits
+VENDOR_TEMPLATES_ENABLED = os.environ.get('VENDOR_TEMPLATES_ENABLED', 'true').lower() == 'true'
+VENDOR_TEMPLATE_MIN_SAMPLES = max(2, int(os.environ.get('VENDOR_TEMPLATE_MIN_SAMPLES', '3')))
+# Every Nth local extraction is also sent to the model to catch layout drift
+VENDOR_TEMPLATE_SPOT_CHECK_EVERY = max(1, int(os.environ.get('VENDOR_TEMPLATE_SPOT_CHECK_EVERY', '10')))
+
+LAYOUT_ANCHOR_PATTERN = re.compile(r'(?<![A-Za-z])([A-Za-z][A-Za-z #./&()-]{1,38}[A-Za-z#.)])\s*:')
+ANCHOR_LABEL_PATTERN = re.compile(r'([A-Za-z][A-Za-z #./&()-]{1,40}?[:#]?)[\s$€£₹¥₽]*$')
+AMOUNT_TOKEN_PATTERN = re.compile(_AMOUNT_NUMBER)
+DATE_TOKEN_PATTERN = re.compile(_DATE_VALUE)
+
+def layout_fingerprint(text):
+    """
+    Hash of the document's label anchors ("Invoice Number:", "Bill To:", ...) in order, plus the
+    shape of its first lines. Values change every month, so only labels and structure are used.
+    """
+    anchors = []
+    for match in LAYOUT_ANCHOR_PATTERN.finditer(text):
+        label = WHITESPACE_PATTERN.sub(" ", match.group(1).lower())
+        if label not in anchors:
+            anchors.append(label)
+        if len(anchors) >= 20:
+            break
+    
+    if len(anchors) < 3:
+        return None
+    
+    lines = [line for line in text.split("\n") if line.strip()][:12]
+    shape = "".join("L" if ":" in line else "N" if re.search(r'\d', line) else "T" for line in lines)
+    return hashlib.sha256(f"{'|'.join(anchors)}#{shape}".encode('utf-8')).hexdigest()[:16]
+
+def template_value_kind(field, value):
+    if field in ("total_amount", "amount_due"):
+        return "amount"
+    if field == "bill_date":
+        return "date"
+    return "rest" if " " in value.strip() else "token"
+
+def read_template_value(rest, kind):
+    """
+    Read a value of the given kind from the text that follows an anchor label
+    """
+    if kind == "amount":
+        match = AMOUNT_TOKEN_PATTERN.search(rest)
+        return clean_amount(match.group(0)) if match else None
+    if kind == "date":
+        match = DATE_TOKEN_PATTERN.search(rest)
+        return parse_invoice_date(match.group(0)) if match else None
+    if kind == "token":
+        tokens = rest.split()
+        return tokens[0].rstrip(",;") if tokens else None
+    return rest.strip() or None
 
-def is_email_already_processed(email_result, processed_records):
+def apply_template_rule(lines, lowered_lines, rule):
     """
-    Check if this specific email was already processed based on Message-ID
+    Value for one field from a learned rule, or None when its anchor is missing
     """
-    email_signature = create_email_signature(email_result)
-    
-    if email_signature in processed_records:
-        record = processed_records[email_signature]
-        print(f"Email already processed on {record.get('processed_date')}")
-        print(f"Original sender: {record.get('sender_email')}")
-        print(f"Original subject: {record.get('subject')}")
-        return True
+    if rule["type"] == "constant":
+        return rule["value"]
     
-    return False
+    for i, lowered in enumerate(lowered_lines):
+        position = lowered.find(rule["label"])
+        if position < 0:
+            continue
+        if rule["line_offset"] == 0:
+            rest = lines[i][position + len(rule["label"]):]
+        elif i + 1 < len(lines):
+            rest = lines[i + 1]
+        else:
+            continue
+        value = read_template_value(rest, rule["kind"])
+        if value:
+            return value
+    return None
 
-def is_email_already_sent(email_result, sent_records):
+def same_field_value(field, first, second):
+    if field in ("total_amount", "amount_due"):
+        try:
+            return float(first) == float(second)
+        except (TypeError, ValueError):
+            pass
+    return WHITESPACE_PATTERN.sub(" ", str(first)).strip().lower() == WHITESPACE_PATTERN.sub(" ", str(second)).strip().lower()
+
+def candidate_template_rules(lines, lowered_lines, field, value):
     """
-    Check if this email's results have already been sent back to the user
+    Anchor rules that reproduce value from this document: the label right before the value on
+    its line, or a label line directly above it
     """
-    email_signature = create_email_signature(email_result)
+    if value in ("", "NOT_FOUND"):
+        return []
     
-    if email_signature in sent_records:
-        record = sent_records[email_signature]
-        print(f"Email results already sent on {record.get('sent_date')}")
-        print(f"Sender: {record.get('sender_email')}")
-        print(f"Results count: {record.get('results_count')}")
-        return True
+    kind = template_value_kind(field, value)
+    candidates = []
+    for i, line in enumerate(lines):
+        if kind == "amount":
+            starts = [match.start() for match in AMOUNT_TOKEN_PATTERN.finditer(line) if same_field_value(field, clean_amount(match.group(0)), value)]
+        elif kind == "date":
+            starts = [match.start() for match in DATE_TOKEN_PATTERN.finditer(line) if parse_invoice_date(match.group(0)) == value]
+        else:
+            start = lowered_lines[i].find(value.strip().lower())
+            starts = [start] if start >= 0 else []
+        
+        for start in starts:
+            label_match = ANCHOR_LABEL_PATTERN.search(line[:start])
+            if label_match and label_match.group(1).strip():
+                rule = {"type": "anchor", "label": WHITESPACE_PATTERN.sub(" ", label_match.group(1).strip().lower()), "line_offset": 0, "kind": kind}
+            elif start == len(line) - len(line.lstrip()) and i > 0 and ANCHOR_LABEL_PATTERN.fullmatch(lines[i - 1].strip()):
+                rule = {"type": "anchor", "label": WHITESPACE_PATTERN.sub(" ", lines[i - 1].strip().lower()), "line_offset": 1, "kind": kind}
+            else:
+                continue
+            
+            # The label must lead back to this value even when it appears earlier in the document
+            if len(rule["label"]) >= 3 and rule not in candidates and same_field_value(field, apply_template_rule(lines, lowered_lines, rule) or "", value):
+                candidates.append(rule)
     
-    return False
+    return candidates
 
-def extract_attachments_from_email(bucket, email_key):
+def get_vendor_templates(bucket):
     """
-    Extract attachments from a raw email message stored by SES in S3
-    Now supports images in addition to PDFs and ZIPs
+    Get learned vendor templates, keyed by sender domain and layout fingerprint
     """
+    templates = {}
+    
     try:
-        # Download raw email from S3
-        response = s3.get_object(Bucket=bucket, Key=email_key)
-        raw_email_content = response['Body'].read()
-        
-        # Parse the raw email message
-        msg = email.message_from_bytes(raw_email_content)
-        
-        # Extract sender information - handle different email formats
-        sender_email = msg.get('From', '')
-        # Clean up sender email - extract just the email address if in format "Name <email@domain.com>"
-        if '<' in sender_email and '>' in sender_email:
-            sender_email = sender_email.split('<')[1].split('>')[0].strip()
-        
-        subject = msg.get('Subject', '')
-        message_id = msg.get('Message-ID', '')
-        date = msg.get('Date', '')
-        
-        print(f"Processing raw email from: {sender_email}")
-        print(f"Subject: {subject}")
-        print(f"Date: {date}")
-        print(f"Message-ID: {message_id}")
-        
-        attachments = []
-        
-        # Walk through all parts of the multipart email
-        for part in msg.walk():
-            # Get content disposition
-            content_disposition = str(part.get("Content-Disposition", ""))
-            content_type = part.get_content_type()
-            
-            print(f"Processing part: Content-Type: {content_type}, Content-Disposition: {content_disposition}")
-            
-            # Check if this part is an attachment
-            if "attachment" in content_disposition.lower():
-                filename = part.get_filename()
-                if filename:
-                    # Decode the attachment content
-                    content = part.get_payload(decode=True)
-                    
-                    if content:
-                        # Process PDF, ZIP, and image files
-                        if filename.lower().endswith(('.pdf', '.zip', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')):
-                            attachments.append((content, filename, content_type))
-                            print(f"Found attachment: {filename} ({len(content)} bytes, type: {content_type})")
-                        else:
-                            print(f"Skipping attachment: {filename} (unsupported file type)")
-                    else:
-                        print(f"Warning: Could not decode attachment {filename}")
-                else:
-                    print(f"Warning: Attachment found but no filename available")
-            
-            # Also check for inline files that might be attachments without explicit Content-Disposition
-            elif content_type in ['application/pdf', 'application/zip'] or content_type.startswith('image/'):
-                filename = part.get_filename()
-                if not filename:
-                    # Try to get filename from Content-Type parameters
-                    if hasattr(part, 'get_param'):
-                        filename = part.get_param('name')
-                    
-                    # Generate filename if still not found
-                    if not filename:
-                        if content_type == 'application/pdf':
-                            extension = '.pdf'
-                        elif content_type == 'application/zip':
-                            extension = '.zip'
-                        elif content_type.startswith('image/'):
-                            extension = '.jpg'  # Default image extension
-                        else:
-                            extension = '.unknown'
-                        filename = f"attachment_{len(attachments)+1}{extension}"
-                
-                content = part.get_payload(decode=True)
-                if content and filename:
-                    attachments.append((content, filename, content_type))
-                    print(f"Found inline attachment: {filename} ({len(content)} bytes, type: {content_type})")
-        
-        if not attachments:
-            print("No PDF, ZIP, or image attachments found in email")
-            # Debug: Print all parts found
-            print("All email parts found:")
-            for i, part in enumerate(msg.walk()):
-                print(f"  Part {i}: {part.get_content_type()}, disposition: {part.get('Content-Disposition', 'None')}")
-        
-        return {
-            "success": True,
-            "sender_email": sender_email,
-            "subject": subject,
-            "message_id": message_id,
-            "date": date,
-            "attachments": attachments
-        }
-        
+        response = s3.get_object(Bucket=bucket, Key="vendor_templates.json")
+        templates = json.loads(response['Body'].read().decode('utf-8')).get('templates', {})
+        print(f"Loaded {len(templates)} vendor templates")
+    except s3.exceptions.NoSuchKey:
+        print("No vendor templates file found")
     except Exception as e:
-        print(f"Error extracting attachments from {email_key}: {str(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
-        return {
-            "success": False,
-            "error": str(e),
-            "sender_email": "",
-            "subject": "",
-            "message_id": "",
-            "date": "",
-            "attachments": []
-        }
+        print(f"Error reading vendor templates file: {str(e)}")
+    
+    return templates
 
-def extract_text_from_pdf(pdf_content):
-    """Extract raw text from PDF content"""
+def save_vendor_templates(bucket, templates):
+    """
+    Persist vendor templates with their samples and hit/accuracy counters
+    """
     try:
-        reader = PdfReader(io.BytesIO(pdf_content))
-        full_text = "\n".join([page.extract_text() for page in reader.pages if page.extract_text()])
-        
-        return {
-            "success": True,
-            "text": full_text,
-            "page_count": len(reader.pages)
-        }
+        s3.put_object(
+            Bucket=bucket,
+            Key="vendor_templates.json",
+            Body=json.dumps({"templates": templates, "last_updated": datetime.utcnow().isoformat()}, indent=2).encode('utf-8'),
+            ContentType='application/json'
+        )
+        return True
     except Exception as e:
-        return {
-            "success": False,
-            "error": str(e),
-            "text": "",
-            "page_count": 0
-        }
+        print(f"Error saving vendor templates file: {str(e)}")
+        return False
 
-def process_image_with_vision(image_content, filename, api_key):
+class VendorTemplateStore:
     """
-    Process image using OpenAI Vision API to extract text
+    Learns anchor-relative extraction rules per sender domain and layout from model extractions,
+    applies them to later matching documents and spot-checks them against the model
     """
-    try:
-        # Convert image to base64
-        image_base64 = base64.b64encode(image_content).decode('utf-8')
-        
-        # Vision prompt for invoice/receipt analysis
-        prompt = """
-        Analyze this image and extract any text content, especially if it appears to be an invoice, receipt, or bill.
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_run({})
+    
+    def start_run(self, templates):
+        with self.lock:
+            self.templates = templates
+            self.changed = False
+            self.counts = {"local": 0, "partial": 0, "fallbacks": 0, "observations": 0, "spot_checks": 0, "drifts": 0}
+    
+    def template_key(self, sender_email, text):
+        if not VENDOR_TEMPLATES_ENABLED or '@' not in (sender_email or ''):
+            return None
+        fingerprint = layout_fingerprint(text)
+        return f"{sender_email.rsplit('@', 1)[1].lower()}|{fingerprint}" if fingerprint else None
+    
+    def match(self, key, text):
+        """
+        (fields, spot_check) for a document with a learned template; fields is None when there is
+        no usable template. spot_check means the model should extract it too for comparison.
+        """
+        with self.lock:
+            template = self.templates.get(key) if key else None
+            rules = dict(template["rules"]) if template and template.get("rules") else None
+        if not rules:
+            return None, False
         
-        Please extract all readable text from the image, maintaining the structure and layout as much as possible.
-        Include:
-        - All text content (handwritten or printed)
-        - Numbers, amounts, dates
-        - Company names, addresses
-        - Item descriptions
-        - Any other readable information
+        lines = text.split("\n")
+        lowered_lines = [line.lower() for line in lines]
+        fields = {}
+        for field, rule in rules.items():
+            value = apply_template_rule(lines, lowered_lines, rule)
+            if value is None:
+                # An anchor disappeared, so the layout changed; the model result will be learned from
+                with self.lock:
+                    template["fallbacks"] += 1
+                    self.counts["fallbacks"] += 1
+                    self.changed = True
+                print(f"Vendor template {key} lost its anchor for {field}, using the model")
+                return None, False
+            fields[field] = value
         
-        If this appears to be a financial document (invoice, receipt, bill), note that specifically.
+        with self.lock:
+            template["lookups"] += 1
+            spot_check = template["lookups"] % VENDOR_TEMPLATE_SPOT_CHECK_EVERY == 0
+            if not spot_check:
+                template["hits"] += 1
+                self.counts["local" if len(fields) == len(BILLING_FIELDS) else "partial"] += 1
+            self.changed = True
+        return fields, spot_check
+    
+    def observe(self, key, text, billing_info):
+        """
+        Record a model extraction as a sample and (re)derive rules once enough samples agree
+        """
+        lines = text.split("\n")
+        lowered_lines = [line.lower() for line in lines]
+        sample = {
+            "values": {field: billing_info.get(field, "") for field in BILLING_FIELDS},
+            "candidates": {field: candidate_template_rules(lines, lowered_lines, field, billing_info.get(field, "")) for field in BILLING_FIELDS}
+        }
         
-        Return the extracted text content:
+        with self.lock:
+            self.counts["observations"] += 1
+            self.changed = True
+            template = self.templates.setdefault(key, {
+                "bill_from": billing_info.get("bill_from", ""),
+                "samples": [],
+                "rules": None,
+                "lookups": 0,
+                "hits": 0,
+                "fallbacks": 0,
+                "spot_checks": 0,
+                "checked_fields": 0,
+                "matched_fields": 0,
+                "drifts": 0
+            })
+            if not same_field_value("bill_from", template["bill_from"], billing_info.get("bill_from", "")):
+                # Same sender and layout but a different vendor: start over
+                template["bill_from"] = billing_info.get("bill_from", "")
+                template["samples"] = []
+                template["rules"] = None
+            
+            template["samples"] = (template["samples"] + [sample])[-VENDOR_TEMPLATE_MIN_SAMPLES:]
+            if len(template["samples"]) >= VENDOR_TEMPLATE_MIN_SAMPLES:
+                template["rules"] = self.derive_rules(template["samples"]) or None
+                template["updated_at"] = datetime.utcnow().isoformat()
+    
+    def derive_rules(self, samples):
+        """
+        Per field, the first anchor rule every sample supports, else the value if it never changed
         """
+        rules = {}
+        for field in BILLING_FIELDS:
+            shared = [rule for rule in samples[0]["candidates"][field] if all(rule in sample["candidates"][field] for sample in samples[1:])]
+            values = [sample["values"][field] for sample in samples]
+            if shared:
+                rules[field] = shared[0]
+            elif all(same_field_value(field, value, values[0]) for value in values):
+                rules[field] = {"type": "constant", "value": values[0]}
+        return rules
+    
+    def spot_check(self, key, text, template_fields, billing_info):
+        """
+        Compare template output with a model extraction; any mismatch drops the rules and relearns
+        """
+        matched = sum(1 for field, value in template_fields.items() if same_field_value(field, value, billing_info.get(field, "")))
         
-        extracted_text = call_openai_vision_api(prompt, image_base64, api_key)
+        with self.lock:
+            template = self.templates[key]
+            template["spot_checks"] += 1
+            template["checked_fields"] += len(template_fields)
+            template["matched_fields"] += matched
+            self.counts["spot_checks"] += 1
+            self.changed = True
+            drifted = matched < len(template_fields)
+            if drifted:
+                print(f"Vendor template {key} drifted ({matched}/{len(template_fields)} fields matched), relearning")
+                template["drifts"] += 1
+                template["samples"] = []
+                template["rules"] = None
+                self.counts["drifts"] += 1
         
-        if extracted_text:
-            return {
-                "success": True,
-                "text": extracted_text,
-                "source": "vision_api"
-            }
-        else:
+        if drifted:
+            self.observe(key, text, billing_info)
+    
+    def stats(self):
+        with self.lock:
             return {
-                "success": False,
-                "error": "No text extracted from image",
-                "text": "",
-                "source": "vision_api"
+                **self.counts,
+                "templates": len(self.templates),
+                "learned": sum(1 for template in self.templates.values() if template.get("rules")),
+                "per_template": {
+                    key: {
+                        "bill_from": template["bill_from"],
+                        "learned_fields": len(template.get("rules") or {}),
+                        "hit_rate": round(template["hits"] / (template["lookups"] + template["fallbacks"]), 3) if template["lookups"] + template["fallbacks"] else 0.0,
+                        "accuracy": round(template["matched_fields"] / template["checked_fields"], 3) if template["checked_fields"] else None
+                    }
+                    for key, template in self.templates.items()
+                    if template.get("rules") or template["lookups"]
+                }
             }
-            
-    except Exception as e:
-        print(f"Error processing image {filename} with Vision API: {str(e)}")
-        return {
-            "success": False,
-            "error": str(e),
-            "text": "",
-            "source": "vision_api"
-        }
 
-def check_document_type(text, api_key):
+vendor_templates = VendorTemplateStore()
+
+def analyze_document_text(text, api_key, pages=None, producer="", sender_email=""):
     """
-    Check if the document is a bill/invoice or something else.
-    More lenient classification to catch all types of invoices.
+    Classify document text and extract billing information using the configured EXTRACTION_MODE.
+    The text is first compacted and fitted into DOCUMENT_TOKEN_BUDGET using the positioned PDF lines in pages,
+    and the local pre-classifier (which also checks the PDF producer) can skip the classification call.
+    Recurring layouts from the same sender are extracted with their learned vendor template.
+    Returns (classification, billing_info); billing_info is None for non-invoices.
     """
-    prompt = f"""
-    You are a document classifier. Analyze the following document text and determine if it is:
-    1. A BILL/INVOICE - ANY document that shows amounts to be paid, charges, fees, costs, or financial obligations
-    2. OTHER - clearly non-financial documents like contracts, reports, manuals, etc.
-    
-    BILL/INVOICE includes (be very inclusive):
-    - Traditional invoices with invoice numbers and line items
-    - Bills (utility, phone, internet, etc.)
-    - Statements with charges or amounts due (even if called "statement")
-    - AWS bills, cloud service bills, subscription bills
-    - Tax bills, government fees, penalty notices
-    - Service charges, professional service bills
-    - Receipts with amounts paid or due
-    - ANY financial document showing money owed or charges
-    - Handwritten receipts or bills from local markets/vendors
+    text = prepare_document_text(text, pages)
+    template_key = vendor_templates.template_key(sender_email, text)
+    template_fields, spot_check = vendor_templates.match(template_key, text)
     
-    IMPORTANT CLASSIFICATION RULES:
-    - If you see ANY dollar amounts, fees, charges, or costs → BILL_INVOICE
-    - If you see terms like "amount due", "total", "charges", "bill", "invoice" → BILL_INVOICE
-    - If you see vendor/company names with amounts → BILL_INVOICE
-    - If you see dates with financial amounts → BILL_INVOICE
-    - Only classify as OTHER if it's clearly non-financial (contracts, manuals, reports with no charges)
-    - When in doubt, classify as BILL_INVOICE (better to process than skip)
+    if template_fields is not None and not spot_check:
+        doc_classification = {"document_type": "BILL_INVOICE", "confidence": "HIGH", "reason": "Matched a learned vendor template"}
+        if len(template_fields) == len(BILLING_FIELDS):
+            return doc_classification, {field: template_fields[field] for field in BILLING_FIELDS}
+        return doc_classification, extract_billing_info_with_gpt(text, api_key, template_fields)
     
-    Return ONLY a JSON object with these keys:
-    - document_type: "BILL_INVOICE" or "OTHER" 
-    - confidence: "HIGH", "MEDIUM", or "LOW"
-    - reason: Brief explanation for the classification
+    doc_classification = preclassify_document(text, producer)
     
-    Document text (first 2000 characters):
-    {text[:2000]}
-    """
+    if doc_classification is not None:
+        billing_info = None
+        if doc_classification["document_type"] == "BILL_INVOICE":
+            billing_info = extract_billing_info_with_gpt(text, api_key)
+    elif EXTRACTION_MODE == 'combined':
+        doc_classification, billing_info = classify_and_extract_with_gpt(text, api_key)
+    else:
+        doc_classification = check_document_type(text, api_key)
+        billing_info = None
+        if doc_classification["document_type"] == "BILL_INVOICE":
+            billing_info = extract_billing_info_with_gpt(text, api_key)
     
-    function_definition = {
-        "name": "ClassifyDocument",
-        "description": "Classify document type",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "document_type": {
-                    "type": "string",
-                    "enum": ["BILL_INVOICE", "OTHER"],
-                    "description": "Type of document"
-                },
-                "confidence": {
-                    "type": "string",
-                    "enum": ["HIGH", "MEDIUM", "LOW"],
-                    "description": "Confidence level"
-                },
-                "reason": {
-                    "type": "string",
-                    "description": "Brief explanation"
-                }
-            },
-            "required": ["document_type", "confidence", "reason"]
-        }
-    }
+    if doc_classification["document_type"] != "BILL_INVOICE":
+        return doc_classification, None
     
-    result = call_openai_api(prompt, api_key, function_definition)
+    if template_key and "API_ERROR" not in billing_info.values() and doc_classification["confidence"] != "LOW":
+        if spot_check:
+            vendor_templates.spot_check(template_key, text, template_fields, billing_info)
+        else:
+            vendor_templates.observe(template_key, text, billing_info)
     
-    if not result:
-        # Default to BILL_INVOICE if API fails - better to process than skip
-        return {"document_type": "BILL_INVOICE", "confidence": "LOW", "reason": "API call failed - defaulting to process"}
+    return doc_classification, billing_info
+
+def status_row(filename, status, marker, status_note=None):
+    """
+    Result row with every billing field set to the same marker (ERROR, NO_TEXT, NOT_INVOICE, ...)
+    status_note, when given, is appended to the status column of the CSV
+    """
+    row = {
+        "filename": filename,
+        "status": status,
+        **{field: marker for field in BILLING_FIELDS}
+    }
+    if status_note:
+        row["status_note"] = status_note
+    return row
+
+def build_result_row(filename, doc_classification, billing_info, status_note=None):
+    """
+    Result row for an analysed document: NOT_INVOICE for non-invoices, otherwise the billing fields
+    """
+    if doc_classification["document_type"] != "BILL_INVOICE":
+        return status_row(filename, "skipped", "NOT_INVOICE", status_note)
     
-    return result
+    row = {
+        "filename": filename,
+        "status": "success",
+        **billing_info
+    }
+    if status_note:
+        row["status_note"] = status_note
+    return row
+
+# Pipeline concurrency settings (1 = fully sequential processing)
+PIPELINE_CONCURRENCY = max(1, int(os.environ.get('PIPELINE_CONCURRENCY', '4')))
+
+# Global cap on documents being processed at once, across emails, attachments and ZIP members
+_pipeline_slots = threading.BoundedSemaphore(PIPELINE_CONCURRENCY)
 
-def extract_billing_info_with_gpt(text, api_key):
+def run_in_parallel(func, items):
     """
-    Extracts billing information from PDF text using GPT.
-    Updated with more flexible PO number detection, better field names, and items list.
+    Apply func to every item, fanning out over a thread pool when concurrency is enabled.
+    Results always come back in the same order as items.
     """
-    prompt = f"""
-    You are a professional invoice analyzer. Extract the following information from this invoice text:
-    1. PO number - Look for ANY number that appears after "PO", "P.O.", "Purchase Order", "PO#", "PO:", "PO-", etc. Can be any length (3-10 digits). If no PO number is found, return "NOT_FOUND"
-    2. Bill To (company/person the invoice is billed to)
-    3. Bill From (company/vendor issuing the invoice)
-    4. Total Amount (final total amount on the invoice - return ONLY the numeric value without currency symbols)
-    5. Amount Due (amount that needs to be paid - return ONLY the numeric value without currency symbols)
-    6. Currency (currency code like USD, INR, EUR, etc.)
-    7. Bill ID/Invoice number
-    8. Bill Date (invoice date in format YYYY-MM-DD)
-    9. Items/Services (list of products, services, or items purchased - comma separated)
-    
-    FLEXIBLE PO NUMBER RULES:
-    - Look for patterns like: "PO: 124555", "P.O. 124555", "Purchase Order 124555", "PO-124555", "PO# 124555"
-    - Can be 3-10 digits long
-    - Can start with any digit (not just 2 or 3)
-    - Examples of VALID patterns: "PO-124555", "PO: 20001", "Purchase Order 987654", "P.O.# 12345"
-    - If multiple PO numbers found, pick the most prominent/first one
-    - If no PO reference found at all, set to "NOT_FOUND"
-    
-    AMOUNT RULES:
-    - Total Amount: Look for "Total", "Grand Total", "Amount", "Invoice Total" - return only numbers (e.g., "1234.56")
-    - Amount Due: Look for "Amount Due", "Balance Due", "Due", "Pay This Amount" - return only numbers (e.g., "1234.56")
-    - Remove all currency symbols, commas, and special characters from amounts
-    
-    CURRENCY RULES:
-    - Extract currency separately (USD, INR, EUR, GBP, etc.)
-    - Look for currency symbols ($, ₹, €, £) or currency codes
-    
-    ITEMS/SERVICES RULES:
-    - List all products, services, subscriptions, or items mentioned in the invoice
-    - Include descriptions, product names, service types
-    - Separate multiple items with commas
-    - Examples: "Web Hosting Service, Domain Registration" or "Electricity Bill, Service Charges"
+    items = list(items)
     
-    Return ONLY a JSON object with these keys: po_number, bill_to, bill_from, total_amount, amount_due, currency, bill_id, bill_date, items_services
+    if PIPELINE_CONCURRENCY <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
     
-    Here's the invoice text:
-    {text}
+    with ThreadPoolExecutor(max_workers=min(len(items), PIPELINE_CONCURRENCY)) as executor:
+        return list(executor.map(func, items))
+
+def process_zip_member(file_data, file_name, openai_api_key, sender_email=""):
     """
-    
-    function_definition = {
-        "name": "ExtractInvoiceData",
-        "description": "Extract structured data from invoice text",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "po_number": {
-                    "type": "string",
-                    "description": "Purchase Order number - any number found after PO/Purchase Order references"
-                },
-                "bill_to": {
-                    "type": "string",
-                    "description": "Company or person the invoice is billed to"
-                },
-                "bill_from": {
-                    "type": "string",
-                    "description": "Company or vendor issuing the invoice"
-                },
-                "total_amount": {
-                    "type": "string",
-                    "description": "Total amount on the invoice - numbers only, no currency symbols"
-                },
-                "amount_due": {
-                    "type": "string",
-                    "description": "Amount due to be paid - numbers only, no currency symbols"
-                },
-                "currency": {
-                    "type": "string",
-                    "description": "Currency code (USD, INR, EUR, etc.)"
-                },
-                "bill_id": {
-                    "type": "string",
-                    "description": "Invoice number or ID"
-                },
-                "bill_date": {
-                    "type": "string",
-                    "description": "Date of the invoice in format YYYY-MM-DD"
-                },
-                "items_services": {
-                    "type": "string",
-                    "description": "Comma-separated list of items, products, or services purchased"
-                }
-            },
-            "required": ["po_number", "bill_to", "bill_from", "total_amount", "amount_due", "currency", "bill_id", "bill_date", "items_services"]
-        }
-    }
-    
-    result = call_openai_api(prompt, api_key, function_definition)
-    
-    if not result:
-        return {
-            "po_number": "API_ERROR",
-            "bill_to": "API_ERROR",
-            "bill_from": "API_ERROR",
-            "total_amount": "API_ERROR",
-            "amount_due": "API_ERROR",
-            "currency": "API_ERROR",
-            "bill_id": "API_ERROR",
-            "bill_date": "API_ERROR",
-            "items_services": "API_ERROR"
-        }
-    
-    # Clean up amounts and ensure proper formatting
-    if 'total_amount' in result:
-        result['total_amount'] = clean_amount(result['total_amount'])
-    if 'amount_due' in result:
-        result['amount_due'] = clean_amount(result['amount_due'])
-    
-    return result
+    Process a single file extracted from a ZIP archive
+    Returns None if the file is not a valid PDF or image
+    """
+    try:
+        if isinstance(file_data, Exception):
+            raise file_data
+        
+        if file_name.lower().endswith('.pdf') and file_data.startswith(b'%PDF'):
+            with _pipeline_slots:
+                result = process_single_pdf(file_data, file_name, openai_api_key, sender_email)
+            print(f"Successfully processed PDF from ZIP: {file_name}")
+            return result
+        elif file_name.lower().endswith(IMAGE_EXTENSIONS):
+            with _pipeline_slots:
+                result = process_single_image(file_data, file_name, openai_api_key, sender_email)
+            print(f"Successfully processed image from ZIP: {file_name}")
+            return result
+        else:
+            print(f"Skipped {file_name} - not a valid PDF or image")
+            return None
+    except CircuitOpenError:
+        # The whole email is deferred, so no error row for this member
+        raise
+    except Exception as e:
+        print(f"Error extracting {file_name}: {str(e)}")
+        return status_row(file_name, "error", "ERROR")
 
-def process_attachment(attachment_content, filename, openai_api_key):
+def process_attachment(attachment_content, filename, openai_api_key, sender_email=""):
     """
     Process a single attachment (PDF, ZIP, or image file)
     No duplicate checking - treat every request as fresh
+    sender_email selects the vendor templates that may apply
+    ZIP members are processed concurrently, results keep the archive order
+    Raises CircuitOpenError when OpenAI is unavailable so the email can be deferred
     """
     processed_results = []
     
@@ -768,67 +4217,44 @@ def process_attachment(attachment_content, filename, openai_api_key):
                 file_list = zip_file.namelist()
                 print(f"Files in ZIP {filename}: {file_list}")
                 
+                members = []
                 for file_name in file_list:
-                    if file_name.lower().endswith(('.pdf', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')) and not file_name.startswith('__MACOSX/'):
+                    if file_name.lower().endswith(('.pdf',) + IMAGE_EXTENSIONS) and not file_name.startswith('__MACOSX/'):
                         print(f"Processing file from ZIP: {file_name}")
                         try:
-                            file_data = zip_file.read(file_name)
-                            if file_name.lower().endswith('.pdf') and file_data.startswith(b'%PDF'):
-                                result = process_single_pdf(file_data, file_name, openai_api_key)
-                                processed_results.append(result)
-                                print(f"Successfully processed PDF from ZIP: {file_name}")
-                            elif file_name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')):
-                                result = process_single_image(file_data, file_name, openai_api_key)
-                                processed_results.append(result)
-                                print(f"Successfully processed image from ZIP: {file_name}")
-                            else:
-                                print(f"Skipped {file_name} - not a valid PDF or image")
+                            members.append((zip_file.read(file_name), file_name))
                         except Exception as e:
-                            print(f"Error extracting {file_name}: {str(e)}")
-                            processed_results.append({
-                                "filename": file_name,
-                                "status": "error",
-                                "po_number": "ERROR",
-                                "bill_to": "ERROR",
-                                "bill_from": "ERROR",
-                                "total_amount": "ERROR",
-                                "amount_due": "ERROR",
-                                "currency": "ERROR",
-                                "bill_id": "ERROR",
-                                "bill_date": "ERROR",
-                                "items_services": "ERROR"
-                            })
+                            # Reported as an error row by process_zip_member
+                            members.append((e, file_name))
+            
+            member_results = run_in_parallel(
+                lambda member: process_zip_member(member[0], member[1], openai_api_key, sender_email),
+                members
+            )
+            processed_results.extend(result for result in member_results if result is not None)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Error processing ZIP file {filename}: {str(e)}")
-            processed_results.append({
-                "filename": filename,
-                "status": "error",
-                "po_number": "ZIP_ERROR",
-                "bill_to": "ZIP_ERROR",
-                "bill_from": "ZIP_ERROR",
-                "total_amount": "ZIP_ERROR",
-                "amount_due": "ZIP_ERROR",
-                "currency": "ZIP_ERROR",
-                "bill_id": "ZIP_ERROR",
-                "bill_date": "ZIP_ERROR",
-                "items_services": "ZIP_ERROR"
-            })
+            processed_results.append(status_row(filename, "error", "ZIP_ERROR"))
     
     elif filename.lower().endswith('.pdf'):
         # Process single PDF file
         print(f"Processing PDF: {filename}")
-        result = process_single_pdf(attachment_content, filename, openai_api_key)
+        with _pipeline_slots:
+            result = process_single_pdf(attachment_content, filename, openai_api_key, sender_email)
         processed_results.append(result)
     
-    elif filename.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')):
+    elif filename.lower().endswith(IMAGE_EXTENSIONS):
         # Process single image file
         print(f"Processing image: {filename}")
-        result = process_single_image(attachment_content, filename, openai_api_key)
+        with _pipeline_slots:
+            result = process_single_image(attachment_content, filename, openai_api_key, sender_email)
         processed_results.append(result)
     
     return processed_results
 
-def process_single_pdf(pdf_content, filename, openai_api_key):
+def process_single_pdf(pdf_content, filename, openai_api_key, sender_email=""):
     """
     Process a single PDF file and extract invoice data
     Updated with new field names including items_services
@@ -839,139 +4265,77 @@ def process_single_pdf(pdf_content, filename, openai_api_key):
     text_result = extract_text_from_pdf(pdf_content)
     
     if not text_result["success"]:
-        return {
-            "filename": filename,
-            "status": "error",
-            "po_number": "ERROR",
-            "bill_to": "ERROR",
-            "bill_from": "ERROR",
-            "total_amount": "ERROR",
-            "amount_due": "ERROR",
-            "currency": "ERROR",
-            "bill_id": "ERROR",
-            "bill_date": "ERROR",
-            "items_services": "ERROR"
-        }
+        return status_row(filename, "error", "ERROR")
     
     extracted_text = text_result["text"]
+    pages = text_result.get("pages")
+    text_quality = score_text_quality(extracted_text)
+    status_note = f"text quality {text_quality:.2f}"
     
-    if not extracted_text.strip():
-        return {
-            "filename": filename,
-            "status": "error",
-            "po_number": "NO_TEXT",
-            "bill_to": "NO_TEXT",
-            "bill_from": "NO_TEXT",
-            "total_amount": "NO_TEXT",
-            "amount_due": "NO_TEXT",
-            "currency": "NO_TEXT",
-            "bill_id": "NO_TEXT",
-            "bill_date": "NO_TEXT",
-            "items_services": "NO_TEXT"
-        }
-    
-    # Check document type
-    doc_classification = check_document_type(extracted_text, openai_api_key)
-    
-    if doc_classification["document_type"] != "BILL_INVOICE":
-        return {
-            "filename": filename,
-            "status": "skipped",
-            "po_number": "NOT_INVOICE",
-            "bill_to": "NOT_INVOICE",
-            "bill_from": "NOT_INVOICE",
-            "total_amount": "NOT_INVOICE",
-            "amount_due": "NOT_INVOICE",
-            "currency": "NOT_INVOICE",
-            "bill_id": "NOT_INVOICE",
-            "bill_date": "NOT_INVOICE",
-            "items_services": "NOT_INVOICE"
-        }
+    if text_quality < TEXT_QUALITY_MIN_SCORE and SCANNED_PDF_FALLBACK_ENABLED:
+        if extracted_text.strip():
+            print(f"Text layer of {filename} looks broken (quality {text_quality:.2f}), reading its page images instead")
+        else:
+            print(f"No text layer in {filename}, reading its page images instead")
+        image_result = extract_text_from_scanned_pdf(pdf_content, filename, openai_api_key)
+        image_text = image_result["text"]
+        if image_text.strip():
+            # Only trust the images over the text layer when they are the pages themselves or read
+            # better; a transcribed logo or stamp must not replace a merely mediocre text layer
+            image_quality = score_text_quality(image_text)
+            if not extracted_text.strip() or image_result.get("full_page_images") or image_quality > text_quality:
+                extracted_text, pages = image_text, None
+                status_note += f", read from page images at quality {image_quality:.2f}"
+            else:
+                print(f"Page images of {filename} read worse than its text layer ({image_quality:.2f}), keeping the text layer")
+                status_note += f", kept over page images at quality {image_quality:.2f}"
     
-    # Extract billing information
-    billing_info = extract_billing_info_with_gpt(extracted_text, openai_api_key)
+    if not extracted_text.strip():
+        return status_row(filename, "error", "NO_TEXT", status_note)
     
-    result = {
-        "filename": filename,
-        "status": "success",
-        **billing_info
-    }
+    # Check document type and extract billing information
+    doc_classification, billing_info = analyze_document_text(extracted_text, openai_api_key, pages, text_result.get("producer", ""), sender_email)
     
     print(f"Successfully processed PDF: {filename}")
-    return result
+    return build_result_row(filename, doc_classification, billing_info, status_note)
 
-def process_single_image(image_content, filename, openai_api_key):
+def process_single_image(image_content, filename, openai_api_key, sender_email=""):
     """
     Process a single image file and extract invoice data using Vision API
+    In the direct IMAGE_EXTRACTION_MODE this is one vision call; otherwise the transcript is analysed like PDF text
     """
     print(f"Processing image: {filename}")
     
+    if IMAGE_EXTRACTION_MODE == 'direct':
+        try:
+            doc_classification, billing_info = classify_and_extract_image(image_content, filename, openai_api_key)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            print(f"Error processing image {filename} with Vision API: {str(e)}")
+            return status_row(filename, "error", "ERROR")
+        
+        print(f"Successfully processed image: {filename}")
+        return build_result_row(filename, doc_classification, billing_info)
+    
     # Extract text from image using Vision API
     text_result = process_image_with_vision(image_content, filename, openai_api_key)
     
     if not text_result["success"]:
-        return {
-            "filename": filename,
-            "status": "error",
-            "po_number": "ERROR",
-            "bill_to": "ERROR",
-            "bill_from": "ERROR",
-            "total_amount": "ERROR",
-            "amount_due": "ERROR",
-            "currency": "ERROR",
-            "bill_id": "ERROR",
-            "bill_date": "ERROR",
-            "items_services": "ERROR"
-        }
+        return status_row(filename, "error", "ERROR")
     
     extracted_text = text_result["text"]
     
     if not extracted_text.strip():
-        return {
-            "filename": filename,
-            "status": "error",
-            "po_number": "NO_TEXT",
-            "bill_to": "NO_TEXT",
-            "bill_from": "NO_TEXT",
-            "total_amount": "NO_TEXT",
-            "amount_due": "NO_TEXT",
-            "currency": "NO_TEXT",
-            "bill_id": "NO_TEXT",
-            "bill_date": "NO_TEXT",
-            "items_services": "NO_TEXT"
-        }
+        return status_row(filename, "error", "NO_TEXT")
     
     print(f"Extracted text from image {filename}: {extracted_text[:200]}...")
     
-    # Check document type
-    doc_classification = check_document_type(extracted_text, openai_api_key)
-    
-    if doc_classification["document_type"] != "BILL_INVOICE":
-        return {
-            "filename": filename,
-            "status": "skipped",
-            "po_number": "NOT_INVOICE",
-            "bill_to": "NOT_INVOICE",
-            "bill_from": "NOT_INVOICE",
-            "total_amount": "NOT_INVOICE",
-            "amount_due": "NOT_INVOICE",
-            "currency": "NOT_INVOICE",
-            "bill_id": "NOT_INVOICE",
-            "bill_date": "NOT_INVOICE",
-            "items_services": "NOT_INVOICE"
-        }
-    
-    # Extract billing information
-    billing_info = extract_billing_info_with_gpt(extracted_text, openai_api_key)
-    
-    result = {
-        "filename": filename,
-        "status": "success",
-        **billing_info
-    }
+    # Check document type and extract billing information
+    doc_classification, billing_info = analyze_document_text(extracted_text, openai_api_key, sender_email=sender_email)
     
     print(f"Successfully processed image: {filename}")
-    return result
+    return build_result_row(filename, doc_classification, billing_info)
 
 def create_csv_from_results(all_results, bucket, output_key):
     """
@@ -1001,6 +4365,10 @@ def create_csv_from_results(all_results, bucket, output_key):
         row = {}
         for header in headers:
             row[header] = result.get(header, "")
+        # Notes like the text quality score go in the status column; result["status"] itself stays
+        # success/error/skipped for the summary counts
+        if result.get("status_note"):
+            row["status"] = f"{row['status']} ({result['status_note']})"
         writer.writerow(row)
     
     csv_content = csv_buffer.getvalue()
@@ -1051,7 +4419,7 @@ Please ensure that:
 Supported file types:
 - PDF files (.pdf)
 - ZIP files (.zip) containing PDFs or images
-- Image files (.jpg, .jpeg, .png, .bmp, .tiff, .webp)
+- Image files (.jpg, .jpeg, .png, .bmp, .tiff, .tif, .webp)
 
 If you need assistance, please reply to this email.
 
@@ -1150,6 +4518,530 @@ Invoice Processing System
         print(f"Error sending email to {sender_email}: {str(e)}")
         return False
 
+# Batch API processing mode for backlogs that are not urgent
+PROCESSING_MODE = os.environ.get('PROCESSING_MODE', 'sync').lower()
+BATCH_BACKEND = os.environ.get('BATCH_BACKEND', 'openai').lower()
+BATCH_COMPLETION_WINDOW = os.environ.get('BATCH_COMPLETION_WINDOW', '24h')
+BATCH_LOCAL_DIR = os.environ.get('BATCH_LOCAL_DIR', '/tmp/local_batches')
+
+class OpenAIBatchBackend:
+    """
+    Client for the OpenAI Files and Batches endpoints (same calls as the vendored
+    openai/resources/files.py and batches.py) over the shared connection pool
+    """
+    
+    def __init__(self, api_key):
+        self.api_key = api_key
+    
+    def _request(self, method, path, **kwargs):
+        response = get_openai_http_client().request(
+            method,
+            path,
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            **kwargs
+        )
+        response.raise_for_status()
+        return response
+    
+    def upload_file(self, content, filename):
+        response = self._request(
+            'POST',
+            '/files',
+            data={"purpose": "batch"},
+            files={"file": (filename, content, "application/jsonl")}
+        )
+        return response.json()["id"]
+    
+    def create_batch(self, input_file_id, metadata):
+        response = self._request(
+            'POST',
+            '/batches',
+            json={
+                "input_file_id": input_file_id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": BATCH_COMPLETION_WINDOW,
+                "metadata": metadata
+            }
+        )
+        return response.json()
+    
+    def retrieve_batch(self, batch_id):
+        return self._request('GET', f'/batches/{batch_id}').json()
+    
+    def download_file(self, file_id):
+        return self._request('GET', f'/files/{file_id}/content').content
+
+def local_batch_responder(body):
+    """
+    Deterministic offline answer to a batched chat completion request:
+    fills the forced tool call's required fields with placeholder values
+    """
+    function = body["tools"][0]["function"]
+    parameters = function["parameters"]
+    
+    arguments = {}
+    for name in parameters.get("required", []):
+        prop = parameters["properties"].get(name, {})
+        arguments[name] = prop["enum"][0] if prop.get("enum") else "NOT_FOUND"
+    
+    return {
+        "object": "chat.completion",
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": "call_local",
+                    "type": "function",
+                    "function": {"name": function["name"], "arguments": json.dumps(arguments)}
+                }]
+            },
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+class LocalBatchBackend:
+    """
+    Offline stand-in for the OpenAI Batches endpoint used to test submit/poll/reconcile.
+    Files and batch records live under a local directory; a batch completes on its
+    first poll, with every request answered by the responder function.
+    """
+    
+    def __init__(self, directory, responder=local_batch_responder):
+        self.directory = directory
+        self.responder = responder
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def _save_batch(self, batch):
+        with open(self._path(f"{batch['id']}.json"), 'w') as f:
+            json.dump(batch, f)
+    
+    def upload_file(self, content, filename):
+        file_id = f"file-local-{hashlib.sha256(content).hexdigest()[:24]}"
+        with open(self._path(file_id), 'wb') as f:
+            f.write(content)
+        return file_id
+    
+    def create_batch(self, input_file_id, metadata):
+        batch = {
+            "id": f"batch_local_{hashlib.sha256(f'{input_file_id}{time.time()}'.encode()).hexdigest()[:24]}",
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "input_file_id": input_file_id,
+            "completion_window": BATCH_COMPLETION_WINDOW,
+            "status": "validating",
+            "metadata": metadata,
+            "created_at": int(time.time())
+        }
+        self._save_batch(batch)
+        return batch
+    
+    def retrieve_batch(self, batch_id):
+        with open(self._path(f"{batch_id}.json")) as f:
+            batch = json.load(f)
+        
+        if batch["status"] != "completed":
+            output_lines = []
+            for line in self.download_file(batch["input_file_id"]).decode('utf-8').splitlines():
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                output_lines.append(json.dumps({
+                    "id": f"batch_req_{request['custom_id']}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": self.responder(request["body"])},
+                    "error": None
+                }))
+            
+            batch["output_file_id"] = self.upload_file(("\n".join(output_lines) + "\n").encode('utf-8'), "output.jsonl")
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+            self._save_batch(batch)
+        
+        return batch
+    
+    def download_file(self, file_id):
+        with open(self._path(file_id), 'rb') as f:
+            return f.read()
+
+def get_batch_backend(api_key):
+    """
+    Batch backend selected by BATCH_BACKEND ("openai" or the offline "local" stand-in)
+    """
+    if BATCH_BACKEND == 'local':
+        return LocalBatchBackend(BATCH_LOCAL_DIR)
+    return OpenAIBatchBackend(api_key)
+
+def get_batch_jobs(bucket):
+    """
+    Get submitted batches that have not been reconciled yet
+    """
+    batch_jobs = {}
+    tracking_key = "batch_jobs_tracking.json"
+    
+    try:
+        response = s3.get_object(Bucket=bucket, Key=tracking_key)
+        tracking_data = json.loads(response['Body'].read().decode('utf-8'))
+        batch_jobs = tracking_data.get('batch_jobs', {})
+        print(f"Found {len(batch_jobs)} pending OpenAI batches")
+        
+    except s3.exceptions.NoSuchKey:
+        print("No batch tracking file found")
+    except Exception as e:
+        print(f"Error reading batch tracking file: {str(e)}")
+    
+    return batch_jobs
+
+def save_batch_jobs(bucket, batch_jobs):
+    """
+    Persist the pending batches so a later invocation can poll and reconcile them
+    """
+    try:
+        tracking_data = {
+            "batch_jobs": batch_jobs,
+            "last_updated": datetime.utcnow().isoformat(),
+            "total_pending": len(batch_jobs)
+        }
+        
+        s3.put_object(
+            Bucket=bucket,
+            Key="batch_jobs_tracking.json",
+            Body=json.dumps(tracking_data, indent=2).encode('utf-8'),
+            ContentType='application/json'
+        )
+        return True
+        
+    except Exception as e:
+        print(f"Error saving batch tracking file: {str(e)}")
+        return False
+
+def get_batch_pending_signatures(batch_jobs):
+    """
+    Signatures of emails waiting on a submitted batch
+    """
+    return {
+        email_info["email_signature"]
+        for job in batch_jobs.values()
+        for email_info in job.get("emails", [])
+    }
+
+def prepare_batch_documents(attachments):
+    """
+    Expand an email's attachments (including ZIP members) into batch documents, in processing order.
+    Each document carries either a chat completion request body or an already final result row.
+    """
+    documents = []
+    
+    def add_document(file_data, file_name):
+        if file_name.lower().endswith('.pdf'):
+            text_result = extract_text_from_pdf(file_data)
+            if not text_result["success"]:
+                documents.append({"filename": file_name, "result": status_row(file_name, "error", "ERROR")})
+                return
+            
+            text = text_result["text"]
+            if score_text_quality(text) < TEXT_QUALITY_MIN_SCORE and SCANNED_PDF_FALLBACK_ENABLED:
+                # Scans go the same way as image attachments; without the comparison the synchronous
+                # path makes, a text layer is only replaced when every page is a full-page scan
+                try:
+                    page_images, full_page_images = read_scanned_pdf_pages(file_data)
+                except Exception as e:
+                    print(f"Could not read the page images of {file_name}: {str(e)}")
+                    page_images, full_page_images = [], False
+                if page_images and (full_page_images or not text.strip()):
+                    print(f"Reading {file_name} from its {len(page_images)} page images")
+                    add_vision_document(file_name, lambda: page_images)
+                    return
+            
+            if not text.strip():
+                documents.append({"filename": file_name, "result": status_row(file_name, "error", "NO_TEXT")})
+                return
+            
+            text = prepare_document_text(text, text_result.get("pages"))
+            
+            # Clear non-invoices never need a request; invoices still go through the combined call
+            if (preclassify_document(text, text_result.get("producer", "")) or {}).get("document_type") == "OTHER":
+                documents.append({"filename": file_name, "result": status_row(file_name, "skipped", "NOT_INVOICE")})
+                return
+            
+            # Documents already analysed by an earlier run or batch never need another request
+            cache_key = classify_extract_cache_key(text)
+            cached = stage_cache.get("classify_extract", cache_key)
+            if cached is not None:
+                documents.append({"filename": file_name, "result": build_result_row(file_name, *parse_classify_extract_result(cached))})
+                return
+            
+            documents.append({
+                "filename": file_name,
+                "cache_key": cache_key,
+                "body": build_tool_payload(build_classify_extract_prompt(text), CLASSIFY_EXTRACT_FUNCTION, max_tokens=estimate_output_tokens(text))
+            })
+        
+        elif file_name.lower().endswith(IMAGE_EXTENSIONS):
+            add_vision_document(file_name, lambda: split_image_pages(file_data))
+    
+    def add_vision_document(file_name, read_pages):
+        try:
+            # A batch can't escalate, so images go straight to the highest detail level
+            images = [preprocess_image(page, VISION_DETAIL_LADDER[-1]) for page in read_pages()]
+        except Exception as e:
+            print(f"Error preparing image {file_name}: {str(e)}")
+            documents.append({"filename": file_name, "result": status_row(file_name, "error", "ERROR")})
+            return
+        
+        documents.append({
+            "filename": file_name,
+            "body": build_vision_tool_payload(
+                build_image_classify_extract_prompt(),
+                [image_data_url(image, mime_type) for image, mime_type in images],
+                IMAGE_CLASSIFY_EXTRACT_FUNCTION,
+                VISION_DETAIL_LADDER[-1]
+            )
+        })
+    
+    for attachment_content, filename, content_type in attachments:
+        if not filename.lower().endswith('.zip'):
+            add_document(attachment_content, filename)
+            continue
+        
+        try:
+            with zipfile.ZipFile(io.BytesIO(attachment_content), 'r') as zip_file:
+                for file_name in zip_file.namelist():
+                    if not file_name.lower().endswith(('.pdf',) + IMAGE_EXTENSIONS) or file_name.startswith('__MACOSX/'):
+                        continue
+                    try:
+                        file_data = zip_file.read(file_name)
+                        if file_name.lower().endswith('.pdf') and not file_data.startswith(b'%PDF'):
+                            print(f"Skipped {file_name} - not a valid PDF or image")
+                            continue
+                        add_document(file_data, file_name)
+                    except Exception as e:
+                        print(f"Error extracting {file_name}: {str(e)}")
+                        documents.append({"filename": file_name, "result": status_row(file_name, "error", "ERROR")})
+        except Exception as e:
+            print(f"Error processing ZIP file {filename}: {str(e)}")
+            documents.append({"filename": filename, "result": status_row(filename, "error", "ZIP_ERROR")})
+    
+    return documents
+
+def submit_invoice_batch(backend, emails):
+    """
+    Write every pending request of the given emails into a JSONL file and submit it as one batch.
+    Request bodies are dropped from the documents so only the reconciliation data gets persisted.
+    """
+    lines = []
+    for email_info in emails:
+        for document in email_info["documents"]:
+            if "body" in document:
+                lines.append(json.dumps({
+                    "custom_id": document["custom_id"],
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": document.pop("body")
+                }))
+    
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    input_file_id = backend.upload_file(("\n".join(lines) + "\n").encode('utf-8'), f"invoice_batch_{timestamp}.jsonl")
+    batch = backend.create_batch(input_file_id, {"source": "invoice_processing"})
+    
+    print(f"Submitted batch {batch['id']} with {len(lines)} requests (input file {input_file_id})")
+    return batch
+
+def reconcile_batch_output(backend, batch, job):
+    """
+    Download a finished batch and map each response back to its email attachment.
+    Sets email_info["results"] for every email in the job, rows in attachment order.
+    """
+    responses = {}
+    for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+        if not file_id:
+            continue
+        for line in backend.download_file(file_id).decode('utf-8').splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                responses[entry["custom_id"]] = entry
+    
+    for email_info in job["emails"]:
+        results = []
+        
+        for document in email_info["documents"]:
+            if "result" in document:
+                results.append(document["result"])
+                continue
+            
+            entry = responses.get(document["custom_id"], {})
+            response = entry.get("response") or {}
+            arguments = {}
+            if response.get("status_code") == 200:
+                arguments = parse_tool_call_arguments(response.get("body") or {})
+            
+            if arguments:
+                if document.get("cache_key"):
+                    stage_cache.put("classify_extract", document["cache_key"], arguments)
+                results.append(build_result_row(document["filename"], *parse_classify_extract_result(arguments)))
+            else:
+                print(f"No batch result for {document['filename']} ({document['custom_id']}): {entry.get('error') or response.get('status_code')}")
+                # Same outcome as a failed synchronous call: processed as an invoice with API_ERROR fields
+                results.append({"filename": document["filename"], "status": "success", **api_error_billing_info()})
+        
+        email_info["results"] = results
+
+def deliver_batch_email_results(bucket, email_info):
+    """
+    Mark a reconciled email as processed and send its CSV if that has not happened yet
+    """
+    email_result = email_info["email_result"]
+    results = email_info["results"]
+    
+    if not email_info["already_processed"]:
+        mark_email_as_processed(bucket, email_info["email_key"], email_result, results)
+    
+    if email_info["already_sent"] or not results:
+        return False
+    
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    csv_key = f"processed_invoices/invoice_data_{timestamp}_{email_result['sender_email'].split('@')[0]}.csv"
+    csv_content = create_csv_from_results(results, bucket, csv_key)
+    
+    if send_csv_via_ses(email_result['sender_email'], csv_content, email_result['subject']):
+        mark_email_as_sent(bucket, email_info["email_signature"], email_result['sender_email'], email_result['subject'], len(results))
+        return True
+    
+    return False
+
+def run_batch_mode(bucket, openai_api_key, email_files, processed_records, sent_records):
+    """
+    Batch API execution mode: reconcile finished batches, then submit new emails as one batch.
+    Emails are only marked processed once their batch has been reconciled.
+    """
+    backend = get_batch_backend(openai_api_key)
+    batch_jobs = get_batch_jobs(bucket)
+    
+    completed_batches = []
+    failed_batches = []
+    delivered_signatures = set()
+    emails_sent = 0
+    
+    # Poll submitted batches and deliver the finished ones
+    for batch_id, job in list(batch_jobs.items()):
+        try:
+            batch = backend.retrieve_batch(batch_id)
+        except Exception as e:
+            print(f"Error polling batch {batch_id}: {str(e)}")
+            continue
+        
+        status = batch.get("status")
+        print(f"Batch {batch_id} status: {status} {batch.get('request_counts', '')}")
+        
+        if status == "completed":
+            reconcile_batch_output(backend, batch, job)
+            for email_info in job["emails"]:
+                if deliver_batch_email_results(bucket, email_info):
+                    emails_sent += 1
+                delivered_signatures.add(email_info["email_signature"])
+            completed_batches.append(batch_id)
+            del batch_jobs[batch_id]
+        elif status in ("failed", "expired", "cancelled"):
+            # The emails were never marked processed, so they are picked up again below
+            print(f"Batch {batch_id} ended with status {status} - resubmitting its emails")
+            failed_batches.append(batch_id)
+            del batch_jobs[batch_id]
+    
+    save_batch_jobs(bucket, batch_jobs)
+    
+    # Collect emails that are neither done nor waiting on a batch
+    pending_signatures = get_batch_pending_signatures(batch_jobs)
+    new_emails = []
+    
+    for email_obj in email_files:
+        email_key = email_obj['Key']
+        email_result = extract_attachments_from_email(bucket, email_key)
+        if not email_result["success"]:
+            continue
+        
+        email_signature = create_email_signature(email_result)
+        if email_signature in pending_signatures:
+            print(f"SKIPPING: {email_key} is waiting on a pending batch")
+            continue
+        if email_signature in delivered_signatures:
+            continue
+        
+        already_processed = is_email_already_processed(email_result, processed_records)
+        already_sent = is_email_already_sent(email_result, sent_records)
+        if already_processed and already_sent:
+            continue
+        
+        if not email_result["attachments"]:
+            if email_result["sender_email"] and not already_sent:
+                send_no_attachments_email(email_result["sender_email"], email_result["subject"])
+                mark_email_as_sent(bucket, email_signature, email_result["sender_email"], email_result["subject"], 0)
+            if not already_processed:
+                mark_email_as_processed(bucket, email_key, email_result, [])
+            continue
+        
+        documents = prepare_batch_documents(email_result["attachments"])
+        signature_hash = hashlib.sha256(email_signature.encode('utf-8')).hexdigest()[:16]
+        for i, document in enumerate(documents):
+            document["custom_id"] = f"{signature_hash}-{i}"
+        
+        new_emails.append({
+            "email_key": email_key,
+            "email_signature": email_signature,
+            "already_processed": already_processed,
+            "already_sent": already_sent,
+            # Only what mark_email_as_processed and the CSV email need, not the attachment bytes
+            "email_result": {
+                "sender_email": email_result["sender_email"],
+                "subject": email_result["subject"],
+                "message_id": email_result["message_id"],
+                "date": email_result["date"],
+                "attachments": [filename for _, filename, _ in email_result["attachments"]]
+            },
+            "documents": documents
+        })
+    
+    # Emails fully answered from the cache or by local errors are delivered right away
+    emails_to_submit = []
+    for email_info in new_emails:
+        if any("body" in document for document in email_info["documents"]):
+            emails_to_submit.append(email_info)
+        else:
+            email_info["results"] = [document["result"] for document in email_info["documents"]]
+            if deliver_batch_email_results(bucket, email_info):
+                emails_sent += 1
+    
+    submitted_batch = None
+    if emails_to_submit:
+        batch = submit_invoice_batch(backend, emails_to_submit)
+        submitted_batch = batch["id"]
+        batch_jobs[submitted_batch] = {
+            "submitted_date": datetime.utcnow().isoformat(),
+            "input_file_id": batch.get("input_file_id"),
+            "emails": emails_to_submit
+        }
+        save_batch_jobs(bucket, batch_jobs)
+    
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": f"Batch mode: {len(completed_batches)} batches reconciled, {len(emails_to_submit)} emails submitted",
+            "processing_mode": "batch",
+            "completed_batches": completed_batches,
+            "failed_batches": failed_batches,
+            "submitted_batch": submitted_batch,
+            "emails_submitted": len(emails_to_submit),
+            "pending_batches": list(batch_jobs.keys()),
+            "emails_sent_this_run": emails_sent,
+            "stage_cache": stage_cache.stats()
+        })
+    }
+
 def lambda_handler(event, context):
     """
     Main Lambda handler with separate tracking for processed and sent emails
@@ -1179,6 +5071,15 @@ def lambda_handler(event, context):
     failed_files = []
     emails_to_send = []
     
+    stage_cache.start_run(bucket)
+    openai_hedger.start_run()
+    openai_usage.start_run()
+    model_tier_stats.start_run()
+    image_screen_stats.start_run()
+    vision_detail_stats.start_run()
+    preclassifier_stats.start_run()
+    rule_extraction_stats.start_run()
+    
     # Get processed email records (Message-ID based tracking)
     processed_records = get_processed_emails(bucket)
     
@@ -1233,92 +5134,164 @@ def lambda_handler(event, context):
                 })
             }
         
+        # Backlogs can be routed through the OpenAI Batch API instead of synchronous calls
+        if event.get('processing_mode', PROCESSING_MODE) == 'batch':
+            return run_batch_mode(bucket, openai_api_key, email_files, processed_records, sent_records)
+        
+        # Emails waiting on a submitted batch are delivered by the batch mode
+        batch_pending_signatures = get_batch_pending_signatures(get_batch_jobs(bucket))
+        
+        # Emails deferred by an earlier OpenAI outage are retried first
+        deferred_emails = get_deferred_emails(bucket)
+        deferred_keys = {entry["email_key"] for entry in deferred_emails.values()}
+        email_files.sort(key=lambda email_obj: email_obj['Key'] not in deferred_keys)
+        deferred_queue_changed = False
+        emails_deferred = 0
+        
+        vendor_templates.start_run(get_vendor_templates(bucket) if VENDOR_TEMPLATES_ENABLED else {})
+        
         # Process each email file with separate tracking for processing and sending
         new_emails_processed = 0
         emails_ready_to_send = 0
         
-        for email_obj in email_files:
-            email_key = email_obj['Key']
-            print(f"=" * 50)
-            print(f"Checking email: {email_key}")
+        # Emails are downloaded, parsed and processed in chunks of PIPELINE_CONCURRENCY, so only
+        # one chunk's attachment bytes are held in memory at a time, however big the mailbox is
+        for chunk_start in range(0, len(email_files), PIPELINE_CONCURRENCY):
+            email_chunk = email_files[chunk_start:chunk_start + PIPELINE_CONCURRENCY]
+            email_results = run_in_parallel(
+                lambda email_obj: extract_attachments_from_email(bucket, email_obj['Key']),
+                email_chunk
+            )
             
-            # First extract basic email info to create signature
-            email_result = extract_attachments_from_email(bucket, email_key)
+            # Decide which emails need their attachments processed
+            emails_to_process = []
             
-            if not email_result["success"]:
-                print(f"Failed to extract email info from {email_key}: {email_result['error']}")
-                failed_files.append({
-                    "file": email_key,
-                    "error": email_result["error"]
-                })
-                continue
+            for email_obj, email_result in zip(email_chunk, email_results):
+                email_key = email_obj['Key']
+                print(f"=" * 50)
+                print(f"Checking email: {email_key}")
             
-            email_signature = create_email_signature(email_result)
-            sender_email = email_result["sender_email"]
-            subject = email_result["subject"]
-            attachments = email_result["attachments"]
+                if not email_result["success"]:
+                    print(f"Failed to extract email info from {email_key}: {email_result['error']}")
+                    failed_files.append({
+                        "file": email_key,
+                        "error": email_result["error"]
+                    })
+                    continue
             
-            print(f"Email from: {sender_email}")
-            print(f"Subject: {subject}")
-            print(f"Email signature: {email_signature}")
-            print(f"Found {len(attachments)} attachments")
+                email_signature = create_email_signature(email_result)
+                sender_email = email_result["sender_email"]
+                subject = email_result["subject"]
+                attachments = email_result["attachments"]
             
-            # Check processing status
-            already_processed = is_email_already_processed(email_result, processed_records)
-            already_sent = is_email_already_sent(email_result, sent_records)
+                print(f"Email from: {sender_email}")
+                print(f"Subject: {subject}")
+                print(f"Email signature: {email_signature}")
+                print(f"Found {len(attachments)} attachments")
             
-            if already_processed and already_sent:
-                print(f"SKIPPING: Email already processed AND results already sent")
-                continue
-            elif already_processed and not already_sent:
-                print(f"FOUND: Email processed but results NOT sent yet - will send results")
-                # We need to get the results from the processed record or reprocess
-                # For now, let's reprocess to ensure we have the results
-            elif not already_processed:
-                print(f"NEW EMAIL: Processing {email_key}")
-                new_emails_processed += 1
+                # Check processing status
+                already_processed = is_email_already_processed(email_result, processed_records)
+                already_sent = is_email_already_sent(email_result, sent_records)
             
-            if not attachments:
-                print(f"No valid attachments found")
-                if sender_email and not already_sent:
-                    send_no_attachments_email(sender_email, subject)
-                    mark_email_as_sent(bucket, email_signature, sender_email, subject, 0)
-                # Mark as processed even without attachments
-                if not already_processed:
-                    mark_email_as_processed(bucket, email_key, email_result, [])
-                continue
+                if already_processed and already_sent:
+                    print(f"SKIPPING: Email already processed AND results already sent")
+                    continue
+                elif email_signature in batch_pending_signatures:
+                    print(f"SKIPPING: Email is waiting on a pending OpenAI batch")
+                    continue
+                elif already_processed and not already_sent:
+                    print(f"FOUND: Email processed but results NOT sent yet - will send results")
+                    # We need to get the results from the processed record or reprocess
+                    # For now, let's reprocess to ensure we have the results
+                elif not already_processed:
+                    print(f"NEW EMAIL: Processing {email_key}")
+                    new_emails_processed += 1
+            
+                if not attachments:
+                    print(f"No valid attachments found")
+                    if sender_email and not already_sent:
+                        send_no_attachments_email(sender_email, subject)
+                        mark_email_as_sent(bucket, email_signature, sender_email, subject, 0)
+                    # Mark as processed even without attachments
+                    if not already_processed:
+                        mark_email_as_processed(bucket, email_key, email_result, [])
+                    continue
             
-            # Process attachments (reprocess if needed for sending)
-            email_processed_results = []
+                emails_to_process.append({
+                    "email_key": email_key,
+                    "email_result": email_result,
+                    "email_signature": email_signature,
+                    "already_processed": already_processed,
+                    "already_sent": already_sent,
+                    "results": [],
+                    "deferred_reason": None
+                })
+            
+            # Process attachments of all emails concurrently (reprocess if needed for sending)
+            attachment_jobs = [
+                (email_info, i, attachment)
+                for email_info in emails_to_process
+                for i, attachment in enumerate(email_info["email_result"]["attachments"])
+            ]
             
-            if not already_processed or not already_sent:
-                for i, (attachment_content, filename, content_type) in enumerate(attachments):
-                    print(f"Processing attachment {i+1}/{len(attachments)}: {filename}")
+            def process_attachment_job(job):
+                email_info, i, (attachment_content, filename, content_type) = job
+                if email_info["deferred_reason"]:
+                    return []
+                print(f"Processing attachment {i+1}/{len(email_info['email_result']['attachments'])}: {filename}")
+                try:
                     attachment_results = process_attachment(
                         attachment_content, 
                         filename, 
-                        openai_api_key
+                        openai_api_key,
+                        email_info["email_result"]["sender_email"]
                     )
-                    email_processed_results.extend(attachment_results)
-                    print(f"Got {len(attachment_results)} results from {filename}")
+                except CircuitOpenError as e:
+                    print(f"Deferring email {email_info['email_key']}: {str(e)}")
+                    email_info["deferred_reason"] = str(e)
+                    return []
+                print(f"Got {len(attachment_results)} results from {filename}")
+                return attachment_results
+            
+            # run_in_parallel keeps job order, so each email's results stay in attachment order
+            for (email_info, _, _), attachment_results in zip(attachment_jobs, run_in_parallel(process_attachment_job, attachment_jobs)):
+                email_info["results"].extend(attachment_results)
+            
+            # Record results and update tracking files sequentially, in email order
+            for email_info in emails_to_process:
+                email_result = email_info["email_result"]
+                email_processed_results = email_info["results"]
             
-            if email_processed_results:
-                processed_results.extend(email_processed_results)
+                if email_info["deferred_reason"]:
+                    # Left unprocessed and unsent so a later run picks it up again
+                    defer_email(deferred_emails, email_info["email_key"], email_result, email_info["email_signature"], email_info["deferred_reason"])
+                    deferred_queue_changed = True
+                    emails_deferred += 1
+                    if not email_info["already_processed"]:
+                        new_emails_processed -= 1
+                    continue
+            
+                if deferred_emails.pop(email_info["email_signature"], None):
+                    print(f"Deferred email {email_info['email_key']} processed")
+                    deferred_queue_changed = True
+            
+                if email_processed_results:
+                    processed_results.extend(email_processed_results)
                 
-                # Only add to send list if results haven't been sent yet
-                if not already_sent:
-                    emails_to_send.append({
-                        "sender_email": sender_email,
-                        "subject": subject,
-                        "results": email_processed_results,
-                        "email_signature": email_signature
-                    })
-                    emails_ready_to_send += 1
+                    # Only add to send list if results haven't been sent yet
+                    if not email_info["already_sent"]:
+                        emails_to_send.append({
+                            "sender_email": email_result["sender_email"],
+                            "subject": email_result["subject"],
+                            "results": email_processed_results,
+                            "email_signature": email_info["email_signature"]
+                        })
+                        emails_ready_to_send += 1
+            
+                # Mark as processed if it wasn't already
+                if not email_info["already_processed"]:
+                    mark_email_as_processed(bucket, email_info["email_key"], email_result, email_processed_results)
             
-            # Mark as processed if it wasn't already
-            if not already_processed:
-                mark_email_as_processed(bucket, email_key, email_result, email_processed_results)
-        
         print(f"=" * 50)
         print(f"PROCESSING SUMMARY:")
         print(f"Total email files found: {len(email_files)}")
@@ -1326,6 +5299,13 @@ def lambda_handler(event, context):
         print(f"Previously processed: {len(processed_records)}")
         print(f"Already sent: {len(sent_records)}")
         print(f"Ready to send: {emails_ready_to_send}")
+        print(f"Deferred by OpenAI outage: {emails_deferred}")
+        
+        if deferred_queue_changed:
+            save_deferred_emails(bucket, deferred_emails)
+        
+        if vendor_templates.changed:
+            save_vendor_templates(bucket, vendor_templates.templates)
         
         # Send CSV files only for emails that haven't had results sent yet
         if emails_to_send:
@@ -1369,8 +5349,20 @@ def lambda_handler(event, context):
                     "successful_files": len([r for r in processed_results if r.get('status') == 'success']),
                     "error_files": len([r for r in processed_results if r.get('status') == 'error']),
                     "skipped_files": len([r for r in processed_results if r.get('status') == 'skipped']),
-                    "total_files": len(processed_results)
+                    "total_files": len(processed_results),
+                    "deferred_emails": emails_deferred,
+                    "circuit_breaker": openai_breaker.stats()
                 },
+                "stage_cache": stage_cache.stats(),
+                "hedging": openai_hedger.stats(),
+                "openai_usage": openai_usage.stats(),
+                "model_tiers": model_tier_stats.stats(),
+                "image_screen": image_screen_stats.stats(),
+                "vision_detail": vision_detail_stats.stats(),
+                "image_preprocessing": image_preprocessing_status(),
+                "preclassifier": preclassifier_stats.stats(),
+                "rule_extraction": rule_extraction_stats.stats(),
+                "vendor_templates": vendor_templates.stats(),
                 "sample_results": processed_results[:3] if processed_results else [],
                 "failed_files": failed_files,
                 "note": f"Enhanced system now supports PDF, ZIP, and image files. Results have been emailed to {len(emails_to_send)} recipient(s) for emails that hadn't been sent yet."
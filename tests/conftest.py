@@ -0,0 +1,88 @@
+import io
+import os
+import sys
+import types
+import zipfile
+
+import pytest
+
+# The Lambda module lives next to its vendored dependencies, as it is deployed
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Image_OCR")
+sys.path.insert(0, PACKAGE_DIR)
+
+# Tests must never read or write the S3 stage cache
+os.environ["STAGE_CACHE_ENABLED"] = "false"
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+class FakeS3:
+    """
+    In-memory stand-in for the few S3 calls the Lambda makes
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix):
+        contents = [
+            {"Key": key, "Size": len(body)}
+            for (bucket, key), body in sorted(self.objects.items())
+            if bucket == Bucket and key.startswith(Prefix)
+        ]
+        return {"Contents": contents} if contents else {}
+
+
+class FakeSES:
+    def __init__(self):
+        self.sent = []
+
+    def send_raw_email(self, **kwargs):
+        self.sent.append(kwargs)
+        return {"MessageId": f"message-{len(self.sent)}"}
+
+
+# boto3 is provided by the Lambda runtime and is not vendored; without it the module-level
+# clients are created from this stand-in so the suite still runs
+try:
+    import boto3  # noqa: F401
+except ImportError:
+    boto3_stub = types.ModuleType("boto3")
+    boto3_stub.client = lambda service, *args, **kwargs: FakeS3() if service == "s3" else FakeSES()
+    sys.modules["boto3"] = boto3_stub
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """
+    Fresh in-memory S3 and SES clients in place of the module-level ones
+    """
+    import lambda_function
+
+    fakes = types.SimpleNamespace(s3=FakeS3(), ses=FakeSES())
+    monkeypatch.setattr(lambda_function, "s3", fakes.s3)
+    monkeypatch.setattr(lambda_function, "ses", fakes.ses)
+    return fakes
+
+
+@pytest.fixture
+def read_sample():
+    """
+    Read a file from the bundled 123.zip sample archive
+    """
+    def read(name):
+        with zipfile.ZipFile(os.path.join(PACKAGE_DIR, "123.zip")) as archive:
+            return archive.read(name)
+    return read
@@ -0,0 +1,53 @@
+import json
+
+import lambda_function as lf
+
+
+class FakeBatchBackend:
+    def __init__(self, files):
+        self.files = files
+
+    def download_file(self, file_id):
+        return self.files[file_id]
+
+
+def tool_call_body(arguments):
+    return {"choices": [{"message": {"tool_calls": [{"function": {"arguments": json.dumps(arguments)}}]}}]}
+
+
+def test_reconcile_batch_output():
+    arguments = {
+        "document_type": "BILL_INVOICE", "confidence": "HIGH", "reason": "invoice",
+        "po_number": "NOT_FOUND", "bill_to": "Acme", "bill_from": "Vendor Co", "total_amount": "$1,234.50",
+        "amount_due": "1234.50", "currency": "USD", "bill_id": "INV-1", "bill_date": "2024-01-15", "items_services": "Widgets"
+    }
+    output = json.dumps({"custom_id": "doc-1", "response": {"status_code": 200, "body": tool_call_body(arguments)}})
+    errors = json.dumps({"custom_id": "doc-2", "response": {"status_code": 500, "body": {}}})
+    backend = FakeBatchBackend({"out": output.encode("utf-8"), "err": errors.encode("utf-8")})
+
+    skipped = lf.status_row("notes.pdf", "skipped", "NOT_INVOICE")
+    job = {"emails": [{"documents": [
+        {"filename": "notes.pdf", "result": skipped},
+        {"filename": "invoice.pdf", "custom_id": "doc-1"},
+        {"filename": "failed.pdf", "custom_id": "doc-2"}
+    ]}]}
+
+    lf.reconcile_batch_output(backend, {"output_file_id": "out", "error_file_id": "err"}, job)
+
+    results = job["emails"][0]["results"]
+    assert [row["filename"] for row in results] == ["notes.pdf", "invoice.pdf", "failed.pdf"]
+    assert results[0] is skipped
+    assert results[1]["status"] == "success"
+    assert results[1]["total_amount"] == "1234.50"
+    assert results[1]["bill_id"] == "INV-1"
+    assert all(results[2][field] == "API_ERROR" for field in lf.BILLING_FIELDS)
+
+
+def test_reconcile_batch_output_non_invoice():
+    arguments = {"document_type": "OTHER", "confidence": "HIGH", "reason": "newsletter"}
+    output = json.dumps({"custom_id": "doc-1", "response": {"status_code": 200, "body": tool_call_body(arguments)}})
+    job = {"emails": [{"documents": [{"filename": "news.pdf", "custom_id": "doc-1"}]}]}
+
+    lf.reconcile_batch_output(FakeBatchBackend({"out": output.encode("utf-8")}), {"output_file_id": "out"}, job)
+
+    assert job["emails"][0]["results"] == [lf.status_row("news.pdf", "skipped", "NOT_INVOICE")]
@@ -0,0 +1,88 @@
+import json
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import httpx
+import pytest
+
+import lambda_function as lf
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = lf.CircuitBreaker(2, 60, 0.1)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.stats()["state"] == "open"
+
+    with pytest.raises(lf.CircuitOpenError):
+        breaker.before_request()
+    assert breaker.stats()["rejected_requests"] == 1
+
+    # After the cool-down a single probe is let through and its success closes the breaker
+    breaker.cooldown_seconds = 0
+    breaker.before_request()
+    assert breaker.stats()["state"] == "half_open"
+    breaker.record_success()
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 0, "times_opened": 1, "rejected_requests": 1}
+
+
+def test_circuit_breaker_failed_probe_reopens():
+    breaker = lf.CircuitBreaker(1, 0, 0.1)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.stats()["state"] == "open"
+    assert breaker.stats()["times_opened"] == 2
+
+
+@pytest.fixture
+def openai_down(monkeypatch):
+    """
+    Every OpenAI request fails with a 503, and the breaker is set to open only after far more
+    failures than a single request's retries, so each request runs out of retries on its own
+    """
+    requests = []
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(503, json={"error": {"message": "overloaded"}})
+
+    monkeypatch.setattr(lf, "_openai_http_client", httpx.Client(base_url=lf.OPENAI_API_BASE, transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(lf, "openai_breaker", lf.CircuitBreaker(100, 60, 1))
+    monkeypatch.setattr(lf, "openai_rate_limiter", lf.OpenAIRateLimiter(0, 0))
+    monkeypatch.setattr(lf.time, "sleep", lambda seconds: None)
+    return requests
+
+
+def test_exhausted_outage_retries_raise(openai_down):
+    with pytest.raises(lf.OpenAIOutageError):
+        lf.request_chat_completion({"model": "x"}, "sk-test", 10)
+    assert len(openai_down) == lf.OPENAI_MAX_RETRIES
+
+
+def invoice_email(pdf):
+    message = MIMEMultipart()
+    message["From"] = "Billing <billing@example.com>"
+    message["Subject"] = "Your invoice"
+    message["Message-ID"] = "<invoice-1@example.com>"
+    message.attach(MIMEText("Invoice attached"))
+    attachment = MIMEApplication(pdf)
+    attachment.add_header("Content-Disposition", "attachment", filename="invoice123.pdf")
+    message.attach(attachment)
+    return message.as_bytes()
+
+
+def test_outage_defers_the_email_instead_of_sending_error_rows(monkeypatch, aws, openai_down, read_sample):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    aws.s3.put_object(Bucket="mailinvoices", Key="Emails/invoice-1", Body=invoice_email(read_sample("invoice123.pdf")))
+
+    response = lf.lambda_handler({}, None)
+
+    summary = json.loads(response["body"])["summary"]
+    assert summary["deferred_emails"] == 1
+    assert aws.ses.sent == []
+    deferred = json.loads(aws.s3.get_object(Bucket="mailinvoices", Key="deferred_emails_tracking.json")["Body"].read())
+    assert [entry["email_key"] for entry in deferred["deferred_emails"].values()] == ["Emails/invoice-1"]
+    with pytest.raises(aws.s3.exceptions.NoSuchKey):
+        aws.s3.get_object(Bucket="mailinvoices", Key="processed_emails_tracking.json")
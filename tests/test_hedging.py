@@ -0,0 +1,66 @@
+import threading
+
+import lambda_function as lf
+
+
+def test_hedged_request_wins_and_cancels_the_primary(monkeypatch):
+    monkeypatch.setattr(lf, "openai_rate_limiter", lf.OpenAIRateLimiter(0, 0))
+    hedger = lf.RequestHedger(0.5, 1, 0.01, 1.0)
+    hedger.record_latency(0.01)
+
+    calls = []
+    primary_cancelled = threading.Event()
+    def send(path, payload, api_key, estimated_tokens, cancel_event=None):
+        calls.append(cancel_event)
+        if len(calls) == 1:
+            # The primary stalls until the hedge has won
+            if cancel_event.wait(5):
+                primary_cancelled.set()
+            return "primary"
+        return "hedge"
+
+    assert hedger.send(send, "/chat/completions", {}, "sk-test") == "hedge"
+    assert primary_cancelled.wait(1)
+    assert hedger.stats()["hedges_won"] == 1
+
+
+def test_no_hedge_before_enough_samples():
+    hedger = lf.RequestHedger(0.5, 3, 0.01, 1.0)
+    hedger.record_latency(0.01)
+    assert hedger.hedge_delay() is None
+    assert hedger.send(lambda *args, **kwargs: "only", "/chat/completions", {}, "sk-test") == "only"
+    assert hedger.stats()["hedges_fired"] == 0
+
+
+class FakeResponse:
+    extensions = {}
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_cancel_closes_the_attached_response():
+    cancel = lf.StreamCancel()
+    response = FakeResponse()
+    assert cancel.attach(response)
+    cancel.set()
+    assert response.closed
+
+    # A response attached after cancellation is refused so its reader closes it at once
+    assert not cancel.attach(FakeResponse())
+
+
+def test_cancelled_request_refunds_its_tokens():
+    limiter = lf.OpenAIRateLimiter(60, 1000)
+    limiter.acquire(500)
+    available = limiter.available_tokens
+
+    # No usage reported: the estimate stands
+    limiter.record_usage(500, None)
+    assert limiter.available_tokens == available
+
+    limiter.record_usage(500, 0)
+    assert limiter.available_tokens == available + 500
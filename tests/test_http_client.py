@@ -0,0 +1,22 @@
+import threading
+
+import lambda_function as lf
+
+
+def test_openai_http_client_is_shared():
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(lf.get_openai_http_client())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(client is clients[0] for client in clients)
+    assert lf.get_openai_http_client() is clients[0]
+    assert str(clients[0].base_url).rstrip("/") == lf.OPENAI_API_BASE.rstrip("/")
+
+
+def test_openai_http_client_timeouts():
+    timeout = lf.get_openai_http_client().timeout
+    assert timeout.connect == lf.OPENAI_CONNECT_TIMEOUT
+    assert timeout.read == lf.OPENAI_READ_TIMEOUT
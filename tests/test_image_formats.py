@@ -0,0 +1,139 @@
+import zlib
+
+import pytest
+
+import lambda_function as lf
+
+
+def bmp_24bit(rows):
+    """
+    Uncompressed 24-bit BMP from rows of (r, g, b) pixels, top row first
+    """
+    width, height = len(rows[0]), len(rows)
+    stride = (24 * width + 31) // 32 * 4
+    pixels = b"".join(
+        b"".join(bytes((b, g, r)) for r, g, b in row).ljust(stride, b"\x00")
+        for row in reversed(rows)
+    )
+    header = (
+        (40).to_bytes(4, "little") + width.to_bytes(4, "little") + height.to_bytes(4, "little")
+        + (1).to_bytes(2, "little") + (24).to_bytes(2, "little") + bytes(24)
+    )
+    return b"BM" + (54 + len(pixels)).to_bytes(4, "little") + bytes(4) + (54).to_bytes(4, "little") + header + pixels
+
+
+def packbits(data):
+    """
+    PackBits encoding with literal runs only, which is all a decoder has to undo for most of a page
+    """
+    return b"".join(bytes([len(data[i:i + 128]) - 1]) + data[i:i + 128] for i in range(0, len(data), 128))
+
+
+def tiff(pages, byte_order="little", compression=1):
+    """
+    Baseline TIFF with one RGB image per page; each page is rows of (r, g, b) pixels
+    """
+    def number(value, size):
+        return value.to_bytes(size, byte_order)
+
+    data = bytearray((b"II*\x00" if byte_order == "little" else b"MM\x00*") + bytes(4))
+    link = 4
+    for rows in pages:
+        strip = b"".join(bytes(value for pixel in row for value in pixel) for row in rows)
+        if compression == 32773:
+            strip = packbits(strip)
+        strip_offset = len(data)
+        data += strip
+        if len(data) % 2:
+            data += b"\x00"
+        bits_offset = len(data)
+        data += number(8, 2) * 3
+        tags = [
+            (256, 3, 1, len(rows[0])), (257, 3, 1, len(rows)), (258, 3, 3, bits_offset), (259, 3, 1, compression),
+            (262, 3, 1, 2), (273, 4, 1, strip_offset), (277, 3, 1, 3), (279, 4, 1, len(strip))
+        ]
+        data[link:link + 4] = number(len(data), 4)
+        data += number(len(tags), 2)
+        for tag, field_type, count, value in tags:
+            inline = number(value, 2) + bytes(2) if field_type == 3 and count == 1 else number(value, 4)
+            data += number(tag, 2) + number(field_type, 2) + number(count, 4) + inline
+        link = len(data)
+        data += bytes(4)
+    return bytes(data)
+
+
+def png_chunks(png):
+    chunks = {}
+    position = 8
+    while position < len(png):
+        length = int.from_bytes(png[position:position + 4], "big")
+        chunk_type = png[position + 4:position + 8]
+        chunks[chunk_type] = chunks.get(chunk_type, b"") + png[position + 8:position + 8 + length]
+        position += 12 + length
+    return chunks
+
+
+def png_rows(rows):
+    return b"".join(b"\x00" + bytes(value for pixel in row for value in pixel) for row in rows)
+
+
+RED_GREEN = [[(255, 0, 0), (0, 255, 0), (0, 0, 255)], [(10, 20, 30), (40, 50, 60), (70, 80, 90)]]
+GRAY = [[(128, 128, 128)] * 3] * 2
+
+
+def test_detect_image_format(read_sample):
+    assert lf.detect_image_format(read_sample("invoice_01.jpg")) == "jpeg"
+    assert lf.detect_image_format(b"\x89PNG\r\n\x1a\n" + bytes(8)) == "png"
+    assert lf.detect_image_format(b"GIF89a") == "gif"
+    assert lf.detect_image_format(b"RIFF\x00\x00\x00\x00WEBP") == "webp"
+    assert lf.detect_image_format(b"BM" + bytes(8)) == "bmp"
+    assert lf.detect_image_format(b"II*\x00") == "tiff"
+    assert lf.detect_image_format(b"%PDF-1.4") is None
+
+
+def test_bmp_to_png():
+    png = lf.bmp_to_png(bmp_24bit(RED_GREEN))
+
+    assert lf.detect_image_format(png) == "png"
+    chunks = png_chunks(png)
+    assert chunks[b"IHDR"][:8] == (3).to_bytes(4, "big") + (2).to_bytes(4, "big")
+    assert zlib.decompress(chunks[b"IDAT"]) == png_rows(RED_GREEN)
+
+
+def test_bmp_to_png_rejects_compressed_bmp():
+    bmp = bytearray(bmp_24bit([[(0, 0, 0)]]))
+    bmp[30:34] = (1).to_bytes(4, "little")
+    with pytest.raises(ValueError):
+        lf.bmp_to_png(bytes(bmp))
+
+
+@pytest.mark.parametrize("byte_order", ["little", "big"])
+@pytest.mark.parametrize("compression", [1, 32773])
+def test_tiff_converted_without_pillow(monkeypatch, byte_order, compression):
+    monkeypatch.setattr(lf, "Image", None)
+
+    png, mime_type = lf.preprocess_image(tiff([RED_GREEN], byte_order, compression))
+
+    assert mime_type == "image/png"
+    chunks = png_chunks(png)
+    assert chunks[b"IHDR"][:10] == (3).to_bytes(4, "big") + (2).to_bytes(4, "big") + bytes([8, 2])
+    assert zlib.decompress(chunks[b"IDAT"]) == png_rows(RED_GREEN)
+
+
+def test_multi_page_tiff_split_without_pillow(monkeypatch):
+    monkeypatch.setattr(lf, "Image", None)
+    monkeypatch.setattr(lf, "MAX_IMAGE_PAGES", 2)
+
+    pages = lf.split_image_pages(tiff([RED_GREEN, GRAY, GRAY], compression=32773))
+
+    assert [zlib.decompress(png_chunks(page)[b"IDAT"]) for page in pages] == [png_rows(RED_GREEN), png_rows(GRAY)]
+
+
+def test_unsupported_tiff_compression_is_rejected(monkeypatch):
+    monkeypatch.setattr(lf, "Image", None)
+    lzw = tiff([RED_GREEN], compression=5)
+
+    # An LZW TIFF is sent on as a single page and refused at conversion
+    assert lf.split_image_pages(lzw) == [lzw]
+    with pytest.raises(ValueError):
+        lf.preprocess_image(lzw)
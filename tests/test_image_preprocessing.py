@@ -0,0 +1,29 @@
+import json
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+
+import lambda_function as lf
+
+
+def test_preprocessing_reported_disabled_without_pillow(monkeypatch, aws, read_sample):
+    monkeypatch.setattr(lf, "Image", None)
+    jpeg = read_sample("invoice_01.jpg")
+
+    # Without Pillow the original bytes go to the vision API untouched
+    assert lf.preprocess_image(jpeg) == (jpeg, "image/jpeg")
+
+    message = MIMEMultipart()
+    message["From"] = "billing@example.com"
+    message["Message-ID"] = "<logo@example.com>"
+    message.attach(MIMEImage(jpeg[:200], "jpeg"))
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    aws.s3.put_object(Bucket="mailinvoices", Key="Emails/logo-only", Body=message.as_bytes())
+    response = lf.lambda_handler({}, None)
+
+    assert json.loads(response["body"])["image_preprocessing"] == {"enabled": False, "reason": "Pillow is not installed"}
+
+
+def test_preprocessing_reported_turned_off(monkeypatch):
+    monkeypatch.setattr(lf, "IMAGE_PREPROCESSING_ENABLED", False)
+
+    assert lf.image_preprocessing_status()["enabled"] is False
@@ -0,0 +1,68 @@
+import zlib
+
+import pytest
+
+import lambda_function as lf
+from test_image_formats import bmp_24bit
+
+
+def paeth(left, up, up_left):
+    estimate = left + up - up_left
+    distances = [abs(estimate - left), abs(estimate - up), abs(estimate - up_left)]
+    return (left, up, up_left)[distances.index(min(distances))]
+
+
+def filter_row(filter_type, row, previous, bpp):
+    """
+    Apply a PNG filter to one scanline, the way an encoder does
+    """
+    def left(i):
+        return row[i - bpp] if i >= bpp else 0
+
+    def up_left(i):
+        return previous[i - bpp] if i >= bpp else 0
+
+    predictors = {
+        0: lambda i: 0,
+        1: left,
+        2: lambda i: previous[i],
+        3: lambda i: (left(i) + previous[i]) // 2,
+        4: lambda i: paeth(left(i), previous[i], up_left(i)),
+    }
+    return bytes((row[i] - predictors[filter_type](i)) & 0xFF for i in range(len(row)))
+
+
+def rgb_png(rows, filter_type):
+    raw = [bytes(value for pixel in row for value in pixel) for row in rows]
+    previous = bytes(len(raw[0]))
+    filtered = []
+    for row in raw:
+        filtered.append(bytes([filter_type]) + filter_row(filter_type, row, previous, 3))
+        previous = row
+    header = len(rows[0]).to_bytes(4, "big") + len(rows).to_bytes(4, "big") + bytes([8, 2, 0, 0, 0])
+    return b"\x89PNG\r\n\x1a\n" + lf.png_chunk(b"IHDR", header) + lf.png_chunk(b"IDAT", zlib.compress(b"".join(filtered))) + lf.png_chunk(b"IEND", b"")
+
+
+PAPER = [[(240 + (x + y) % 5, 238, 236) for x in range(6)] for y in range(5)]
+STAMPED = [row[:] for row in PAPER]
+STAMPED[3][4] = (20, 20, 120)
+
+
+@pytest.mark.parametrize("filter_type", [0, 1, 2, 3, 4])
+def test_png_blank_check_undoes_every_filter(filter_type):
+    assert lf.png_is_blank(rgb_png(PAPER, filter_type)) is True
+    assert lf.png_is_blank(rgb_png(STAMPED, filter_type)) is False
+
+
+def test_blank_check_without_pillow(monkeypatch, read_sample):
+    monkeypatch.setattr(lf, "Image", None)
+    lf.image_screen_stats.start_run()
+
+    assert lf.is_blank_image(bmp_24bit(PAPER)) is True
+    assert lf.is_blank_image(bmp_24bit(STAMPED)) is False
+    # JPEG needs Pillow, so it is kept and counted as not checked
+    assert lf.is_blank_image(read_sample("invoice_01.jpg")) is False
+
+    stats = lf.image_screen_stats.stats()
+    assert stats["blank_check"] == "PNG and BMP only (Pillow is not installed)"
+    assert stats["blank_check_skipped"] == 1
@@ -0,0 +1,19 @@
+from PyPDF2 import PageObject
+
+import lambda_function as lf
+
+
+def test_each_page_is_extracted_once(monkeypatch, read_sample):
+    calls = []
+    extract_text = PageObject.extract_text
+
+    def counting_extract_text(page, *args, **kwargs):
+        calls.append(page)
+        return extract_text(page, *args, **kwargs)
+
+    monkeypatch.setattr(PageObject, "extract_text", counting_extract_text)
+
+    result = lf.extract_text_from_pdf(read_sample("invoice123.pdf"))
+
+    assert result["success"] and result["text"].strip()
+    assert len(calls) == result["page_count"] == len(result["pages"])
@@ -0,0 +1,22 @@
+import lambda_function as lf
+
+
+def test_sample_invoice_is_classified_locally(read_sample):
+    result = lf.extract_text_from_pdf(read_sample("invoice123.pdf"))
+    classification = lf.preclassify_document(result["text"], result["producer"])
+    assert classification["document_type"] == "BILL_INVOICE"
+    assert classification["confidence"] == "HIGH"
+
+
+def test_document_without_amounts_or_financial_terms_is_other():
+    text = "Team offsite agenda\n" + "We will meet in the main hall and discuss the roadmap for next year.\n" * 20
+    assert lf.preclassify_document(text)["document_type"] == "OTHER"
+
+
+def test_unclear_documents_are_left_to_the_model():
+    assert lf.preclassify_document("Meeting notes\nTotal attendees: 12") is None
+
+
+def test_preclassifier_disabled(monkeypatch):
+    monkeypatch.setattr(lf, "PRECLASSIFIER_ENABLED", False)
+    assert lf.preclassify_document("Invoice\nBill to: Acme\nTotal: $10.00") is None
@@ -0,0 +1,31 @@
+import lambda_function as lf
+
+
+def test_rate_limiter_reserves_and_corrects_tokens():
+    limiter = lf.OpenAIRateLimiter(60, 1000)
+    assert limiter.acquire(900) == 0
+    assert not limiter.has_capacity(500)
+
+    # The API reported fewer tokens than estimated, so the difference goes back into the bucket
+    limiter.record_usage(900, 400)
+    assert limiter.has_capacity(500)
+
+
+def test_rate_limiter_caps_oversized_requests():
+    limiter = lf.OpenAIRateLimiter(60, 1000)
+    # A request bigger than the whole budget only waits for a full bucket
+    assert limiter.acquire(5000) == 0
+    assert not limiter.has_capacity(1)
+
+
+def test_rate_limiter_request_budget():
+    limiter = lf.OpenAIRateLimiter(2, 0)
+    limiter.acquire(0)
+    limiter.acquire(0)
+    assert not limiter.has_capacity(0)
+
+
+def test_rate_limiter_pause():
+    limiter = lf.OpenAIRateLimiter(60, 1000)
+    limiter.pause(30)
+    assert not limiter.has_capacity(1)
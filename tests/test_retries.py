@@ -0,0 +1,75 @@
+import httpx
+import pytest
+
+import lambda_function as lf
+
+
+def status_error(status_code, **kwargs):
+    response = httpx.Response(status_code, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"), **kwargs)
+    return httpx.HTTPStatusError(f"HTTP {status_code}", request=response.request, response=response)
+
+
+def test_parse_reset_duration():
+    assert lf.parse_reset_duration("20ms") == pytest.approx(0.02)
+    assert lf.parse_reset_duration("6m0s") == 360.0
+    assert lf.parse_reset_duration("1h2m3.5s") == 3723.5
+    assert lf.parse_reset_duration("soon") is None
+    assert lf.parse_reset_duration("") is None
+
+
+def test_parse_retry_after_headers():
+    assert lf.parse_retry_after_headers(None) is None
+    assert lf.parse_retry_after_headers({"retry-after-ms": "250", "retry-after": "9"}) == 0.25
+    assert lf.parse_retry_after_headers({"retry-after": "3"}) == 3.0
+    assert lf.parse_retry_after_headers({
+        "x-ratelimit-remaining-requests": "5",
+        "x-ratelimit-reset-requests": "30s",
+        "x-ratelimit-remaining-tokens": "0",
+        "x-ratelimit-reset-tokens": "1.5s"
+    }) == 1.5
+    assert lf.parse_retry_after_headers({"x-ratelimit-remaining-tokens": "100"}) is None
+
+
+def test_calculate_retry_wait():
+    assert lf.calculate_retry_wait(0, {"retry-after": "2"}) == 2.0
+    # Too long a wait falls back to capped exponential backoff with jitter
+    wait = lf.calculate_retry_wait(1, {"retry-after": str(lf.OPENAI_MAX_RETRY_AFTER + 1)})
+    backoff = min(lf.OPENAI_INITIAL_RETRY_DELAY * 2, lf.OPENAI_MAX_RETRY_DELAY)
+    assert 0.75 * backoff <= wait <= backoff
+
+
+def test_is_retryable_response():
+    assert lf.is_retryable_response(httpx.Response(429, json={"error": {"code": "rate_limit_exceeded"}}))
+    assert not lf.is_retryable_response(httpx.Response(429, json={"error": {"code": "insufficient_quota"}}))
+    assert lf.is_retryable_response(httpx.Response(503))
+    assert not lf.is_retryable_response(httpx.Response(400))
+    assert not lf.is_retryable_response(httpx.Response(503, headers={"x-should-retry": "false"}))
+
+
+def test_request_chat_completion_waits_as_asked(monkeypatch):
+    waits = []
+    monkeypatch.setattr(lf.time, "sleep", waits.append)
+    monkeypatch.setattr(lf, "openai_breaker", lf.CircuitBreaker(5, 60, 1))
+    monkeypatch.setattr(lf, "openai_rate_limiter", lf.OpenAIRateLimiter(0, 0))
+
+    responses = [status_error(429, headers={"retry-after": "1.5"}, json={"error": {"code": "rate_limit_exceeded"}}), {"ok": True}]
+    def send(path, payload, api_key, estimated_tokens):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert lf.request_chat_completion({}, "sk-test", 10, send=send) == {"ok": True}
+    assert waits == [1.5]
+
+
+def test_request_chat_completion_gives_up_on_permanent_errors(monkeypatch):
+    monkeypatch.setattr(lf.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(lf, "openai_breaker", lf.CircuitBreaker(5, 60, 1))
+    calls = []
+    def send(path, payload, api_key, estimated_tokens):
+        calls.append(path)
+        raise status_error(400, json={"error": {"code": "invalid_request"}})
+
+    assert lf.request_chat_completion({}, "sk-test", 10, send=send) is None
+    assert len(calls) == 1
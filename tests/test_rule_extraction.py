@@ -0,0 +1,67 @@
+import json
+
+import lambda_function as lf
+
+INVOICE_TEXT = (
+    "Acme Power Co\nInvoice Number: INV-1004\nInvoice Date: 2024-04-15\n"
+    "Bill To: Jane Doe\nTotal: $14.50\nAmount Due: $14.50\n"
+)
+
+
+def test_extract_billing_fields_with_rules():
+    assert lf.extract_billing_fields_with_rules(INVOICE_TEXT) == {
+        "total_amount": "14.50",
+        "amount_due": "14.50",
+        "currency": "USD",
+        "bill_id": "INV-1004",
+        "po_number": "NOT_FOUND",
+        "bill_date": "2024-04-15",
+        "bill_to": "Jane Doe"
+    }
+
+
+def test_extract_billing_fields_with_rules_skips_ambiguous_totals():
+    fields = lf.extract_billing_fields_with_rules("Invoice No: A-1\nTotal: $10.00\nTotal: $12.00")
+    assert "total_amount" not in fields
+    assert fields["bill_id"] == "A-1"
+
+
+def test_parse_invoice_date():
+    assert lf.parse_invoice_date("2025-03-04") == "2025-03-04"
+    assert lf.parse_invoice_date("Mar. 3, 2025") == "2025-03-03"
+    assert lf.parse_invoice_date("25/03/2025") == "2025-03-25"
+    # Day and month could be either way round
+    assert lf.parse_invoice_date("03/04/2025") is None
+
+
+def test_partial_prompt_only_carries_rules_for_missing_fields():
+    prompt = lf.build_partial_extraction_prompt("invoice text", ("bill_from", "items_services"))
+    assert "1. Bill From" in prompt
+    assert "2. Items/Services" in prompt
+    assert "ITEMS/SERVICES RULES" in prompt
+    for absent in ("PO NUMBER RULES", "AMOUNT RULES", "CURRENCY RULES", "Bill To"):
+        assert absent not in prompt
+    assert len(prompt) < len(lf.build_extraction_prompt("invoice text")) / 2
+
+
+def test_full_rules_cover_every_field():
+    rules = lf.build_billing_rules(lf.BILLING_FIELDS)
+    assert rules == lf.BILLING_EXTRACTION_RULES
+    assert all(heading in rules for heading, _, _ in lf.BILLING_RULE_SECTIONS)
+    assert rules.count("Remove all currency symbols") == 1
+
+
+def test_model_is_asked_only_for_the_missing_fields(monkeypatch):
+    requests = []
+    def call(template, text, api_key, max_tokens=None, model=None, usage=None, **kwargs):
+        requests.append(json.loads(template.render(text)))
+        return {"bill_from": "Acme Power Co", "items_services": "Electricity"}
+    monkeypatch.setattr(lf, "call_openai_template", call)
+
+    result = lf.extract_billing_info_with_gpt(INVOICE_TEXT, "sk-test")
+
+    assert result["bill_from"] == "Acme Power Co"
+    assert result["total_amount"] == "14.50"
+    schema = requests[0]["tools"][0]["function"]["parameters"]["properties"]
+    assert sorted(schema) == ["bill_from", "items_services"]
+    assert "AMOUNT RULES" not in requests[0]["messages"][1]["content"]
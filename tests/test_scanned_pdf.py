@@ -0,0 +1,88 @@
+import io
+
+import pytest
+from PyPDF2 import PdfReader
+
+import lambda_function as lf
+
+
+def scanned_pdf(strips, text=""):
+    """
+    One-page PDF drawing each (width, height, filter, data) image strip below the previous one,
+    with an optional line of text on top
+    """
+    width = max(strip[0] for strip in strips)
+    height = sum(strip[1] for strip in strips)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>"]
+
+    names = " ".join(f"/Im{index} {5 + index} 0 R" for index in range(len(strips)))
+    objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] /Contents 4 0 R "
+                   f"/Resources << /XObject << {names} >> /Font << /F1 << /Type /Font /Subtype /Type1 /BaseFont /Helvetica >> >> >> >>".encode())
+
+    content = []
+    top = height
+    for index, (strip_width, strip_height, _, _) in enumerate(strips):
+        top -= strip_height
+        content.append(f"q {strip_width} 0 0 {strip_height} 0 {top} cm /Im{index} Do Q")
+    if text:
+        content.append(f"BT /F1 12 Tf 10 {height - 20} Td ({text}) Tj ET")
+    content = "\n".join(content).encode()
+    objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+
+    for strip_width, strip_height, image_filter, data in strips:
+        parameters = f" /DecodeParms << /K -1 /Columns {strip_width} /Rows {strip_height} >>" if image_filter == "CCITTFaxDecode" else ""
+        objects.append(f"<< /Type /XObject /Subtype /Image /Width {strip_width} /Height {strip_height} /ColorSpace /DeviceRGB "
+                       f"/BitsPerComponent 8 /Filter /{image_filter}{parameters} /Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream")
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1) + b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    return pdf + b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+
+@pytest.fixture
+def jpeg_strips(read_sample):
+    jpeg = read_sample("invoice_01.jpg")
+    width, height = lf.get_image_dimensions(jpeg)
+    # Trailing bytes after the end marker keep the two strips apart without changing the image
+    return [(width, height, "DCTDecode", jpeg), (width, height, "DCTDecode", jpeg + b"\x00")]
+
+
+def test_single_jpeg_strip_is_passed_through_without_pillow(monkeypatch, jpeg_strips):
+    monkeypatch.setattr(lf, "Image", None)
+    page = PdfReader(io.BytesIO(scanned_pdf(jpeg_strips[:1]))).pages[0]
+
+    assert lf.extract_scanned_page_images(page) == [jpeg_strips[0][3]]
+
+
+def test_jpeg_strips_are_kept_apart_and_fax_skipped_without_pillow(monkeypatch, jpeg_strips):
+    monkeypatch.setattr(lf, "Image", None)
+    fax = (jpeg_strips[0][0], 200, "CCITTFaxDecode", b"\x00" * 64)
+    page = PdfReader(io.BytesIO(scanned_pdf(jpeg_strips + [fax]))).pages[0]
+
+    assert lf.extract_scanned_page_images(page) == [jpeg_strips[0][3], jpeg_strips[1][3]]
+
+
+def test_batch_reads_scanned_pdf_from_its_page_images(monkeypatch, jpeg_strips):
+    monkeypatch.setattr(lf, "Image", None)
+    documents = lf.prepare_batch_documents([(scanned_pdf(jpeg_strips[:1]), "scan.pdf", "application/pdf")])
+
+    assert len(documents) == 1 and "result" not in documents[0]
+    images = [part["image_url"]["url"] for part in documents[0]["body"]["messages"][1]["content"] if part["type"] == "image_url"]
+    assert images == [lf.image_data_url(jpeg_strips[0][3], "image/jpeg")]
+
+
+def test_batch_keeps_the_text_layer_of_a_partial_scan(monkeypatch, jpeg_strips):
+    monkeypatch.setattr(lf, "Image", None)
+    monkeypatch.setattr(lf, "TEXT_QUALITY_MIN_SCORE", 1.1)
+    # The image is a logo on a page of text, not the page itself
+    monkeypatch.setattr(lf, "page_image_coverage", lambda page: 0.2)
+    pdf = scanned_pdf(jpeg_strips[:1], "Invoice 1001 Total 99.00")
+
+    documents = lf.prepare_batch_documents([(pdf, "invoice.pdf", "application/pdf")])
+
+    assert "Invoice 1001" in documents[0]["body"]["messages"][1]["content"]
@@ -0,0 +1,58 @@
+import json
+
+import httpx
+
+import lambda_function as lf
+
+
+def sse_client(monkeypatch, chunks):
+    """
+    Shared HTTP client whose chat completions stream the given chunks as SSE lines
+    """
+    def handler(request):
+        body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body.encode("utf-8"))
+
+    monkeypatch.setattr(lf, "_openai_http_client", httpx.Client(base_url=lf.OPENAI_API_BASE, transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(lf, "openai_rate_limiter", lf.OpenAIRateLimiter(0, 0))
+
+
+def argument_chunks(arguments, size=7):
+    text = json.dumps(arguments)
+    return [
+        {"choices": [{"delta": {"tool_calls": [{"function": {"arguments": text[i:i + size]}}]}}]}
+        for i in range(0, len(text), size)
+    ]
+
+
+def test_parse_partial_json_without_jiter(monkeypatch):
+    monkeypatch.setattr(lf, "jiter", None)
+    assert lf.parse_partial_json('{"a": "x", "b": "y') == {"a": "x"}
+    assert lf.parse_partial_json('{"a": 1, "b": [1, 2') == {"a": 1}
+    assert lf.parse_partial_json('{"a": "x, y", "b": 2}') == {"a": "x, y", "b": 2}
+    assert lf.parse_partial_json('{"a": "say \\"hi\\", ok"') == {"a": 'say "hi", ok'}
+    assert lf.parse_partial_json('[1, 2') == {}
+
+
+def test_stream_reports_fields_and_usage(monkeypatch):
+    arguments = {"document_type": "BILL_INVOICE", "confidence": "HIGH", "reason": "invoice"}
+    sse_client(monkeypatch, argument_chunks(arguments) + [{"choices": [], "usage": {"total_tokens": 42}}])
+
+    seen = []
+    result = lf.stream_openai_request("/chat/completions", {"model": "x"}, "sk-test", on_field=lambda name, value: seen.append(name))
+
+    assert seen == ["document_type", "confidence", "reason"]
+    assert lf.parse_tool_call_arguments(result) == arguments
+    assert result["usage"] == {"total_tokens": 42}
+
+
+def test_stream_stops_early(monkeypatch):
+    arguments = {"document_type": "OTHER", "confidence": "HIGH", "reason": "a newsletter, not a bill"}
+    sse_client(monkeypatch, argument_chunks(arguments))
+
+    result = lf.stream_openai_request(
+        "/chat/completions", {"model": "x"}, "sk-test",
+        stop_when=lambda fields: fields.get("document_type") == "OTHER"
+    )
+
+    assert lf.parse_tool_call_arguments(result) == {"document_type": "OTHER"}
@@ -0,0 +1,19 @@
+import lambda_function as lf
+
+
+def test_compact_document_text_collapses_whitespace_and_repeats():
+    text, pages = lf.compact_document_text("Total......... 12.00\nTotal......... 12.00\nfoo    bar")
+    assert text == "Total 12.00\nfoo bar"
+    assert pages is None
+
+
+def test_compact_document_text_drops_repeated_page_margins():
+    page_texts = [f"ACME Supplies Ltd\nLine item {n}  $1{n}.00\nPage {n} footer note" for n in range(1, 5)]
+    text, _ = lf.compact_document_text("\n".join(page_texts))
+    assert text.count("ACME Supplies Ltd") == 1
+    assert all(f"Line item {n} $1{n}.00" in text for n in range(1, 5))
+
+
+def test_compact_document_text_disabled(monkeypatch):
+    monkeypatch.setattr(lf, "TEXT_COMPACTION_ENABLED", False)
+    assert lf.compact_document_text("a    b") == ("a    b", None)
@@ -0,0 +1,57 @@
+import pytest
+
+import lambda_function as lf
+
+GOOD_TEXT = "ACME Supplies Invoice\nInvoice number INV-2041\nDate: 2024-03-15\nTotal amount due: $1,234.50\n"
+# Text layer of a font without a usable ToUnicode map: every letter and digit is shifted
+BROKEN_TEXT = "".join(chr(ord(char) + 3) if char.isalnum() else char for char in GOOD_TEXT)
+
+
+def test_score_text_quality():
+    assert lf.score_text_quality(GOOD_TEXT) > lf.TEXT_QUALITY_MIN_SCORE
+    assert lf.score_text_quality(BROKEN_TEXT) < lf.TEXT_QUALITY_MIN_SCORE
+    assert lf.score_text_quality("�" * 50) < lf.TEXT_QUALITY_MIN_SCORE
+    assert lf.score_text_quality("") == 0
+
+
+def test_sample_invoice_text_layer_scores_high(read_sample):
+    result = lf.extract_text_from_pdf(read_sample("invoice123.pdf"))
+    assert result["success"]
+    assert result["page_count"] == 2
+    assert lf.score_text_quality(result["text"]) == 0.99
+
+
+@pytest.fixture
+def pdf_pipeline(monkeypatch):
+    """
+    process_single_pdf with a given text layer and page image transcript, recording the text analysed
+    """
+    def run(layer_text, image_text, full_page_images):
+        analysed = []
+        monkeypatch.setattr(lf, "extract_text_from_pdf", lambda content: {"success": True, "text": layer_text, "pages": None, "producer": ""})
+        monkeypatch.setattr(lf, "extract_text_from_scanned_pdf", lambda content, filename, api_key: {"success": True, "text": image_text, "full_page_images": full_page_images})
+        def analyze(text, api_key, pages=None, producer="", sender_email=""):
+            analysed.append(text)
+            return {"document_type": "BILL_INVOICE", "confidence": "HIGH", "reason": ""}, {field: "x" for field in lf.BILLING_FIELDS}
+        monkeypatch.setattr(lf, "analyze_document_text", analyze)
+        row = lf.process_single_pdf(b"%PDF", "scan.pdf", "sk-test")
+        return analysed[0], row["status_note"]
+    return run
+
+
+def test_broken_layer_is_read_from_full_page_images(pdf_pipeline):
+    text, note = pdf_pipeline(BROKEN_TEXT, "www.acme", True)
+    assert text == "www.acme"
+    assert "read from page images" in note
+
+
+def test_broken_layer_is_kept_over_a_worse_logo_transcript(pdf_pipeline):
+    text, note = pdf_pipeline(BROKEN_TEXT, "www.acme", False)
+    assert text == BROKEN_TEXT
+    assert "kept over page images" in note
+
+
+def test_broken_layer_is_replaced_by_a_better_transcript(pdf_pipeline):
+    text, note = pdf_pipeline(BROKEN_TEXT, GOOD_TEXT, False)
+    assert text == GOOD_TEXT
+    assert "read from page images" in note
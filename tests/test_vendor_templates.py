@@ -0,0 +1,53 @@
+import lambda_function as lf
+
+
+def vendor_document(month):
+    return (
+        f"Acme Power Co\nInvoice Number: INV-100{month}\nInvoice Date: 2024-0{month}-15\n"
+        f"Bill To: Jane Doe\nTotal: $1{month}.50\nAmount Due: $1{month}.50\n"
+    )
+
+
+def vendor_billing_info(month):
+    return {
+        "po_number": "NOT_FOUND", "bill_to": "Jane Doe", "bill_from": "Acme Power Co",
+        "total_amount": f"1{month}.50", "amount_due": f"1{month}.50", "currency": "USD",
+        "bill_id": f"INV-100{month}", "bill_date": f"2024-0{month}-15", "items_services": "Electricity"
+    }
+
+
+def learned_store():
+    store = lf.VendorTemplateStore()
+    key = store.template_key("billing@acme.example", vendor_document(1))
+    for month in range(1, lf.VENDOR_TEMPLATE_MIN_SAMPLES + 1):
+        assert store.match(key, vendor_document(month)) == (None, False)
+        store.observe(key, vendor_document(month), vendor_billing_info(month))
+    return store, key
+
+
+def test_template_key_ignores_changing_values():
+    store = lf.VendorTemplateStore()
+    key = store.template_key("billing@acme.example", vendor_document(1))
+    assert key.startswith("acme.example|")
+    assert store.template_key("billing@acme.example", vendor_document(2)) == key
+    assert store.template_key("", vendor_document(1)) is None
+
+
+def test_vendor_template_learns_and_matches():
+    store, key = learned_store()
+    fields, spot_check = store.match(key, vendor_document(7))
+    assert fields == vendor_billing_info(7)
+    assert not spot_check
+
+
+def test_vendor_template_falls_back_when_an_anchor_disappears():
+    store, key = learned_store()
+    assert store.match(key, vendor_document(7).replace("Invoice Date:", "Issued on")) == (None, False)
+    assert store.counts["fallbacks"] == 1
+
+
+def test_vendor_template_spot_check_drift_relearns():
+    store, key = learned_store()
+    wrong = dict(vendor_billing_info(7), total_amount="99.99")
+    store.spot_check(key, vendor_document(7), vendor_billing_info(7), wrong)
+    assert store.templates[key]["rules"] is None